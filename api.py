@@ -0,0 +1,429 @@
+"""Versioned JSON API (/api/v1) mirroring the dashboards, search, slots and claims.
+
+Authentication reuses the web session cookie: log in with POST /api/v1/session
+(or the HTML login form) and send the cookie on every call.
+
+Conventions shared by every list endpoint:
+
+- `fields=id,status,doctor` returns only those fields; related objects
+  (doctor, patient, ...) are only loaded when asked for.
+- `limit` (default 50, max 200) and an opaque `cursor`. Each page carries
+  `next_cursor`, which is null on the last page. Cursors are keyset based
+  (time, id), so paging stays fast and stable while new rows arrive.
+- Every response has a strong ETag; send it back in If-None-Match to get an
+  empty 304 when nothing changed, which makes polling cheap.
+
+Bodies are serialized with orjson when it is installed, falling back to json.
+"""
+import base64
+import datetime
+import hashlib
+import json
+from functools import wraps
+from flask import Blueprint, current_app, request, g, url_for
+from flask_login import current_user, login_user, logout_user
+from sqlalchemy import tuple_
+from sqlalchemy.orm import aliased, joinedload
+from models import db, Appointment, MedicalRecord, MedicalFile, DoctorProfile, Invoice, InsuranceClaim
+import main
+import autocomplete
+
+try:
+    import orjson
+except ImportError: # Optional speedup; the stdlib encoder gives the same output, just slower
+    orjson = None
+
+api_bp = Blueprint('api', __name__, url_prefix='/api/v1')
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 200
+
+
+class ApiError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message, self.status = message, status
+
+
+@api_bp.errorhandler(ApiError)
+def handle_api_error(e):
+    return json_response({'error': e.message}, e.status, conditional=False)
+
+
+@api_bp.errorhandler(404)
+def handle_not_found(e):
+    return json_response({'error': 'Not found.'}, 404, conditional=False)
+
+
+# --- Serialization ---
+
+def _json_default(value):
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def dumps(payload):
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload, default=_json_default, separators=(',', ':')).encode('utf-8')
+
+
+def json_response(payload, status=200, conditional=True):
+    """JSON response with a content ETag; answers a matching If-None-Match with 304."""
+    response = current_app.response_class(dumps(payload), status=status, mimetype='application/json')
+    if conditional:
+        response.set_etag(hashlib.sha1(response.get_data()).hexdigest())
+        response.headers['Cache-Control'] = 'private, no-cache'
+        response.vary.add('Cookie')
+        response.make_conditional(request)
+    return response
+
+
+# --- Field selection ---
+# Each resource maps field name -> getter. Fields in the matching *_RELATIONS set are
+# eager-loaded only when selected, so a page of 200 appointments costs one query, not 201.
+
+def _doctor_summary(doctor):
+    return {'id': doctor.id, 'full_name': doctor.full_name, 'specialty': doctor.specialty}
+
+def _patient_summary(patient):
+    return {'id': patient.id, 'full_name': patient.full_name, 'phone': patient.phone}
+
+def _claim(appointment):
+    return appointment.invoice.claim if appointment.invoice else None
+
+APPOINTMENT_FIELDS = {
+    'id': lambda a: a.id,
+    'appointment_time': lambda a: a.appointment_time,
+    'status': lambda a: a.status,
+    # Billing fields read the appointment's invoice and its current claim (see billing.py)
+    'bill_amount': lambda a: a.invoice.amount if a.invoice else None,
+    'bill_status': lambda a: a.invoice.status if a.invoice else 'Unbilled',
+    'bill_description': lambda a: a.invoice.description if a.invoice else None,
+    'insurance_claim_status': lambda a: _claim(a).status if _claim(a) else 'None',
+    'bill_version': lambda a: a.invoice.version if a.invoice else 0,
+    'doctor': lambda a: _doctor_summary(a.doctor),
+    'patient': lambda a: _patient_summary(a.patient),
+    'insurance_company': lambda a: _claim(a) and {'id': _claim(a).insurer.id, 'company_name': _claim(a).insurer.company_name},
+}
+APPOINTMENT_RELATIONS = {'doctor', 'patient'}
+APPOINTMENT_BILLING_FIELDS = {'bill_amount', 'bill_status', 'bill_description', 'insurance_claim_status', 'bill_version',
+                              'insurance_company'}
+
+RECORD_FIELDS = {
+    'id': lambda r: r.id,
+    'created_at': lambda r: r.created_at,
+    'diagnosis': lambda r: r.diagnosis,
+    'notes': lambda r: r.notes,
+    'prescription': lambda r: r.prescription,
+    'doctor': lambda r: _doctor_summary(r.doctor),
+}
+RECORD_RELATIONS = {'doctor'}
+
+FILE_FIELDS = {
+    'id': lambda f: f.id,
+    'created_at': lambda f: f.created_at,
+    'original_filename': lambda f: f.original_filename,
+    'description': lambda f: f.description,
+    'url': lambda f: url_for('main.get_file', filename=f.filename),
+    'doctor': lambda f: _doctor_summary(f.doctor),
+}
+FILE_RELATIONS = {'doctor'}
+
+# Search results are (doctor, avg_overall, avg_cost, avg_hospitality, distance_km) tuples
+DOCTOR_SEARCH_FIELDS = {
+    'id': lambda r: r[0].id,
+    'full_name': lambda r: r[0].full_name,
+    'specialty': lambda r: r[0].specialty,
+    'practice_address': lambda r: r[0].practice_address,
+    'pincode': lambda r: r[0].pincode,
+    'avg_overall': lambda r: r[1],
+    'avg_cost': lambda r: r[2],
+    'avg_hospitality': lambda r: r[3],
+    'distance_km': lambda r: r[4],
+    'region': lambda r: r[0].region, # Region database (null for the default one); only own-region doctors can be booked
+}
+
+
+def selected_fields(available):
+    """Parses ?fields=a,b into a list of field names (all fields when absent)."""
+    raw = request.args.get('fields')
+    if not raw:
+        return list(available)
+    fields = [f.strip() for f in raw.split(',') if f.strip()]
+    unknown = [f for f in fields if f not in available]
+    if unknown:
+        raise ApiError(f'Unknown field(s): {", ".join(unknown)}. Available: {", ".join(available)}.')
+    return fields
+
+
+def serialize(items, available, fields):
+    getters = [(name, available[name]) for name in fields]
+    return [{name: getter(item) for name, getter in getters} for item in items]
+
+
+def eager_loads(model, relations, fields):
+    return [joinedload(getattr(model, name)) for name in fields if name in relations]
+
+
+def appointment_loads(fields):
+    """eager_loads for appointments, plus one joined load of invoice, claim and insurer for any billing field."""
+    options = eager_loads(Appointment, APPOINTMENT_RELATIONS, fields)
+    if APPOINTMENT_BILLING_FIELDS.intersection(fields):
+        options.append(joinedload(Appointment.invoice).joinedload(Invoice.claim).joinedload(InsuranceClaim.insurer))
+    return options
+
+
+# --- Pagination ---
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(dumps(values)).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token):
+    try:
+        return json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+    except ValueError:
+        raise ApiError('Invalid cursor.')
+
+
+def page_limit():
+    try:
+        limit = int(request.args.get('limit', DEFAULT_LIMIT))
+    except ValueError:
+        raise ApiError('limit must be an integer.')
+    return min(max(limit, 1), MAX_LIMIT)
+
+
+def keyset_page(query, model, time_column, descending=False):
+    """Runs one page of `query` ordered by (time, id); returns (rows, next_cursor).
+
+    The cursor holds only the last row's id. Its time is read back in SQL, so the
+    comparison is made against the stored value: created_at columns filled by
+    CURRENT_TIMESTAMP have no fractional seconds, and a time round-tripped through
+    Python would no longer compare equal to them.
+    """
+    limit = page_limit()
+    token = request.args.get('cursor')
+    if token:
+        values = decode_cursor(token)
+        if not (isinstance(values, list) and len(values) == 1 and isinstance(values[0], int)):
+            raise ApiError('Invalid cursor.')
+        anchor = aliased(model)
+        anchor_time = db.select(getattr(anchor, time_column.key)).where(anchor.id == values[0]).scalar_subquery()
+        key, anchor_key = tuple_(time_column, model.id), tuple_(anchor_time, values[0])
+        query = query.where(key < anchor_key if descending else key > anchor_key)
+    order = (time_column.desc(), model.id.desc()) if descending else (time_column.asc(), model.id.asc())
+    rows = db.session.scalars(query.order_by(*order).limit(limit + 1)).unique().all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor([rows[-1].id])
+    return rows, next_cursor
+
+
+def list_response(items, available, fields, next_cursor):
+    return json_response({'data': serialize(items, available, fields), 'next_cursor': next_cursor})
+
+
+# --- Auth ---
+
+def current_profile():
+    return {'patient': current_user.patient_profile, 'doctor': current_user.doctor_profile,
+            'insurance': current_user.insurance_profile}.get(current_user.role)
+
+
+def api_role_required(role_name=None):
+    """Like main.role_required, but answers 401/403 with JSON instead of redirecting to the login page."""
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            if not current_user.is_authenticated:
+                raise ApiError('Authentication required.', 401)
+            if role_name and current_user.role != role_name:
+                raise ApiError('Forbidden.', 403)
+            g.profile = current_profile()
+            return f(*args, **kwargs)
+        return decorated_function
+    return decorator
+
+
+def me_payload():
+    profile = g.profile
+    payload = {'id': current_user.id, 'email': current_user.email, 'role': current_user.role}
+    if current_user.role == 'patient':
+        payload['profile'] = {'id': profile.id, 'full_name': profile.full_name, 'insurance_company_id': profile.insurance_company_id,
+                              'insurance_policy_id': profile.insurance_policy_id}
+    elif current_user.role == 'doctor':
+        payload['profile'] = {'id': profile.id, 'full_name': profile.full_name, 'specialty': profile.specialty,
+                              'availability_start_time': profile.availability_start_time,
+                              'availability_end_time': profile.availability_end_time,
+                              'slot_duration_minutes': profile.slot_duration_minutes}
+    elif current_user.role == 'insurance':
+        payload['profile'] = {'id': profile.id, 'company_name': profile.company_name}
+    return payload
+
+
+@api_bp.route('/session', methods=['POST'])
+def create_session():
+    data = request.get_json(silent=True) or {}
+    user = main.find_user_by_email(data.get('email'))
+    if not user or not main.bcrypt.check_password_hash(user.password_hash, data.get('password') or ''):
+        raise ApiError('Invalid email or password.', 401)
+    login_user(user, remember=bool(data.get('remember')))
+    g.profile = current_profile()
+    return json_response(me_payload())
+
+
+@api_bp.route('/session', methods=['DELETE'])
+def delete_session():
+    logout_user()
+    return '', 204
+
+
+@api_bp.route('/me')
+@api_role_required()
+def api_me():
+    return json_response(me_payload())
+
+
+# --- Reference data ---
+
+@api_bp.route('/reference')
+def reference_data():
+    """Insurers and specialties. Public: the registration form needs them before login.
+
+    The payload's `version` changes whenever the lists do, so a client that asks for
+    ?v=<version> gets a response it may cache for a day without revalidating.
+    """
+    data = main.get_reference_data()
+    response = json_response(data)
+    if request.args.get('v') == data['version']:
+        response.headers['Cache-Control'] = 'public, max-age=86400, immutable'
+    return response
+
+
+# --- Patient ---
+
+@api_bp.route('/patient/appointments')
+@api_role_required('patient')
+def patient_appointments():
+    fields = selected_fields(APPOINTMENT_FIELDS)
+    query = db.select(Appointment).where(Appointment.patient_id == g.profile.id).options(*appointment_loads(fields))
+    if request.args.get('status'):
+        query = query.where(Appointment.status == request.args['status'])
+    if request.args.get('bill_status'):
+        invoiced = db.select(Invoice.id).where(Invoice.appointment_id == Appointment.id)
+        if request.args['bill_status'] == 'Unbilled':
+            query = query.where(~invoiced.exists())
+        else:
+            query = query.where(invoiced.where(Invoice.status == request.args['bill_status']).exists())
+    rows, next_cursor = keyset_page(query, Appointment, Appointment.appointment_time, descending=True)
+    return list_response(rows, APPOINTMENT_FIELDS, fields, next_cursor)
+
+
+@api_bp.route('/patient/records')
+@api_role_required('patient')
+def patient_records():
+    fields = selected_fields(RECORD_FIELDS)
+    query = db.select(MedicalRecord).where(MedicalRecord.patient_id == g.profile.id) \
+        .options(*eager_loads(MedicalRecord, RECORD_RELATIONS, fields))
+    rows, next_cursor = keyset_page(query, MedicalRecord, MedicalRecord.created_at, descending=True)
+    return list_response(rows, RECORD_FIELDS, fields, next_cursor)
+
+
+@api_bp.route('/patient/files')
+@api_role_required('patient')
+def patient_files():
+    fields = selected_fields(FILE_FIELDS)
+    query = db.select(MedicalFile).where(MedicalFile.patient_id == g.profile.id) \
+        .options(*eager_loads(MedicalFile, FILE_RELATIONS, fields))
+    rows, next_cursor = keyset_page(query, MedicalFile, MedicalFile.created_at, descending=True)
+    return list_response(rows, FILE_FIELDS, fields, next_cursor)
+
+
+@api_bp.route('/doctors')
+@api_role_required('patient')
+def search_doctors():
+    fields = selected_fields(DOCTOR_SEARCH_FIELDS)
+    try:
+        min_rating = int(request.args.get('min_rating', 1))
+    except ValueError:
+        raise ApiError('min_rating must be an integer.')
+    results = main.find_doctors(g.profile, request.args.get('specialty'), min_rating, request.args.get('sort_by', 'default'))
+    # Search results are ranked in Python, so the cursor is an offset into the ranking
+    limit = page_limit()
+    values = decode_cursor(request.args['cursor']) if request.args.get('cursor') else [0]
+    if not (isinstance(values, list) and len(values) == 1 and isinstance(values[0], int) and values[0] >= 0):
+        raise ApiError('Invalid cursor.')
+    offset = values[0]
+    page = results[offset:offset + limit]
+    next_cursor = encode_cursor([offset + limit]) if offset + limit < len(results) else None
+    return json_response({'data': serialize(page, DOCTOR_SEARCH_FIELDS, fields), 'next_cursor': next_cursor})
+
+
+@api_bp.route('/doctors/suggest')
+@api_role_required('patient')
+def suggest_doctors():
+    """Typeahead: specialties and the best-rated doctors whose name or specialty words start with `q`."""
+    query = request.args.get('q', '').strip()
+    try:
+        limit = int(request.args.get('limit', current_app.config['AUTOCOMPLETE_LIMIT']))
+    except ValueError:
+        raise ApiError('limit must be an integer.')
+    limit = max(1, min(limit, current_app.config['AUTOCOMPLETE_MAX_LIMIT']))
+    return json_response({'query': query, **autocomplete.suggest(query, limit)})
+
+
+@api_bp.route('/doctors/<int:doctor_id>/slots')
+@api_role_required('patient')
+def doctor_slots(doctor_id):
+    doctor = db.session.get(DoctorProfile, doctor_id)
+    if not doctor:
+        raise ApiError('Doctor not found.', 404)
+    try:
+        selected_date = datetime.date.fromisoformat(request.args.get('date', ''))
+    except ValueError:
+        raise ApiError('date must be YYYY-MM-DD.')
+    slots = [] if selected_date < datetime.date.today() else main.get_available_slots(doctor, selected_date)
+    return json_response({'doctor_id': doctor.id, 'date': selected_date, 'slot_duration_minutes': doctor.slot_duration_minutes,
+                          'data': slots})
+
+
+# --- Doctor ---
+
+@api_bp.route('/doctor/appointments')
+@api_role_required('doctor')
+def doctor_appointments():
+    fields = selected_fields(APPOINTMENT_FIELDS)
+    query = db.select(Appointment).where(Appointment.doctor_id == g.profile.id).options(*appointment_loads(fields))
+    if request.args.get('status'):
+        query = query.where(Appointment.status == request.args['status'])
+    rows, next_cursor = keyset_page(query, Appointment, Appointment.appointment_time)
+    return list_response(rows, APPOINTMENT_FIELDS, fields, next_cursor)
+
+
+# --- Insurance ---
+
+CLAIM_STATUSES = {'pending': ['Pending'], 'processed': ['Accepted', 'Rejected'],
+                  'accepted': ['Accepted'], 'rejected': ['Rejected']}
+
+@api_bp.route('/insurance/claims')
+@api_role_required('insurance')
+def insurance_claims():
+    status = request.args.get('status', 'pending')
+    if status not in CLAIM_STATUSES:
+        raise ApiError(f'status must be one of: {", ".join(CLAIM_STATUSES)}.')
+    fields = selected_fields(APPOINTMENT_FIELDS)
+    query = (
+        db.select(Appointment)
+        .select_from(InsuranceClaim)
+        .join(Invoice, db.and_(Invoice.id == InsuranceClaim.invoice_id, Invoice.claim_id == InsuranceClaim.id))
+        .join(Appointment, Appointment.id == Invoice.appointment_id)
+        .where(InsuranceClaim.insurer_id == g.profile.id, InsuranceClaim.status.in_(CLAIM_STATUSES[status]))
+        .options(*appointment_loads(fields))
+    )
+    # Same order as the dashboard: oldest pending claim first, newest processed claim first
+    rows, next_cursor = keyset_page(query, Appointment, Appointment.appointment_time, descending=status != 'pending')
+    return list_response(rows, APPOINTMENT_FIELDS, fields, next_cursor)
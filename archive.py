@@ -0,0 +1,74 @@
+"""Hot/cold archival of settled history.
+
+archive_history(cutoff) moves rows older than `cutoff` from the hot tables into
+their *_archive twins (see models.ArchivedAppointment and friends):
+
+- appointments that were cancelled, or completed with the bill paid,
+- medical records and uploaded-file rows.
+
+Unpaid, pending or upcoming appointments stay hot whatever their age. Each
+batch is copied and deleted in one transaction, so a row is always in exactly
+one of the two tables, and rows keep their ids: invoice links and file names
+stay valid and a read-through is a primary-key lookup. File blobs stay in
+UPLOAD_FOLDER; only the rows move. Invoices, claims and payments are not moved:
+they are keyed by appointment id and already small.
+
+Pages read the archive only when asked (?history=all), so day-to-day queries
+and their indexes cover recent data only.
+"""
+import datetime
+from sqlalchemy import insert, delete, literal
+from models import (db, Appointment, MedicalRecord, MedicalFile, Invoice,
+                    ArchivedAppointment, ArchivedMedicalRecord, ArchivedMedicalFile)
+
+
+def settled_appointment(cutoff):
+    return db.and_(
+        Appointment.appointment_time < cutoff,
+        db.or_(Appointment.status == 'Cancelled',
+               db.and_(Appointment.status == 'Completed',
+                       db.select(Invoice.id).where(Invoice.appointment_id == Appointment.id, Invoice.status == 'Paid').exists()))
+    )
+
+
+# (hot model, archive model, condition for rows to move given the cutoff)
+ARCHIVE_PLAN = [
+    (Appointment, ArchivedAppointment, settled_appointment),
+    (MedicalRecord, ArchivedMedicalRecord, lambda cutoff: MedicalRecord.created_at < cutoff),
+    (MedicalFile, ArchivedMedicalFile, lambda cutoff: MedicalFile.created_at < cutoff),
+]
+
+
+def archive_table(hot, cold, condition, batch_size, dry_run=False):
+    """Moves matching rows in id order, one batch per transaction. Returns the number of rows moved."""
+    hot_table = hot.__table__
+    columns = [column.name for column in hot_table.columns]
+    # SQLite hands out max(id) + 1 for new rows, so moving the newest row would let its id be
+    # reused by a hot row. It is never old enough to matter; leave it for a later run.
+    newest_id = db.session.scalar(db.select(db.func.max(hot.id)))
+    moved, last_id = 0, 0
+    while True:
+        ids = db.session.scalars(
+            db.select(hot.id).where(condition, hot.id > last_id, hot.id < newest_id).order_by(hot.id).limit(batch_size)
+        ).all() if newest_id else []
+        if not ids:
+            break
+        last_id = ids[-1]
+        moved += len(ids)
+        if dry_run:
+            continue
+        archived_at = datetime.datetime.now()
+        db.session.execute(insert(cold.__table__).from_select(
+            columns + ['archived_at'],
+            db.select(*hot_table.columns, literal(archived_at, db.DateTime)).where(hot_table.c.id.in_(ids))
+        ))
+        db.session.execute(delete(hot_table).where(hot_table.c.id.in_(ids)))
+        db.session.commit()
+    db.session.rollback()
+    return moved
+
+
+def archive_history(cutoff, batch_size=1000, dry_run=False):
+    """Archives everything settled before `cutoff`. Returns {hot table name: rows moved}."""
+    return {hot.__tablename__: archive_table(hot, cold, condition(cutoff), batch_size, dry_run)
+            for hot, cold, condition in ARCHIVE_PLAN}
@@ -0,0 +1,333 @@
+"""Typeahead suggestions for doctor names and specialties.
+
+Each worker keeps a PrefixIndex per region in memory:
+
+- Every word of a doctor's name and specialty, casefolded, sits in one sorted
+  list next to the doctor's id. A prefix is matched with two bisects, so no
+  query touches the database.
+- Doctors are ranked by average overall rating (unrated last), then by review
+  count. A prefix that matches more than HEAVY_RANGE entries, such as a single
+  letter or a common surname, gets its best TOP_DEPTH doctors precomputed at
+  build time. Short queries, the slow case for a plain scan, are then a dict
+  lookup. Rarer prefixes match few enough entries to rank on the fly.
+- Several words ("priya sh") narrow each other: the candidates are the doctors
+  matched by every word.
+
+The index is built when the worker starts (AUTOCOMPLETE_PRELOAD) and kept up to
+date from a stamp of the newest doctor id and the newest review id. Each lookup
+compares the stamp with the database at most every AUTOCOMPLETE_REFRESH seconds.
+When it has moved, only the new doctors and the doctors with new reviews are
+loaded and applied. register() and leave_review() call invalidate(), so the
+worker that made the change sees it on its next lookup.
+"""
+import bisect
+import copy
+import heapq
+import re
+import threading
+import time
+from dataclasses import dataclass
+from flask import current_app
+from sqlalchemy.sql import func
+from models import db, DoctorProfile, DoctorReview
+import shards
+
+TOKEN_RE = re.compile(r'\w+')
+TITLES = frozenset({'dr'}) # Typed by nobody looking for a doctor, and carried by nearly every name
+HEAVY_RANGE = 256 # Prefixes matching more index entries than this get a precomputed top list
+TOP_DEPTH = 128 # Doctors kept per top list; rebuilt from the index once fewer than half remain
+LAST = '\U0010ffff' # Sorts after every character, so prefix + LAST closes the prefix's range
+
+
+def tokens(text):
+    return [token for token in TOKEN_RE.findall((text or '').casefold()) if token not in TITLES]
+
+
+@dataclass(frozen=True, slots=True)
+class DoctorEntry:
+    id: int
+    full_name: str
+    specialty: str
+    avg_overall: float
+    review_count: int
+    tokens: frozenset
+    rank: tuple # Sort key: best rated first, unrated last
+
+
+def doctor_entry(doctor_id, full_name, specialty, avg_overall, review_count):
+    review_count = review_count or 0
+    rank = (avg_overall is None, -(avg_overall or 0), -review_count, (full_name or '').casefold(), doctor_id)
+    return DoctorEntry(doctor_id, full_name, specialty, avg_overall, review_count,
+                       frozenset(tokens(full_name) + tokens(specialty)), rank)
+
+
+class PrefixIndex:
+    """An immutable snapshot of one region's doctors; updated() returns a new one."""
+
+    def __init__(self, doctors, stamp=None):
+        self.doctors = {doctor.id: doctor for doctor in doctors}
+        self.stamp = stamp # (newest doctor id, newest review id) the snapshot reflects
+        self.checked = time.monotonic() # When the stamp was last compared with the database
+        pairs = sorted((token, doctor.id) for doctor in self.doctors.values() for token in doctor.tokens)
+        self.keys = [token for token, _ in pairs]
+        self.ids = [doctor_id for _, doctor_id in pairs]
+        self.specialty_counts = {}
+        for doctor in self.doctors.values():
+            if doctor.specialty:
+                self.specialty_counts[doctor.specialty] = self.specialty_counts.get(doctor.specialty, 0) + 1
+        self.specialties = self._specialties()
+        self.top = self._top_lists(self._heavy_prefixes())
+
+    def _range(self, prefix):
+        lo = bisect.bisect_left(self.keys, prefix)
+        return lo, bisect.bisect_left(self.keys, prefix + LAST, lo)
+
+    def _heavy_prefixes(self):
+        """Every prefix matching more than HEAVY_RANGE entries. A heavy prefix's own prefixes are heavy too."""
+        heavy, stack = set(), ['']
+        while stack:
+            prefix = stack.pop()
+            pos, hi = self._range(prefix)
+            while pos < hi:
+                if len(self.keys[pos]) == len(prefix):
+                    pos += 1 # The prefix itself is a whole word
+                    continue
+                child = self.keys[pos][:len(prefix) + 1]
+                end = bisect.bisect_left(self.keys, child + LAST, pos, hi)
+                if end - pos > HEAVY_RANGE:
+                    heavy.add(child)
+                    stack.append(child)
+                pos = end
+        return heavy
+
+    def _top_lists(self, heavy):
+        """{heavy prefix: ids of its best TOP_DEPTH doctors, best first}, in one pass over the doctors in rank order."""
+        top = {prefix: [] for prefix in heavy}
+        unfilled = len(top)
+        for doctor in sorted(self.doctors.values(), key=lambda doctor: doctor.rank):
+            if not unfilled:
+                break
+            for token in doctor.tokens:
+                for length in range(1, len(token) + 1):
+                    ids = top.get(token[:length])
+                    if ids is None:
+                        break # Longer prefixes of this token are not heavy either
+                    if len(ids) < TOP_DEPTH and (not ids or ids[-1] != doctor.id):
+                        ids.append(doctor.id)
+                        if len(ids) == TOP_DEPTH:
+                            unfilled -= 1
+        return top
+
+    def _specialties(self):
+        """[(specialty, words, doctor count)], most doctors first. There are few enough to scan."""
+        return sorted(((name, tokens(name), count) for name, count in self.specialty_counts.items() if count),
+                      key=lambda item: (-item[2], item[0]))
+
+    def _best(self, candidates, limit):
+        return [self.doctors[doctor_id] for doctor_id in
+                heapq.nsmallest(limit, candidates, key=lambda doctor_id: self.doctors[doctor_id].rank)]
+
+    def _matches(self, doctor_id, words):
+        doctor_tokens = self.doctors[doctor_id].tokens
+        return all(any(token.startswith(word) for token in doctor_tokens) for word in words)
+
+    def suggest_doctors(self, query, limit):
+        """The best `limit` doctors with a name or specialty word starting with each word of the query."""
+        words = list(dict.fromkeys(tokens(query)))
+        if not words:
+            return []
+        if len(words) == 1 and words[0] in self.top:
+            return [self.doctors[doctor_id] for doctor_id in self.top[words[0]][:limit]]
+        ranges = sorted(((self._range(word), word) for word in words), key=lambda item: item[0][1] - item[0][0])
+        (lo, hi), narrowest = ranges[0]
+        others = [word for _, word in ranges[1:]]
+        if narrowest in self.top:
+            # The top list is the narrowest word's best doctors in order, so if enough of them match
+            # the other words too, they are the best matches overall
+            found = [doctor_id for doctor_id in self.top[narrowest] if self._matches(doctor_id, others)][:limit]
+            if len(found) == limit:
+                return [self.doctors[doctor_id] for doctor_id in found]
+        if hi - lo <= HEAVY_RANGE:
+            return self._best([doctor_id for doctor_id in set(self.ids[lo:hi]) if self._matches(doctor_id, others)], limit)
+        candidates = set(self.ids[lo:hi]) # Rare: every word is common, yet few doctors match them all
+        for (lo, hi), _ in ranges[1:]:
+            candidates = candidates.intersection(self.ids[lo:hi])
+        return self._best(candidates, limit)
+
+    def suggest_specialties(self, query, limit):
+        words = tokens(query)
+        if not words:
+            return []
+        matches = (item for item in self.specialties
+                   if all(any(token.startswith(word) for token in item[1]) for word in words))
+        return [(name, count) for name, _, count in matches][:limit]
+
+    def updated(self, doctors, stamp):
+        """A new index with these DoctorEntry rows added or replaced. Shares what did not change."""
+        index = copy.copy(self)
+        index.doctors, index.top, index.stamp, index.checked = dict(self.doctors), dict(self.top), stamp, time.monotonic()
+        moved = False # Any token added or removed
+        for doctor in doctors:
+            old = index.doctors.get(doctor.id)
+            if (old and old.specialty) != doctor.specialty:
+                if index.specialty_counts is self.specialty_counts:
+                    index.specialty_counts = dict(self.specialty_counts)
+                if old and old.specialty:
+                    index.specialty_counts[old.specialty] -= 1
+                if doctor.specialty:
+                    index.specialty_counts[doctor.specialty] = index.specialty_counts.get(doctor.specialty, 0) + 1
+            old_tokens = old.tokens if old else frozenset()
+            index.doctors[doctor.id] = doctor
+            if old_tokens != doctor.tokens:
+                if not moved:
+                    index.keys, index.ids, moved = list(self.keys), list(self.ids), True
+                index._move_tokens(doctor.id, old_tokens - doctor.tokens, doctor.tokens - old_tokens)
+            index._rerank(doctor, old_tokens | doctor.tokens)
+        if index.specialty_counts is not self.specialty_counts:
+            index.specialties = index._specialties()
+        return index
+
+    def _move_tokens(self, doctor_id, removed, added):
+        for token in removed:
+            pos = bisect.bisect_left(self.keys, token)
+            while self.ids[pos] != doctor_id:
+                pos += 1
+            del self.keys[pos], self.ids[pos]
+        for token in added:
+            pos = bisect.bisect_left(self.keys, token)
+            pos = bisect.bisect_left(self.ids, doctor_id, pos, bisect.bisect_right(self.keys, token, pos))
+            self.keys.insert(pos, token)
+            self.ids.insert(pos, doctor_id)
+
+    def _rerank(self, doctor, all_tokens):
+        """Fixes the top lists of the heavy prefixes of every word the doctor has (or had).
+
+        A top list always holds the best k doctors for its prefix. Doctors outside it rank below
+        its last entry, so the doctor goes back in only if it ranks above that entry. Otherwise the
+        list just gets shorter, and it is rebuilt from the index once under half of TOP_DEPTH remain.
+        """
+        prefixes = {token[:length] for token in all_tokens for length in range(1, len(token) + 1)}
+        rank = lambda doctor_id: self.doctors[doctor_id].rank
+        for prefix in prefixes & self.top.keys():
+            ids = [doctor_id for doctor_id in self.top[prefix] if doctor_id != doctor.id]
+            if ids and doctor.rank < rank(ids[-1]) and any(token.startswith(prefix) for token in doctor.tokens):
+                bisect.insort(ids, doctor.id, key=rank)
+            if len(ids) < TOP_DEPTH // 2:
+                lo, hi = self._range(prefix)
+                ids = [entry.id for entry in self._best(set(self.ids[lo:hi]), TOP_DEPTH)]
+            self.top[prefix] = ids[:TOP_DEPTH]
+
+
+# --- Per-worker indexes ---
+
+_indexes = {} # region -> PrefixIndex
+_locks = {} # region -> lock held while that region's index is built or refreshed
+_locks_lock = threading.Lock()
+
+
+def _stamp():
+    return tuple(db.session.execute(db.select(
+        db.select(func.max(DoctorProfile.id)).scalar_subquery(),
+        db.select(func.max(DoctorReview.id)).scalar_subquery(),
+    )).one())
+
+
+def load_doctors(doctor_ids=None):
+    """DoctorEntry rows for every doctor, or just these."""
+    ratings = db.select(DoctorReview.doctor_id, func.avg(DoctorReview.overall_rating).label('avg_overall'),
+                        func.count().label('review_count')).group_by(DoctorReview.doctor_id)
+    query = db.select(DoctorProfile.id, DoctorProfile.full_name, DoctorProfile.specialty)
+    if doctor_ids is not None:
+        ratings = ratings.where(DoctorReview.doctor_id.in_(doctor_ids))
+        query = query.where(DoctorProfile.id.in_(doctor_ids))
+    ratings = ratings.subquery()
+    query = query.add_columns(ratings.c.avg_overall, ratings.c.review_count) \
+        .outerjoin(ratings, DoctorProfile.id == ratings.c.doctor_id)
+    return [doctor_entry(*row) for row in db.session.execute(query)]
+
+
+def build_index():
+    stamp = _stamp() # Read first: anything committed after it is picked up by the next refresh
+    return PrefixIndex(load_doctors(), stamp)
+
+
+def _refresh(index):
+    stamp = _stamp()
+    if stamp == index.stamp:
+        index.checked = time.monotonic()
+        return index
+    last_doctor, last_review = ((value or 0) for value in index.stamp)
+    changed = set(db.session.scalars(db.select(DoctorProfile.id).where(DoctorProfile.id > last_doctor)))
+    changed.update(db.session.scalars(db.select(DoctorReview.doctor_id).where(DoctorReview.id > last_review).distinct()))
+    if len(changed) > max(1000, len(index.doctors) // 20):
+        return build_index() # Cheaper than applying that many changes one by one
+    return index.updated(load_doctors(changed), stamp)
+
+
+def get_index():
+    """The current region's index, refreshed if it is due."""
+    region = shards.current_region()
+    index = _indexes.get(region)
+    if index is not None and time.monotonic() - index.checked < current_app.config['AUTOCOMPLETE_REFRESH']:
+        return index
+    with _locks_lock:
+        lock = _locks.setdefault(region, threading.Lock())
+    with lock:
+        index = _indexes.get(region) # Another thread may have done it while we waited
+        if index is None:
+            index = build_index()
+        elif time.monotonic() - index.checked >= current_app.config['AUTOCOMPLETE_REFRESH']:
+            index = _refresh(index)
+        _indexes[region] = index
+    return index
+
+
+def invalidate():
+    """Makes every region's index compare its stamp on the next lookup."""
+    for index in list(_indexes.values()):
+        index.checked = float('-inf')
+
+
+def _suggest_in_region(query, limit):
+    index = get_index()
+    return index.suggest_specialties(query, limit), index.suggest_doctors(query, limit)
+
+
+def suggest(query, limit):
+    """{'specialties': [...], 'doctors': [...]} for the query. Sharded, every region is asked and the results merged."""
+    specialties, doctors = {}, []
+    for region, (region_specialties, region_doctors) in shards.fan_out(_suggest_in_region, query, limit).items():
+        for name, count in region_specialties:
+            specialties[name] = specialties.get(name, 0) + count
+        doctors += [(doctor, region) for doctor in region_doctors]
+    doctors = heapq.nsmallest(limit, doctors, key=lambda item: item[0].rank)
+    return {
+        'specialties': [{'name': name, 'doctors': count}
+                        for name, count in sorted(specialties.items(), key=lambda item: (-item[1], item[0]))[:limit]],
+        'doctors': [{'id': doctor.id, 'full_name': doctor.full_name, 'specialty': doctor.specialty,
+                     'avg_overall': round(doctor.avg_overall, 1) if doctor.avg_overall is not None else None,
+                     'review_count': doctor.review_count, 'region': region} for doctor, region in doctors],
+    }
+
+
+def init_autocomplete(app):
+    app.config.setdefault('AUTOCOMPLETE_LIMIT', 8)
+    app.config.setdefault('AUTOCOMPLETE_MAX_LIMIT', 20)
+    app.config.setdefault('AUTOCOMPLETE_REFRESH', 30)
+    app.config.setdefault('AUTOCOMPLETE_PRELOAD', False)
+    if not app.config['AUTOCOMPLETE_PRELOAD']:
+        return
+
+    def preload():
+        with app.app_context():
+            for region in shards.regions():
+                try:
+                    with shards.use_region(region):
+                        get_index()
+                except Exception:
+                    app.logger.exception('Could not build the autocomplete index for region %s', region)
+                finally:
+                    db.session.remove()
+
+    # In the background, so the worker can serve other pages while a large index builds
+    threading.Thread(target=preload, name='autocomplete-preload', daemon=True).start()
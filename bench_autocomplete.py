@@ -0,0 +1,177 @@
+"""Doctor name / specialty autocomplete benchmark (see autocomplete.py).
+
+Builds a PrefixIndex over --doctors synthetic doctors in memory. First names
+and specialties come from generate_data.py's pools; surnames mix its common
+ones with random made-up ones, so there are both very common and rare words.
+Then it times lookups for each kind of query a typing user sends, and compares
+them with a plain scan that checks and ranks every doctor. Also times the
+incremental update a new review or a few new doctors cause.
+
+With --db it also times GET /api/v1/doctors/suggest end to end through the
+Flask test client, logged in as patient@test.com (see generate_data.py).
+
+    python bench_autocomplete.py --doctors 100000
+    python bench_autocomplete.py --doctors 100000 --db bench.db
+"""
+import argparse
+import json
+import random
+import string
+import time
+
+import autocomplete
+from generate_data import FIRST_NAMES, LAST_NAMES, SPECIALTIES
+
+TARGET_MS = 5.0
+
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+
+def made_up_surname(rng):
+    syllables = ['ka', 'ra', 'an', 'vi', 'sh', 'ma', 'th', 'ur', 'de', 'la', 'ne', 'po', 'gi', 'ul', 'ya', 'ch']
+    return ''.join(rng.choice(syllables) for _ in range(rng.randint(2, 4))).capitalize()
+
+
+def synthetic_doctors(count, rng):
+    doctors = []
+    for doctor_id in range(1, count + 1):
+        surname = rng.choice(LAST_NAMES) if rng.random() < 0.5 else made_up_surname(rng)
+        review_count = rng.choice((0, 0, rng.randint(1, 5), rng.randint(5, 200)))
+        avg_overall = round(rng.uniform(1, 10), 2) if review_count else None
+        doctors.append(autocomplete.doctor_entry(doctor_id, f'Dr. {rng.choice(FIRST_NAMES)} {surname}',
+                                                 rng.choice(SPECIALTIES), avg_overall, review_count))
+    return doctors
+
+
+def query_mix(doctors, rng, per_kind):
+    """{kind: [query, ...]}: prefixes of real words, whole words, two-word queries and misses."""
+    words = [token for doctor in rng.sample(doctors, min(len(doctors), 2000)) for token in doctor.tokens]
+    names = [autocomplete.tokens(doctor.full_name) for doctor in rng.sample(doctors, min(len(doctors), 2000))]
+    return {
+        '1 letter': [rng.choice(string.ascii_lowercase) for _ in range(per_kind)],
+        '2 letters': [rng.choice(words)[:2] for _ in range(per_kind)],
+        '3 letters': [rng.choice(words)[:3] for _ in range(per_kind)],
+        'whole word': [rng.choice(words) for _ in range(per_kind)],
+        'two words': [' '.join((name[0], name[-1][:rng.randint(1, 3)])) for name in rng.choices(names, k=per_kind)],
+        'no match': [''.join(rng.choices('qxz', k=3)) for _ in range(per_kind)],
+    }
+
+
+def naive_suggest(doctors, query, limit):
+    """The baseline: test every doctor's words, then rank the matches."""
+    words = autocomplete.tokens(query)
+    matches = [doctor for doctor in doctors
+               if all(any(token.startswith(word) for token in doctor.tokens) for word in words)]
+    return sorted(matches, key=lambda doctor: doctor.rank)[:limit]
+
+
+def time_queries(fn, queries):
+    latencies = []
+    for query in queries:
+        t0 = time.perf_counter()
+        fn(query)
+        latencies.append(time.perf_counter() - t0)
+    return latencies
+
+
+def run_index(args, rng):
+    doctors = synthetic_doctors(args.doctors, rng)
+    t0 = time.perf_counter()
+    index = autocomplete.PrefixIndex(doctors, stamp=(args.doctors, 0))
+    build_s = time.perf_counter() - t0
+
+    mix = query_mix(doctors, rng, args.queries)
+    results = {}
+    for kind, queries in mix.items():
+        for query in queries[:20]: # The index must agree with the scan
+            expected = [doctor.id for doctor in naive_suggest(doctors, query, args.limit)]
+            got = [doctor.id for doctor in index.suggest_doctors(query, args.limit)]
+            if expected != got:
+                raise SystemExit(f'Mismatch for {query!r}: {got} != {expected}')
+        indexed = time_queries(lambda q: (index.suggest_doctors(q, args.limit), index.suggest_specialties(q, args.limit)), queries)
+        naive = time_queries(lambda q: naive_suggest(doctors, q, args.limit), queries[:args.naive_queries])
+        results[kind] = {'p50_ms': percentile(indexed, 50) * 1000, 'p95_ms': percentile(indexed, 95) * 1000,
+                         'max_ms': max(indexed) * 1000, 'naive_p50_ms': percentile(naive, 50) * 1000}
+
+    # A new review for a top-ranked doctor, then a handful of new doctors
+    best = index.suggest_doctors('a', 1)[0]
+    reviewed = autocomplete.doctor_entry(best.id, best.full_name, best.specialty, 1.0, best.review_count + 1)
+    t0 = time.perf_counter()
+    index = index.updated([reviewed], (args.doctors, 1))
+    review_ms = (time.perf_counter() - t0) * 1000
+    new_doctors = synthetic_doctors(10, random.Random(args.seed + 1))
+    new_doctors = [autocomplete.doctor_entry(args.doctors + d.id, d.full_name, d.specialty, d.avg_overall, d.review_count)
+                   for d in new_doctors]
+    t0 = time.perf_counter()
+    index = index.updated(new_doctors, (args.doctors + 10, 1))
+    new_doctors_ms = (time.perf_counter() - t0) * 1000
+    all_doctors = [index.doctors[doctor_id] for doctor_id in index.doctors]
+    for query in ('a', best.full_name.split()[1][:2], new_doctors[0].full_name.split()[-1][:3]):
+        if [d.id for d in index.suggest_doctors(query, args.limit)] != [d.id for d in naive_suggest(all_doctors, query, args.limit)]:
+            raise SystemExit(f'Mismatch after update for {query!r}')
+
+    return {'doctors': args.doctors, 'index_entries': len(index.keys), 'precomputed_prefixes': len(index.top),
+            'build_s': build_s, 'queries': results, 'update_one_review_ms': review_ms, 'update_ten_new_doctors_ms': new_doctors_ms}
+
+
+def run_endpoint(args, rng):
+    import main
+
+    app = main.create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + args.db, 'RATE_LIMIT_ENABLED': False,
+                           'AUTO_MIGRATE': False, 'AUTOCOMPLETE_PRELOAD': False})
+    client = app.test_client()
+    response = client.post('/api/v1/session', json={'email': 'patient@test.com', 'password': args.password})
+    if response.status_code != 200:
+        raise SystemExit(f'patient@test.com could not log in ({response.status_code}).')
+    t0 = time.perf_counter()
+    client.get('/api/v1/doctors/suggest?q=a')
+    first_s = time.perf_counter() - t0 # Builds the index
+    with app.app_context():
+        doctors = list(autocomplete.get_index().doctors.values())
+    latencies = time_queries(lambda q: client.get('/api/v1/doctors/suggest', query_string={'q': q, 'limit': args.limit}),
+                             [q for queries in query_mix(doctors, rng, args.queries).values() for q in queries])
+    return {'db': args.db, 'doctors': len(doctors), 'first_request_s': first_s,
+            'p50_ms': percentile(latencies, 50) * 1000, 'p95_ms': percentile(latencies, 95) * 1000}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--doctors', type=int, default=100_000)
+    parser.add_argument('--queries', type=int, default=2000, help='Queries timed per kind.')
+    parser.add_argument('--naive-queries', type=int, default=20, help='Queries per kind for the plain-scan baseline.')
+    parser.add_argument('--limit', type=int, default=8, help='Suggestions per query.')
+    parser.add_argument('--db', help='Also time the API endpoint against this database.')
+    parser.add_argument('--password', default='password')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help='Print raw JSON results.')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    result = {'index': run_index(args, rng)}
+    if args.db:
+        result['endpoint'] = run_endpoint(args, rng)
+    if args.json:
+        print(json.dumps(result, indent=2))
+        return
+
+    index = result['index']
+    print(f'{index["doctors"]} doctors, {index["index_entries"]} index entries, '
+          f'{index["precomputed_prefixes"]} precomputed prefixes, built in {index["build_s"]:.2f}s')
+    print(f'{"query":<12}{"p50":>10}{"p95":>10}{"max":>10}{"scan p50":>12}')
+    for kind, r in index['queries'].items():
+        flag = '' if r['p95_ms'] < TARGET_MS else f'  over {TARGET_MS:g}ms'
+        print(f'{kind:<12}{r["p50_ms"]:>8.3f}ms{r["p95_ms"]:>8.3f}ms{r["max_ms"]:>8.3f}ms{r["naive_p50_ms"]:>10.1f}ms{flag}')
+    print(f'Update: one review {index["update_one_review_ms"]:.1f}ms, ten new doctors {index["update_ten_new_doctors_ms"]:.1f}ms')
+    if 'endpoint' in result:
+        endpoint = result['endpoint']
+        print(f'Endpoint ({endpoint["doctors"]} doctors): first request {endpoint["first_request_s"]:.2f}s, '
+              f'p50 {endpoint["p50_ms"]:.2f}ms, p95 {endpoint["p95_ms"]:.2f}ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,325 @@
+"""Route-level load and latency benchmark.
+
+Virtual users run scripted sessions against the app and every request is
+timed per route:
+
+    patient:   login, dashboard, search, pick a date, book a slot, pay a bill, logout
+    doctor:    login, dashboard, view/add a record, send a bill, logout
+    insurer:   login, dashboard, view an invoice, process a claim, logout
+
+By default the app runs in-process through the Flask test client against a
+throwaway copy of --db (build one with generate_data.py). With --url the same
+sessions are sent over HTTP to a running server, e.g. a local gunicorn serving
+that database; that server's database is modified by the sessions. Start
+that server with RATE_LIMIT_ENABLED=0, as the in-process app is, or the
+per-IP rate limits (see ratelimit.py) reject most logins and searches.
+
+    python bench_routes.py --db bench.db --duration 30 --concurrency 8 --output before.json
+    python bench_routes.py --db bench.db --duration 30 --concurrency 8 --output after.json --compare before.json
+    python bench_routes.py --db bench.db --url http://127.0.0.1:8000 --duration 30
+
+Results (throughput and p50/p95/p99 latency per route) are printed and can be
+saved as JSON; --compare diffs against an earlier run and flags regressions.
+"""
+import argparse
+import datetime
+import http.cookiejar
+import json
+import os
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+basedir = os.path.abspath(os.path.dirname(__file__))
+SPECIALTIES = ['Cardio', 'Derma', 'Neuro', 'Pedia', 'Onco', 'Ortho', 'General', 'Surgeon', 'Psych', '']
+
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+
+# --- Transports: both return the status code and fully read the body ---
+
+class TestClientSession:
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, data=None):
+        response = self.client.open(path, method=method, data=data)
+        response.get_data()
+        response.close()
+        return response.status_code
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None # Surface 302s as-is, like the test client
+
+
+class HttpSession:
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), _NoRedirect())
+
+    def request(self, method, path, data=None):
+        body = urllib.parse.urlencode(data).encode() if data is not None else None
+        req = urllib.request.Request(self.base_url + path, data=body, method=method)
+        try:
+            with self.opener.open(req, timeout=60) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as e:
+            e.read()
+            return e.code
+
+
+# --- Work pools: ids the sessions can act on, read straight from the database ---
+
+class WorkPools:
+    def __init__(self, db_path, rng, accounts_per_role):
+        conn = sqlite3.connect(db_path)
+        q = lambda sql, *params: conn.execute(sql, params).fetchall()
+        self.lock = threading.Lock()
+        self.patients = q('SELECT u.email, p.id FROM user u JOIN patient_profile p ON p.user_id = u.id ORDER BY u.id LIMIT ?', accounts_per_role)
+        self.doctors = q('SELECT u.email, d.id FROM user u JOIN doctor_profile d ON d.user_id = u.id ORDER BY u.id LIMIT ?', accounts_per_role)
+        self.insurers = q('SELECT u.email, i.id FROM user u JOIN insurance_profile i ON i.user_id = u.id ORDER BY u.id LIMIT ?', accounts_per_role)
+        self.doctor_ids = [row[0] for row in q('SELECT id FROM doctor_profile ORDER BY id LIMIT 10000')]
+        self.unpaid = self._group(q, 'patient_id', "id IN (SELECT appointment_id FROM invoice WHERE status = 'Unpaid')",
+                                  [p[1] for p in self.patients])
+        self.unbilled = self._group(q, 'doctor_id', "status = 'Completed' AND id NOT IN (SELECT appointment_id FROM invoice)",
+                                    [d[1] for d in self.doctors])
+        self.doctor_patients = {
+            doctor_id: [row[0] for row in q('SELECT DISTINCT patient_id FROM appointment WHERE doctor_id = ? LIMIT 20', doctor_id)]
+            for _, doctor_id in self.doctors
+        }
+        self.pending_claims = {insurer_id: [row[0] for row in q(
+            'SELECT i.appointment_id FROM insurance_claim c JOIN invoice i ON i.id = c.invoice_id AND i.claim_id = c.id '
+            "WHERE c.insurer_id = ? AND c.status = 'Pending' ORDER BY i.appointment_id LIMIT 50", insurer_id)]
+            for _, insurer_id in self.insurers}
+        conn.close()
+        for pool in (self.patients, self.doctors, self.insurers):
+            rng.shuffle(pool)
+
+    @staticmethod
+    def _group(q, owner_column, condition, owner_ids):
+        grouped = {}
+        for owner_id in owner_ids:
+            grouped[owner_id] = [row[0] for row in q(
+                f'SELECT id FROM appointment WHERE {owner_column} = ? AND {condition} ORDER BY id LIMIT 50', owner_id)]
+        return grouped
+
+    def take(self, pool, owner_id):
+        with self.lock:
+            ids = pool.get(owner_id)
+            return ids.pop() if ids else None
+
+
+# --- Scripted sessions ---
+
+def patient_session(call, pools, rng, password):
+    email, patient_id = rng.choice(pools.patients)
+    call('login', 'POST', '/login', {'email': email, 'password': password}, expect=(302,))
+    call('patient_dashboard', 'GET', '/patient_dashboard')
+    call('search_doctors', 'POST', '/search_doctors', {
+        'specialty': rng.choice(SPECIALTIES), 'min_rating': str(rng.choice((1, 1, 5, 7))),
+        'sort_by': rng.choice(('default', 'rating', 'distance'))})
+    doctor_id = rng.choice(pools.doctor_ids)
+    day = datetime.date.today() + datetime.timedelta(days=rng.randint(1, 60))
+    call('book_appointment [GET]', 'GET', f'/book_appointment/{doctor_id}?date={day.isoformat()}')
+    slot = datetime.datetime.combine(day, datetime.time(rng.randint(9, 16), rng.choice((0, 30))))
+    call('book_appointment [POST]', 'POST', f'/book_appointment/{doctor_id}', {'appointment_slot': slot.isoformat()}, expect=(302,))
+    appointment_id = pools.take(pools.unpaid, patient_id)
+    if appointment_id:
+        call('pay_bill', 'GET', f'/pay_bill/{appointment_id}')
+        call('pay_upi', 'GET', f'/pay_upi/{appointment_id}', expect=(302,))
+    call('logout', 'GET', '/logout', expect=(302,))
+
+
+def doctor_session(call, pools, rng, password):
+    email, doctor_id = rng.choice(pools.doctors)
+    call('login', 'POST', '/login', {'email': email, 'password': password}, expect=(302,))
+    call('doctor_dashboard', 'GET', '/doctor_dashboard')
+    if pools.doctor_patients.get(doctor_id):
+        patient_id = rng.choice(pools.doctor_patients[doctor_id])
+        call('update_record [GET]', 'GET', f'/update_record/{patient_id}')
+        call('update_record [POST]', 'POST', f'/update_record/{patient_id}', {
+            'diagnosis': 'Benchmark visit', 'notes': 'Stable.', 'prescription': 'None'}, expect=(302,))
+    appointment_id = pools.take(pools.unbilled, doctor_id)
+    if appointment_id:
+        call('set_bill', 'POST', f'/set_bill/{appointment_id}', {
+            'bill_amount': str(rng.randint(5, 200) * 10), 'bill_description': 'Consultation'}, expect=(302,))
+    call('logout', 'GET', '/logout', expect=(302,))
+
+
+def insurer_session(call, pools, rng, password):
+    email, insurer_id = rng.choice(pools.insurers)
+    call('login', 'POST', '/login', {'email': email, 'password': password}, expect=(302,))
+    call('insurance_dashboard', 'GET', '/insurance_dashboard')
+    appointment_id = pools.take(pools.pending_claims, insurer_id)
+    if appointment_id:
+        call('generate_invoice_pdf', 'GET', f'/generate_invoice_pdf/{appointment_id}')
+        action = 'accept' if rng.random() < 0.7 else 'reject'
+        call('process_claim', 'GET', f'/process_claim/{appointment_id}/{action}', expect=(302,))
+    call('logout', 'GET', '/logout', expect=(302,))
+
+
+SESSIONS = [('patient', patient_session), ('doctor', doctor_session), ('insurer', insurer_session)]
+
+
+def run(args, make_session, pools):
+    weights = [args.patient_weight, args.doctor_weight, args.insurer_weight]
+    lock = threading.Lock()
+    latencies, errors, sessions = {}, {}, {'patient': 0, 'doctor': 0, 'insurer': 0}
+    deadline = time.perf_counter() + args.duration
+
+    def worker(worker_id):
+        rng = random.Random(f'{args.seed}:{worker_id}')
+        local_latencies, local_errors, local_sessions = {}, {}, {}
+
+        while time.perf_counter() < deadline:
+            kind, session_fn = rng.choices(SESSIONS, weights=weights)[0]
+            session = make_session() # Fresh cookies per session
+
+            def call(route, method, path, data=None, expect=(200,)):
+                t0 = time.perf_counter()
+                status = session.request(method, path, data)
+                local_latencies.setdefault(route, []).append(time.perf_counter() - t0)
+                if status not in expect:
+                    local_errors[route] = local_errors.get(route, 0) + 1
+
+            session_fn(call, pools, rng, args.password)
+            local_sessions[kind] = local_sessions.get(kind, 0) + 1
+
+        with lock:
+            for route, samples in local_latencies.items():
+                latencies.setdefault(route, []).extend(samples)
+            for route, count in local_errors.items():
+                errors[route] = errors.get(route, 0) + count
+            for kind, count in local_sessions.items():
+                sessions[kind] += count
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    routes = {}
+    for route, samples in sorted(latencies.items()):
+        samples.sort()
+        routes[route] = {
+            'count': len(samples),
+            'errors': errors.get(route, 0),
+            'throughput_per_s': len(samples) / elapsed,
+            'mean_ms': sum(samples) / len(samples) * 1000,
+            'p50_ms': percentile(samples, 50) * 1000,
+            'p95_ms': percentile(samples, 95) * 1000,
+            'p99_ms': percentile(samples, 99) * 1000,
+        }
+    return {'elapsed_s': elapsed, 'sessions': sessions, 'requests': sum(r['count'] for r in routes.values()), 'routes': routes}
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=basedir, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def print_report(result, baseline=None, threshold=10.0):
+    print(f'{result["requests"]} requests in {result["elapsed_s"]:.1f}s '
+          f'({result["requests"] / result["elapsed_s"]:.1f} req/s), sessions: {result["sessions"]}')
+    header = f'{"route":<26}{"count":>7}{"err":>5}{"req/s":>8}{"p50 ms":>9}{"p95 ms":>9}{"p99 ms":>9}'
+    if baseline:
+        header += f'{"p95 vs base":>13}'
+    print(header)
+    regressions = []
+    for route, r in result['routes'].items():
+        line = f'{route:<26}{r["count"]:>7}{r["errors"]:>5}{r["throughput_per_s"]:>8.1f}{r["p50_ms"]:>9.1f}{r["p95_ms"]:>9.1f}{r["p99_ms"]:>9.1f}'
+        base = baseline['routes'].get(route) if baseline else None
+        if base and base['p95_ms'] > 0:
+            change = (r['p95_ms'] - base['p95_ms']) / base['p95_ms'] * 100
+            flag = ' !' if change > threshold else ''
+            line += f'{change:>+11.1f}%{flag}'
+            if flag:
+                regressions.append((route, change))
+        print(line)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', default=os.path.join(basedir, 'site.db'), help='Database to benchmark (copied unless --url).')
+    parser.add_argument('--url', help='Benchmark a running server (e.g. gunicorn) instead of the in-process test client.')
+    parser.add_argument('--duration', type=float, default=20)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--patient-weight', type=float, default=6)
+    parser.add_argument('--doctor-weight', type=float, default=2.5)
+    parser.add_argument('--insurer-weight', type=float, default=1.5)
+    parser.add_argument('--accounts', type=int, default=200, help='Accounts per role to log in as.')
+    parser.add_argument('--password', default='password')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='Write results as JSON.')
+    parser.add_argument('--compare', help='Earlier JSON result to diff against.')
+    parser.add_argument('--threshold', type=float, default=10.0, help='p95 increase (%%) counted as a regression.')
+    parser.add_argument('--fail-on-regression', action='store_true')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = args.db
+        if args.url:
+            make_session = lambda: HttpSession(args.url)
+        else:
+            db_path = os.path.join(tmp, 'bench.db')
+            shutil.copyfile(args.db, db_path)
+            os.environ['DATABASE_URL'] = 'sqlite:///' + db_path
+            import main as app_module
+            # Every virtual user comes from one address, so admission control would turn the run
+            # into a benchmark of 429s and redirects to /login
+            app = app_module.create_app({'RATE_LIMIT_ENABLED': False, 'CONCURRENCY_LIMITS': {}})
+            make_session = lambda: TestClientSession(app)
+
+        pools = WorkPools(db_path, random.Random(args.seed), args.accounts)
+        if not (pools.patients and pools.doctors and pools.insurers):
+            parser.error('The database needs at least one patient, doctor and insurer account.')
+        result = run(args, make_session, pools)
+
+    result['meta'] = {
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'git_revision': git_revision(),
+        'target': args.url or 'test-client',
+        'db': os.path.abspath(args.db),
+        'duration': args.duration,
+        'concurrency': args.concurrency,
+        'seed': args.seed,
+    }
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    regressions = print_report(result, baseline, args.threshold)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+        print(f'Saved {args.output}')
+    if regressions:
+        print(f'{len(regressions)} route(s) regressed by more than {args.threshold:g}% at p95.')
+        if args.fail_on_regression:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
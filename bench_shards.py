@@ -0,0 +1,170 @@
+"""Write-scaling benchmark for region sharding (see shards.py).
+
+For each region count N, builds N empty region databases in a temporary
+directory and seeds each with doctors and patients. It then runs --writers
+booking processes per region for --seconds. Each writer logs in as one of its
+region's patients and books appointments through the Flask test client. With
+one region every writer queues on the same SQLite write lock. With N regions
+the writers spread over N files, so bookings/s should grow close to linearly
+with N, as long as the machine has a core for each writer.
+
+    python bench_shards.py --regions 1 2 4 --writers 2 --seconds 10
+"""
+import argparse
+import datetime
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+basedir = os.path.abspath(os.path.dirname(__file__))
+
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+
+def region_names(count):
+    return [f'region{i}' for i in range(count)]
+
+
+def seed(args, tmp, count):
+    """Creates the default database and `count` region databases, each with doctors and one patient per writer."""
+    import main
+    from models import db, User, PatientProfile, DoctorProfile
+    import shards
+
+    shard_uris = {region: 'sqlite:///' + os.path.join(tmp, f'{region}.db') for region in region_names(count)}
+    app = main.create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(tmp, 'default.db'), 'SHARDS': shard_uris})
+    with app.app_context():
+        db.create_all() # The default database holds no accounts here, but login still asks it
+        password_hash = main.bcrypt.generate_password_hash(args.password).decode('utf-8')
+        for region in shard_uris:
+            with shards.use_region(region):
+                for i in range(args.doctors):
+                    user = User(email=f'doctor{i}@{region}.bench', password_hash=password_hash, role='doctor')
+                    db.session.add(DoctorProfile(user=user, full_name=f'Dr. {region} {i}', specialty='General',
+                                                 availability_start_time=datetime.time(9, 0),
+                                                 availability_end_time=datetime.time(17, 0), slot_duration_minutes=30))
+                for i in range(args.writers):
+                    user = User(email=f'patient{i}@{region}.bench', password_hash=password_hash, role='patient')
+                    db.session.add(PatientProfile(user=user, full_name=f'Patient {region} {i}'))
+                db.session.commit()
+    return shard_uris
+
+
+def run_worker(args):
+    """Runs inside a child process: books appointments as one patient until the deadline, then prints JSON."""
+    import main
+
+    app = main.create_app({'RATE_LIMIT_ENABLED': False})
+    client = app.test_client()
+    response = client.post('/login', data={'email': args.email, 'password': args.password})
+    if response.status_code != 302 or not response.headers['Location'].endswith('/dashboard'):
+        raise SystemExit(f'{args.email} could not log in.')
+    with app.app_context():
+        import shards
+        shards.set_region(args.region)
+        doctor_ids = main.db.session.scalars(main.db.select(main.DoctorProfile.id)).all()
+
+    rng = random.Random(args.seed)
+    stats = {'booked': 0, 'conflicts': 0, 'busy': 0, 'errors': 0}
+    latencies = []
+    time.sleep(max(0.0, args.start_at - time.time()))
+    deadline = args.start_at + args.seconds
+    while time.time() < deadline:
+        slot = datetime.datetime.combine(
+            datetime.date.today() + datetime.timedelta(days=rng.randint(1, 365)),
+            datetime.time(rng.randint(9, 16), rng.choice((0, 30)))
+        )
+        t0 = time.perf_counter()
+        response = client.post(f'/book_appointment/{rng.choice(doctor_ids)}', data={'appointment_slot': slot.isoformat()})
+        latencies.append(time.perf_counter() - t0)
+        with client.session_transaction() as sess:
+            flashes = sess.pop('_flashes', [])
+        if response.status_code != 302:
+            stats['errors'] += 1
+        elif any(category == 'success' for category, _ in flashes):
+            stats['booked'] += 1
+        elif any('busy' in message for _, message in flashes):
+            stats['busy'] += 1
+        else:
+            stats['conflicts'] += 1
+    stats['latencies'] = latencies
+    print(json.dumps(stats))
+
+
+def run_regions(args, count):
+    with tempfile.TemporaryDirectory() as tmp:
+        shard_uris = seed(args, tmp, count)
+        env = dict(os.environ, SQLITE_PROFILE='production', DATABASE_URL='sqlite:///' + os.path.join(tmp, 'default.db'),
+                   SHARDS=','.join(f'{region}={uri}' for region, uri in shard_uris.items()))
+        start_at = time.time() + args.warmup # Every writer logs in first, then all start together
+        children = []
+        for region in shard_uris:
+            for i in range(args.writers):
+                command = [sys.executable, os.path.abspath(__file__), '--worker', '--region', region,
+                           '--email', f'patient{i}@{region}.bench', '--password', args.password,
+                           '--seconds', str(args.seconds), '--start-at', str(start_at), '--seed', str(args.seed + len(children))]
+                children.append(subprocess.Popen(command, env=env, cwd=basedir, stdout=subprocess.PIPE, text=True))
+        results = []
+        for child in children:
+            output, _ = child.communicate()
+            if child.returncode:
+                raise SystemExit(f'A writer failed (exit {child.returncode}).')
+            results.append(json.loads(output.strip().splitlines()[-1]))
+
+    latencies = [latency for result in results for latency in result['latencies']]
+    totals = {key: sum(result[key] for result in results) for key in ('booked', 'conflicts', 'busy', 'errors')}
+    return {
+        'regions': count,
+        'writers': count * args.writers,
+        'seconds': args.seconds,
+        'bookings_per_s': totals['booked'] / args.seconds,
+        'write_p50_ms': percentile(latencies, 50) * 1000,
+        'write_p95_ms': percentile(latencies, 95) * 1000,
+        **totals,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--regions', type=int, nargs='+', default=[1, 2, 4], help='Region counts to compare.')
+    parser.add_argument('--writers', type=int, default=2, help='Booking processes per region.')
+    parser.add_argument('--doctors', type=int, default=20, help='Doctors seeded per region.')
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--warmup', type=float, default=5, help='Seconds allowed for the writers to start and log in.')
+    parser.add_argument('--password', default='password')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help='Print raw JSON results.')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--region', help=argparse.SUPPRESS)
+    parser.add_argument('--email', help=argparse.SUPPRESS)
+    parser.add_argument('--start-at', type=float, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args)
+        return
+
+    results = [run_regions(args, count) for count in args.regions]
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f'{args.writers} writer process(es) per region for {args.seconds:g}s, {os.cpu_count()} CPU(s)')
+    print(f'{"regions":>8}{"writers":>9}{"bookings/s":>12}{"speedup":>9}{"p50":>10}{"p95":>10}{"busy":>7}{"errors":>8}')
+    baseline = results[0]['bookings_per_s']
+    for r in results:
+        speedup = f'{r["bookings_per_s"] / baseline:.2f}x' if baseline else '-'
+        print(f'{r["regions"]:>8}{r["writers"]:>9}{r["bookings_per_s"]:>12.1f}{speedup:>9}'
+              f'{r["write_p50_ms"]:>8.1f}ms{r["write_p95_ms"]:>8.1f}ms{r["busy"]:>7}{r["errors"]:>8}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+"""Mixed read/write benchmark for the SQLite engine profiles in main.py.
+
+Reader threads load the doctor, insurance and patient dashboards while writer
+threads book appointments, all through the Flask test client. Each profile runs
+in its own process (the engine is configured from the environment) against a
+throwaway copy of the database, so the source database is never modified.
+
+    python bench_sqlite.py --seconds 10 --readers 8 --writers 4
+    python bench_sqlite.py --db big.db --profiles production
+"""
+import argparse
+import datetime
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+basedir = os.path.abspath(os.path.dirname(__file__))
+
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+
+def run_worker(args):
+    """Runs inside the child process; prints one JSON result line."""
+    import main
+
+    app, db = main.create_app({'RATE_LIMIT_ENABLED': False, 'CONCURRENCY_LIMITS': {}}), main.db # Every client shares one IP
+    with app.app_context():
+        def emails(role, limit):
+            return db.session.scalars(
+                db.select(main.User.email).where(main.User.role == role).order_by(main.User.id).limit(limit)
+            ).all()
+        candidates = {role: emails(role, 50) for role in ('doctor', 'insurance', 'patient')}
+        doctor_ids = db.session.scalars(db.select(main.DoctorProfile.id)).all()
+
+    def logged_in_client(role):
+        # Accounts with an unknown password are skipped
+        for email in random.sample(candidates[role], len(candidates[role])):
+            client = app.test_client()
+            response = client.post('/login', data={'email': email, 'password': args.password})
+            if response.status_code == 302 and response.headers['Location'].endswith('/dashboard'):
+                return client
+        raise SystemExit(f'No {role} account accepts password {args.password!r}.')
+
+    read_paths = {'doctor': '/doctor_dashboard', 'insurance': '/insurance_dashboard', 'patient': '/patient_dashboard'}
+    lock = threading.Lock()
+    stats = {'reads': 0, 'read_errors': 0, 'booked': 0, 'conflicts': 0, 'busy': 0, 'write_errors': 0}
+    read_latencies, write_latencies = [], []
+    start_barrier = threading.Barrier(args.readers + args.writers + 1)
+    deadline = [0.0]
+
+    def reader(role):
+        client = logged_in_client(role)
+        local, latencies = {'reads': 0, 'read_errors': 0}, []
+        start_barrier.wait()
+        while time.perf_counter() < deadline[0]:
+            t0 = time.perf_counter()
+            response = client.get(read_paths[role])
+            latencies.append(time.perf_counter() - t0)
+            local['reads' if response.status_code == 200 else 'read_errors'] += 1
+        with lock:
+            for key, value in local.items():
+                stats[key] += value
+            read_latencies.extend(latencies)
+
+    def writer(seed):
+        client = logged_in_client('patient')
+        rng = random.Random(seed)
+        local, latencies = {'booked': 0, 'conflicts': 0, 'busy': 0, 'write_errors': 0}, []
+        start_barrier.wait()
+        while time.perf_counter() < deadline[0]:
+            slot = datetime.datetime.combine(
+                datetime.date.today() + datetime.timedelta(days=rng.randint(1, 365)),
+                datetime.time(rng.randint(9, 16), rng.choice((0, 30)))
+            )
+            t0 = time.perf_counter()
+            response = client.post(f'/book_appointment/{rng.choice(doctor_ids)}', data={'appointment_slot': slot.isoformat()})
+            latencies.append(time.perf_counter() - t0)
+            with client.session_transaction() as sess:
+                flashes = sess.pop('_flashes', [])
+            if response.status_code != 302:
+                local['write_errors'] += 1
+            elif any(category == 'success' for category, _ in flashes):
+                local['booked'] += 1
+            elif any('busy' in message for _, message in flashes):
+                local['busy'] += 1
+            else:
+                local['conflicts'] += 1
+        with lock:
+            for key, value in local.items():
+                stats[key] += value
+            write_latencies.extend(latencies)
+
+    roles = ['doctor', 'insurance', 'patient']
+    threads = [threading.Thread(target=reader, args=(roles[i % len(roles)],)) for i in range(args.readers)]
+    threads += [threading.Thread(target=writer, args=(args.seed + i,)) for i in range(args.writers)]
+    for thread in threads:
+        thread.start()
+    deadline[0] = time.perf_counter() + 3600 # Placeholder until every client has logged in
+    start_barrier.wait()
+    deadline[0] = time.perf_counter() + args.seconds
+    for thread in threads:
+        thread.join()
+
+    stats.update({
+        'profile': app.config['SQLITE_PROFILE'],
+        'seconds': args.seconds,
+        'reads_per_s': stats['reads'] / args.seconds,
+        'writes_per_s': (stats['booked'] + stats['conflicts']) / args.seconds,
+        'read_p50_ms': percentile(read_latencies, 50) * 1000,
+        'read_p95_ms': percentile(read_latencies, 95) * 1000,
+        'write_p95_ms': percentile(write_latencies, 95) * 1000,
+    })
+    print(json.dumps(stats))
+
+
+def run_profile(args, profile):
+    with tempfile.TemporaryDirectory() as tmp:
+        db_copy = os.path.join(tmp, 'bench.db')
+        shutil.copyfile(args.db, db_copy)
+        env = dict(os.environ, SQLITE_PROFILE=profile, DATABASE_URL='sqlite:///' + db_copy)
+        command = [sys.executable, os.path.abspath(__file__), '--worker',
+                   '--seconds', str(args.seconds), '--readers', str(args.readers), '--writers', str(args.writers),
+                   '--password', args.password, '--seed', str(args.seed)]
+        output = subprocess.run(command, env=env, cwd=basedir, check=True, capture_output=True, text=True).stdout
+        return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', default=os.path.join(basedir, 'site.db'), help='Database to copy for each run.')
+    parser.add_argument('--profiles', nargs='+', default=['default', 'production'])
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--writers', type=int, default=4)
+    parser.add_argument('--password', default='password', help='Password shared by the seeded accounts.')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help='Print raw JSON results.')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args)
+        return
+
+    results = [run_profile(args, profile) for profile in args.profiles]
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f'{args.readers} readers / {args.writers} writers for {args.seconds:g}s each')
+    print(f'{"profile":<12}{"reads/s":>10}{"writes/s":>10}{"read p50":>10}{"read p95":>10}{"write p95":>11}{"busy":>7}{"errors":>8}')
+    for r in results:
+        print(f'{r["profile"]:<12}{r["reads_per_s"]:>10.1f}{r["writes_per_s"]:>10.1f}'
+              f'{r["read_p50_ms"]:>8.1f}ms{r["read_p95_ms"]:>8.1f}ms{r["write_p95_ms"]:>9.1f}ms'
+              f'{r["busy"]:>7}{r["read_errors"] + r["write_errors"]:>8}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+"""Worker startup benchmark.
+
+Measures what a fresh gunicorn worker pays before it can serve traffic: the
+time to import main, to build the app with create_app(), and to serve the
+first request. Every run is a new interpreter, so nothing is warm except the
+OS page cache. Also reports which heavy, lazily imported modules got loaded
+along the way, and optionally the slowest imports from `python -X importtime`.
+
+    python bench_startup.py --runs 10
+    python bench_startup.py --path /login --path /register --importtime 15
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import shutil
+
+basedir = os.path.abspath(os.path.dirname(__file__))
+
+# Modules that only specific routes need; none should be loaded by startup alone
+LAZY_MODULES = ['geopy', 'fpdf']
+
+
+def run_worker(args):
+    """Runs inside the child process; prints one JSON result line."""
+    import time
+    started = time.perf_counter()
+    import main
+    imported = time.perf_counter()
+    app = main.create_app()
+    created = time.perf_counter()
+    client = app.test_client()
+    first_status = client.get(args.path[0]).status_code
+    first_request = time.perf_counter()
+    for path in args.path[1:]:
+        client.get(path)
+    print(json.dumps({
+        'import_ms': (imported - started) * 1000,
+        'create_app_ms': (created - imported) * 1000,
+        'first_request_ms': (first_request - created) * 1000,
+        'total_ms': (first_request - started) * 1000,
+        'first_status': first_status,
+        'lazy_loaded': [name for name in LAZY_MODULES if name in sys.modules],
+    }))
+
+
+def run_once(args, env, importtime=False):
+    command = [sys.executable] + (['-X', 'importtime'] if importtime else []) + [os.path.abspath(__file__), '--worker']
+    for path in args.path:
+        command += ['--path', path]
+    proc = subprocess.run(command, env=env, cwd=basedir, check=True, capture_output=True, text=True)
+    return json.loads(proc.stdout.strip().splitlines()[-1]), proc.stderr
+
+
+def slowest_imports(stderr, limit):
+    """Parses `-X importtime` output into [(cumulative us, module)], slowest first.
+
+    Only modules imported directly by a top-level import (e.g. main's own
+    imports) are kept; deeper ones are already counted in their parent.
+    """
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2 # Each nesting level indents by two spaces
+        if depth == 1:
+            imports.append((int(cumulative), name.strip()))
+    return sorted(imports, reverse=True)[:limit]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', default=os.path.join(basedir, 'site.db'), help='Database to copy for the runs.')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--path', action='append', help='Request path(s) to serve after startup (default /login).')
+    parser.add_argument('--importtime', type=int, default=0, metavar='N', help='Also show the N slowest imports.')
+    parser.add_argument('--json', action='store_true', help='Print raw JSON results.')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    args.path = args.path or ['/login']
+
+    if args.worker:
+        run_worker(args)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_copy = os.path.join(tmp, 'bench.db')
+        shutil.copyfile(args.db, db_copy)
+        env = dict(os.environ, DATABASE_URL='sqlite:///' + db_copy)
+        run_once(args, env) # Warm the OS page cache and .pyc files; not counted
+        results = [run_once(args, env)[0] for _ in range(args.runs)]
+        importtime = run_once(args, env, importtime=True)[1] if args.importtime else ''
+
+    summary = {key: {'median': statistics.median(r[key] for r in results),
+                     'min': min(r[key] for r in results), 'max': max(r[key] for r in results)}
+               for key in ('import_ms', 'create_app_ms', 'first_request_ms', 'total_ms')}
+    summary['lazy_loaded'] = sorted({name for r in results for name in r['lazy_loaded']})
+    summary['first_status'] = results[-1]['first_status']
+    if args.json:
+        print(json.dumps(summary, indent=2))
+        return
+
+    print(f'{args.runs} cold starts, first request {" then ".join(args.path)} ({summary["first_status"]})')
+    print(f'{"":<18}{"median":>10}{"min":>10}{"max":>10}')
+    for key, label in (('import_ms', 'import main'), ('create_app_ms', 'create_app()'),
+                       ('first_request_ms', 'first request'), ('total_ms', 'total')):
+        s = summary[key]
+        print(f'{label:<18}{s["median"]:>8.1f}ms{s["min"]:>8.1f}ms{s["max"]:>8.1f}ms')
+    print(f'Lazy modules loaded: {", ".join(summary["lazy_loaded"]) or "none"}')
+    if args.importtime:
+        print('\nSlowest imports:')
+        for cumulative, name in slowest_imports(importtime, args.importtime):
+            print(f'{cumulative / 1000:>8.1f}ms  {name}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""Invoices, insurance claims and payments.
+
+Each billed appointment has one Invoice row. The helpers here are the only code
+that changes invoices. Each one:
+
+- checks the invoice is in a state that allows the change (returning None or
+  False if not, so routes can flash their own message),
+- updates the narrow invoice row and bumps its version, which keys the invoice
+  cache and ETag,
+- adds the claim or payment row the change creates,
+- appends a BillingEvent recording what happened and who did it.
+
+They never commit: the route commits, so the change and its event land together.
+
+An invoice is Unpaid, Pending Insurance or Paid. An appointment without an
+invoice is reported as Unbilled, and one whose invoice has no claim as having
+claim status None, as the old appointment columns did.
+"""
+import datetime
+from models import db, Invoice, InsuranceClaim, Payment, BillingEvent
+
+PAYABLE = ('Unpaid',)
+# The doctor may record a payment taken at the clinic while a claim is still pending
+PAYABLE_AT_CLINIC = ('Unpaid', 'Pending Insurance')
+
+
+def get_invoice(appointment_id):
+    return db.session.scalar(db.select(Invoice).where(Invoice.appointment_id == appointment_id))
+
+
+def record_event(invoice, kind, actor_user_id=None, amount=None, claim=None, payment=None):
+    db.session.add(BillingEvent(
+        invoice_id=invoice.id, kind=kind, amount=amount, claim_id=claim.id if claim else None,
+        payment_id=payment.id if payment else None, actor_user_id=actor_user_id, status_after=invoice.status
+    ))
+
+
+def issue_invoice(apt, amount, description, actor_user_id=None):
+    """Bills an appointment, or re-bills it with a new amount (the invoice goes back to Unpaid)."""
+    invoice = get_invoice(apt.id)
+    kind = 'reissued' if invoice else 'issued'
+    if invoice is None:
+        invoice = Invoice(appointment_id=apt.id, patient_id=apt.patient_id, doctor_id=apt.doctor_id,
+                          appointment_time=apt.appointment_time, version=0)
+        db.session.add(invoice)
+    invoice.amount, invoice.description, invoice.status = amount, description, 'Unpaid'
+    invoice.version = (invoice.version or 0) + 1
+    db.session.flush()
+    record_event(invoice, kind, actor_user_id, amount=amount)
+    return invoice
+
+
+def record_payment(invoice, method, actor_user_id=None, allowed=PAYABLE, claim=None, kind='paid'):
+    """Marks the invoice paid. Returns the Payment, or None if the invoice is not in an `allowed` status."""
+    if invoice is None or invoice.status not in allowed:
+        return None
+    payment = Payment(invoice_id=invoice.id, amount=invoice.amount, method=method, claim_id=claim.id if claim else None)
+    db.session.add(payment)
+    invoice.status = 'Paid'
+    invoice.version += 1
+    db.session.flush()
+    record_event(invoice, kind, actor_user_id, amount=payment.amount, claim=claim, payment=payment)
+    return payment
+
+
+def submit_claim(invoice, insurer_id, policy_id, actor_user_id=None):
+    """Claims an unpaid invoice from an insurer. Returns the claim, or None if the invoice is not unpaid."""
+    if invoice is None or invoice.status not in PAYABLE:
+        return None
+    claim = InsuranceClaim(invoice_id=invoice.id, insurer_id=insurer_id, policy_id=policy_id, amount=invoice.amount,
+                           status='Pending')
+    db.session.add(claim)
+    db.session.flush()
+    invoice.claim_id = claim.id
+    invoice.status = 'Pending Insurance'
+    invoice.version += 1
+    record_event(invoice, 'claim_submitted', actor_user_id, amount=claim.amount, claim=claim)
+    return claim
+
+
+def decide_claim(invoice, accept, actor_user_id=None):
+    """Accepts (the invoice is paid by the insurer) or rejects (it is unpaid again) the pending claim.
+
+    Returns False if the invoice has no pending claim.
+    """
+    claim = db.session.get(InsuranceClaim, invoice.claim_id) if invoice and invoice.claim_id else None
+    if claim is None or claim.status != 'Pending':
+        return False
+    claim.status = 'Accepted' if accept else 'Rejected'
+    claim.decided_at = datetime.datetime.now()
+    if accept:
+        record_payment(invoice, 'insurance', actor_user_id, allowed=('Pending Insurance',), claim=claim,
+                       kind='claim_accepted')
+        return True
+    invoice.status = 'Unpaid' # The patient must pay it themselves or claim again
+    invoice.version += 1
+    record_event(invoice, 'claim_rejected', actor_user_id, amount=claim.amount, claim=claim)
+    return True
@@ -0,0 +1,97 @@
+"""In-process change feed for the dashboards' Server-Sent Events stream.
+
+Routes publish a small event after committing a state change. Each open
+dashboard holds a Subscription on its own channel, e.g. ('doctor', 12), and is
+pushed only the events for that channel.
+
+Events live in this process only. A browser connected to another worker
+misses them until it reconnects, so run the app with one process and several
+threads (gunicorn -k gthread --threads 16), or accept that other workers'
+dashboards fall back to a reload. A bounded history lets a reconnecting client
+resume from Last-Event-ID. When that is not possible, for example after a
+restart or with a different worker, the client is told to reset, i.e. reload
+once.
+"""
+import queue
+import threading
+import uuid
+from collections import deque
+
+
+class Subscription:
+    def __init__(self, feed, channel, queue_size):
+        self.feed, self.channel = feed, channel
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.needs_reset = False # Set when events were lost; the client must reload
+
+    def push(self, event_id, event):
+        try:
+            self.queue.put_nowait((event_id, event))
+        except queue.Full: # A stalled client; don't let it hold up publishers
+            self.needs_reset = True
+
+    def get(self, timeout):
+        """Next (event_id, event), or None after `timeout` seconds without one."""
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.feed._unsubscribe(self)
+
+
+class ChangeFeed:
+    def __init__(self, history_size=1000, queue_size=256):
+        self.boot_id = uuid.uuid4().hex[:8] # Distinguishes this process's event ids from another's
+        self.queue_size = queue_size
+        self._seq = 0
+        self._history = deque(maxlen=history_size) # (seq, channels, event)
+        self._subscribers = {} # channel -> set of Subscription
+        self._lock = threading.Lock()
+
+    def publish(self, channels, event):
+        with self._lock:
+            self._seq += 1
+            event_id = f'{self.boot_id}-{self._seq}'
+            self._history.append((self._seq, frozenset(channels), event))
+            targets = [sub for channel in channels for sub in self._subscribers.get(channel, ())]
+        for sub in targets:
+            sub.push(event_id, event)
+
+    def subscribe(self, channel, last_event_id=None):
+        """Registers a subscriber; replays missed events when last_event_id is still in the history."""
+        sub = Subscription(self, channel, self.queue_size)
+        with self._lock:
+            self._subscribers.setdefault(channel, set()).add(sub)
+            if last_event_id:
+                boot_id, _, seq = last_event_id.partition('-')
+                oldest = self._history[0][0] if self._history else self._seq + 1
+                if boot_id != self.boot_id or not seq.isdigit() or int(seq) + 1 < oldest:
+                    sub.needs_reset = True
+                else:
+                    for event_seq, channels, event in self._history:
+                        if event_seq > int(seq) and channel in channels:
+                            sub.push(f'{self.boot_id}-{event_seq}', event)
+        return sub
+
+    def _unsubscribe(self, sub):
+        with self._lock:
+            subs = self._subscribers.get(sub.channel)
+            if subs is not None:
+                subs.discard(sub)
+                if not subs:
+                    del self._subscribers[sub.channel]
+
+
+def format_sse(data, event=None, event_id=None):
+    lines = []
+    if event_id:
+        lines.append(f'id: {event_id}')
+    if event:
+        lines.append(f'event: {event}')
+    lines.extend(f'data: {line}' for line in data.split('\n'))
+    return '\n'.join(lines) + '\n\n'
+
+
+feed = ChangeFeed()
@@ -0,0 +1,366 @@
+"""Deterministic, scalable synthetic data generator for benchmarking.
+
+Unlike init_db.py (a handful of hand-made accounts, one commit and one bcrypt
+hash per user), this writes straight to the tables with executemany in large
+batches, one transaction per table, and reuses a single precomputed password
+hash. The same --seed, --anchor and sizes always produce the same data.
+
+    python generate_data.py --db bench.db --scale medium
+    python generate_data.py --db big.db --scale production       # 50k doctors, 2M patients, 20M appointments
+    python generate_data.py --db custom.db --doctors 500 --patients 20000 --appointments 300000
+
+Every account's password is 'password' (or --password). A few fixed accounts
+are always created: patient@test.com, doctor@test.com, insurer@test.com.
+"""
+import argparse
+import datetime
+import os
+import random
+import sys
+import time
+
+SCALES = {
+    'small':      dict(insurers=5,   doctors=200,    patients=5_000,     appointments=50_000,     reviews=10_000,    records=20_000,     files=5_000),
+    'medium':     dict(insurers=20,  doctors=5_000,  patients=200_000,   appointments=2_000_000,  reviews=500_000,   records=1_000_000,  files=200_000),
+    'production': dict(insurers=50,  doctors=50_000, patients=2_000_000, appointments=20_000_000, reviews=5_000_000, records=10_000_000, files=2_000_000),
+}
+
+SPECIALTIES = [
+    'Cardiologist', 'Dermatologist', 'Neurologist', 'Pediatrician',
+    'Oncologist', 'Orthopedist', 'General', 'Surgeon', 'Psychiatrist'
+]
+FIRST_NAMES = [
+    'Aarav', 'Aditi', 'Ananya', 'Arjun', 'Diya', 'Ishaan', 'Kavya', 'Krishna', 'Meera', 'Neha',
+    'Priya', 'Rahul', 'Rohan', 'Saanvi', 'Sai', 'Sneha', 'Tanvi', 'Vihaan', 'Vikram', 'Zara',
+    'James', 'Maria', 'David', 'Sarah', 'Daniel', 'Laura', 'Michael', 'Emma', 'John', 'Olivia',
+]
+LAST_NAMES = [
+    'Sharma', 'Verma', 'Iyer', 'Reddy', 'Nair', 'Gupta', 'Patel', 'Rao', 'Kumar', 'Singh',
+    'Das', 'Joshi', 'Menon', 'Pillai', 'Bose', 'Smith', 'Johnson', 'Brown', 'Garcia', 'Miller',
+]
+DIAGNOSES = ['Hypertension', 'Type 2 diabetes', 'Migraine', 'Seasonal allergy', 'Lower back pain',
+             'Eczema', 'Anxiety', 'Asthma', 'Viral fever', 'Routine checkup - healthy']
+BILL_DESCRIPTIONS = ['Consultation', 'Follow-up', 'Annual Checkup', 'Specialist Consultation', 'Lab work review']
+
+# Rough (lat, lon) centres for the first digit of an Indian pincode (the postal region)
+PINCODE_REGIONS = {
+    1: (28.6, 77.2), 2: (26.8, 80.9), 3: (23.0, 72.6), 4: (19.1, 72.9),
+    5: (17.4, 78.5), 6: (13.1, 80.3), 7: (22.6, 88.4), 8: (25.6, 85.1),
+}
+
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f' # What SQLAlchemy's SQLite DateTime type stores
+TIME_FORMAT = '%H:%M:%S.%f'
+SLOTS_PER_DAY = 16 # 09:00-17:00 in 30 minute slots
+
+
+def name(rng):
+    return f'{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}'
+
+
+def location(rng):
+    region = rng.randint(1, 8)
+    lat, lon = PINCODE_REGIONS[region]
+    pincode = f'{region}{rng.randint(0, 99999):05d}'
+    return pincode, round(lat + rng.uniform(-2, 2), 5), round(lon + rng.uniform(-2, 2), 5)
+
+
+def bulk_insert(conn, table, columns, rows, batch_size):
+    """executemany in fixed-size batches; `rows` is any iterable of tuples."""
+    sql = f'INSERT INTO "{table}" ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))})'
+    count = 0
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            conn.exec_driver_sql(sql, batch)
+            count += len(batch)
+            batch = []
+    if batch:
+        conn.exec_driver_sql(sql, batch)
+        count += len(batch)
+    return count
+
+
+class Generator:
+    def __init__(self, sizes, seed, password_hash, now):
+        self.sizes = sizes
+        self.seed = seed
+        self.password_hash = password_hash
+        self.now = now.replace(minute=0, second=0, microsecond=0)
+        # Appointments are spread evenly per doctor; ~80% of each doctor's slots lie in the past
+        self.slots_per_doctor = -(-sizes['appointments'] // sizes['doctors'])
+        self.first_day = (self.now - datetime.timedelta(days=int(self.slots_per_doctor * 0.8) // SLOTS_PER_DAY + 1)).date()
+
+    def rng(self, table):
+        # An independent stream per table keeps every table reproducible on its own
+        return random.Random(f'{self.seed}:{table}')
+
+    # Ids are assigned explicitly: users 1..I are insurers, then doctors, then patients
+    def insurer_user_id(self, i): return i
+    def doctor_user_id(self, i): return self.sizes['insurers'] + i
+    def patient_user_id(self, i): return self.sizes['insurers'] + self.sizes['doctors'] + i
+
+    def users(self):
+        fixed = {'insurance': 'insurer@test.com', 'doctor': 'doctor@test.com', 'patient': 'patient@test.com'}
+        for role, count, first_id in (('insurance', self.sizes['insurers'], self.insurer_user_id(1)),
+                                      ('doctor', self.sizes['doctors'], self.doctor_user_id(1)),
+                                      ('patient', self.sizes['patients'], self.patient_user_id(1))):
+            yield (first_id, fixed[role], self.password_hash, role)
+            for n in range(1, count):
+                yield (first_id + n, f'{role}{n}@example.com', self.password_hash, role)
+
+    def insurance_profiles(self):
+        rng = self.rng('insurance_profile')
+        for i in range(1, self.sizes['insurers'] + 1):
+            pincode, _, _ = location(rng)
+            yield (i, f'{rng.choice(LAST_NAMES)} Health Insurance {i}', f'+91{rng.randint(7000000000, 9999999999)}',
+                   f'{rng.randint(1, 999)} Main Road', pincode, self.insurer_user_id(i))
+
+    def doctor_profiles(self):
+        rng = self.rng('doctor_profile')
+        start, end = datetime.time(9, 0).strftime(TIME_FORMAT), datetime.time(17, 0).strftime(TIME_FORMAT)
+        for i in range(1, self.sizes['doctors'] + 1):
+            pincode, lat, lon = location(rng)
+            yield (i, f'Dr. {name(rng)}', f'+91{rng.randint(7000000000, 9999999999)}', rng.choice(SPECIALTIES),
+                   f'{rng.randint(1, 999)} Clinic Street', pincode, lat, lon, start, end, 30, self.doctor_user_id(i))
+
+    def patient_profiles(self):
+        rng = self.rng('patient_profile')
+        for i in range(1, self.sizes['patients'] + 1):
+            pincode, lat, lon = location(rng)
+            insured = rng.random() < 0.6
+            yield (i, name(rng), f'+91{rng.randint(7000000000, 9999999999)}', f'{rng.randint(1, 999)} Residency Road',
+                   pincode, lat, lon,
+                   f'POL{i:08d}' if insured else None,
+                   rng.randint(1, self.sizes['insurers']) if insured else None,
+                   self.patient_user_id(i))
+
+    def appointment_time(self, k):
+        """Slot k of a doctor's calendar; unique per doctor, so (doctor_id, appointment_time) never collides."""
+        day = self.first_day + datetime.timedelta(days=k // SLOTS_PER_DAY)
+        minutes = 9 * 60 + (k % SLOTS_PER_DAY) * 30
+        return datetime.datetime.combine(day, datetime.time(minutes // 60, minutes % 60))
+
+    def appointment_plan(self):
+        """Yields (appointment row, bill) per appointment; bill is None or (amount, description, outcome, insurer id).
+
+        outcome is 'Paid' or 'Unpaid' for bills settled by the patient, else the claim status.
+        Each billing table replays this same seeded stream, so they all agree.
+        """
+        rng = self.rng('appointment')
+        doctors, patients = self.sizes['doctors'], self.sizes['patients']
+        for i in range(self.sizes['appointments']):
+            doctor_id = i % doctors + 1
+            when = self.appointment_time(i // doctors)
+            patient_id = rng.randint(1, patients)
+            bill = None
+            if when > self.now:
+                status = 'Pending' if rng.random() < 0.4 else 'Confirmed'
+            elif rng.random() < 0.1:
+                status = 'Cancelled'
+            else:
+                status = 'Completed'
+                roll = rng.random()
+                if roll < 0.9:
+                    amount = float(rng.randint(5, 200) * 10)
+                    description = rng.choice(BILL_DESCRIPTIONS)
+                    if roll < 0.55:
+                        bill = (amount, description, 'Paid', None)
+                    elif roll < 0.7:
+                        bill = (amount, description, 'Unpaid', None)
+                    else:
+                        insurer_id = rng.randint(1, self.sizes['insurers'])
+                        bill = (amount, description, rng.choice(('Pending', 'Accepted', 'Rejected')), insurer_id)
+            yield (i + 1, when, status, patient_id, doctor_id), bill
+
+    def appointments(self):
+        for (appointment_id, when, status, patient_id, doctor_id), _ in self.appointment_plan():
+            yield (appointment_id, when.strftime(DATETIME_FORMAT), status, patient_id, doctor_id)
+
+    def bills(self):
+        """Per billed appointment: (invoice row, claim row or None, payment row or None, [event rows]).
+
+        Invoices, claims and payments are numbered in appointment order; events follow the
+        billing.py transitions (issued, then claimed and decided, or paid).
+        """
+        claim_id = payment_id = event_id = 0
+        stamp = lambda t: t.strftime(DATETIME_FORMAT)
+        for invoice_id, ((appointment_id, when, _, patient_id, doctor_id), (amount, description, outcome, insurer_id)) \
+                in enumerate(((row, bill) for row, bill in self.appointment_plan() if bill), start=1):
+            issued_at = when + datetime.timedelta(hours=1)
+            decided_at = min(when + datetime.timedelta(days=3), self.now)
+            events, claim, payment = [('issued', None, None, 'Unpaid', issued_at)], None, None
+            if insurer_id:
+                claim_id += 1
+                submitted_at = min(when + datetime.timedelta(days=1), self.now)
+                claim = (claim_id, invoice_id, insurer_id, None, amount, outcome, stamp(submitted_at),
+                         None if outcome == 'Pending' else stamp(decided_at))
+                events.append(('claim_submitted', claim_id, None, 'Pending Insurance', submitted_at))
+                if outcome == 'Rejected':
+                    events.append(('claim_rejected', claim_id, None, 'Unpaid', decided_at))
+            if outcome in ('Paid', 'Accepted'):
+                payment_id += 1
+                payment = (payment_id, invoice_id, amount, 'insurance' if claim else 'upi', claim_id if claim else None,
+                           stamp(decided_at))
+                events.append(('claim_accepted' if claim else 'paid', claim[0] if claim else None, payment_id, 'Paid', decided_at))
+            status = events[-1][3]
+            invoice = (invoice_id, appointment_id, patient_id, doctor_id, stamp(when), amount, description, status,
+                       claim[0] if claim else None, len(events), stamp(issued_at), stamp(events[-1][4]))
+            rows = []
+            for kind, event_claim_id, event_payment_id, status_after, at in events:
+                event_id += 1
+                rows.append((event_id, invoice_id, kind, amount, event_claim_id, event_payment_id, None, status_after, stamp(at)))
+            yield invoice, claim, payment, rows
+
+    def invoices(self):
+        return (invoice for invoice, _, _, _ in self.bills())
+
+    def insurance_claims(self):
+        return (claim for _, claim, _, _ in self.bills() if claim)
+
+    def payments(self):
+        return (payment for _, _, payment, _ in self.bills() if payment)
+
+    def billing_events(self):
+        return (event for _, _, _, events in self.bills() for event in events)
+
+    def past_timestamp(self, rng):
+        return (self.now - datetime.timedelta(minutes=rng.randint(0, 5 * 365 * 24 * 60))).strftime(DATETIME_FORMAT)
+
+    def reviews(self):
+        rng = self.rng('doctor_review')
+        doctors, patients = self.sizes['doctors'], self.sizes['patients']
+        for i in range(self.sizes['reviews']):
+            # Round r pairs patient p with a different doctor each time, so (patient, doctor) stays unique
+            patient_id, round_ = i % patients + 1, i // patients
+            doctor_id = (patient_id * 7919 + round_) % doctors + 1
+            overall = rng.randint(1, 10)
+            ratings = [max(1, min(10, overall + rng.randint(-2, 2))) for _ in range(3)]
+            yield (i + 1, *ratings, overall, f'Visit rated {overall}/10.', self.past_timestamp(rng), patient_id, doctor_id)
+
+    def records(self):
+        rng = self.rng('medical_record')
+        for i in range(self.sizes['records']):
+            yield (i + 1, rng.choice(DIAGNOSES), 'Follow up in 4 weeks.', 'As discussed', self.past_timestamp(rng),
+                   rng.randint(1, self.sizes['patients']), rng.randint(1, self.sizes['doctors']))
+
+    def files(self):
+        rng = self.rng('medical_file')
+        for i in range(self.sizes['files']):
+            yield (i + 1, f'synthetic-{self.seed}-{i + 1:010d}.pdf', f'report_{i + 1}.pdf', 'Lab report', self.past_timestamp(rng),
+                   rng.randint(1, self.sizes['patients']), rng.randint(1, self.sizes['doctors']))
+
+    def tables(self):
+        s = self.sizes
+        return [
+            ('user', ('id', 'email', 'password_hash', 'role'), self.users, s['insurers'] + s['doctors'] + s['patients']),
+            ('insurance_profile', ('id', 'company_name', 'phone', 'company_address', 'pincode', 'user_id'),
+             self.insurance_profiles, s['insurers']),
+            ('doctor_profile', ('id', 'full_name', 'phone', 'specialty', 'practice_address', 'pincode', 'latitude', 'longitude',
+                                'availability_start_time', 'availability_end_time', 'slot_duration_minutes', 'user_id'),
+             self.doctor_profiles, s['doctors']),
+            ('patient_profile', ('id', 'full_name', 'phone', 'address', 'pincode', 'latitude', 'longitude',
+                                 'insurance_policy_id', 'insurance_company_id', 'user_id'),
+             self.patient_profiles, s['patients']),
+            ('appointment', ('id', 'appointment_time', 'status', 'patient_id', 'doctor_id'),
+             self.appointments, s['appointments']),
+            ('invoice', ('id', 'appointment_id', 'patient_id', 'doctor_id', 'appointment_time', 'amount', 'description',
+                         'status', 'claim_id', 'version', 'issued_at', 'updated_at'),
+             self.invoices, None),
+            ('insurance_claim', ('id', 'invoice_id', 'insurer_id', 'policy_id', 'amount', 'status', 'submitted_at',
+                                 'decided_at'),
+             self.insurance_claims, None),
+            ('payment', ('id', 'invoice_id', 'amount', 'method', 'claim_id', 'paid_at'), self.payments, None),
+            ('billing_event', ('id', 'invoice_id', 'kind', 'amount', 'claim_id', 'payment_id', 'actor_user_id',
+                               'status_after', 'created_at'),
+             self.billing_events, None),
+            ('doctor_review', ('id', 'cost_rating', 'hospitality_rating', 'med_rec_rating', 'overall_rating', 'comment',
+                               'created_at', 'patient_id', 'doctor_id'),
+             self.reviews, s['reviews']),
+            ('medical_record', ('id', 'diagnosis', 'notes', 'prescription', 'created_at', 'patient_id', 'doctor_id'),
+             self.records, s['records']),
+            ('medical_file', ('id', 'filename', 'original_filename', 'description', 'created_at', 'patient_id', 'doctor_id'),
+             self.files, s['files']),
+        ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', required=True, help='SQLite file to create. Must not exist unless --force.')
+    parser.add_argument('--force', action='store_true', help='Overwrite an existing file.')
+    parser.add_argument('--scale', choices=sorted(SCALES), default='small')
+    for key in SCALES['small']:
+        parser.add_argument(f'--{key}', type=int, help=f'Override the number of {key}.')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--anchor', type=datetime.date.fromisoformat, default=datetime.date.today(),
+                        help="'Today' for the generated calendar (YYYY-MM-DD). Fix it to reproduce a database exactly.")
+    parser.add_argument('--batch-size', type=int, default=50_000)
+    parser.add_argument('--password', default='password')
+    args = parser.parse_args()
+
+    sizes = dict(SCALES[args.scale])
+    for key in sizes:
+        if getattr(args, key) is not None:
+            sizes[key] = getattr(args, key)
+    if min(sizes['insurers'], sizes['doctors'], sizes['patients']) < 1:
+        parser.error('Need at least one insurer, doctor and patient.')
+    if sizes['reviews'] > sizes['patients'] * sizes['doctors']:
+        parser.error('More reviews than (patient, doctor) pairs.')
+
+    db_path = os.path.abspath(args.db)
+    if os.path.exists(db_path):
+        if not args.force:
+            parser.error(f'{db_path} already exists (use --force to overwrite).')
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(db_path + suffix):
+                os.remove(db_path + suffix)
+
+    import main as app_module
+    import migrations
+    app = app_module.create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + db_path, 'AUTO_MIGRATE': False})
+    db, bcrypt = app_module.db, app_module.bcrypt
+
+    started = time.perf_counter()
+    with app.app_context():
+        db.create_all()
+        password_hash = bcrypt.generate_password_hash(args.password).decode('utf-8') # Hashed once, shared by all
+        generator = Generator(sizes, args.seed, password_hash, datetime.datetime.combine(args.anchor, datetime.time(12, 0)))
+        tables = generator.tables()
+
+        with db.engine.connect() as conn:
+            conn.exec_driver_sql('PRAGMA synchronous=OFF')
+            conn.commit()
+            # Loads are far faster into unindexed tables: every non-unique secondary index on a loaded
+            # table is dropped and rebuilt once at the end. Unique ones (and the automatic indexes behind
+            # UNIQUE constraints, whose sql is NULL) stay, so duplicates still fail the load.
+            loaded = [table for table, _, _, _ in tables]
+            with conn.begin():
+                secondary_indexes = conn.exec_driver_sql(
+                    "SELECT name, sql FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL "
+                    f"AND sql NOT LIKE 'CREATE UNIQUE%' AND tbl_name IN ({', '.join('?' * len(loaded))})",
+                    tuple(loaded),
+                ).all()
+                for name, _ in secondary_indexes:
+                    conn.exec_driver_sql(f'DROP INDEX {name}')
+            for table, columns, rows, expected in tables:
+                t0 = time.perf_counter()
+                with conn.begin():
+                    count = bulk_insert(conn, table, columns, rows(), args.batch_size)
+                elapsed = time.perf_counter() - t0
+                print(f'{table:<20}{count:>12,} rows {elapsed:>8.1f}s ({count / max(elapsed, 1e-9):,.0f} rows/s)', flush=True)
+
+            t0 = time.perf_counter()
+            with conn.begin():
+                for _, sql in secondary_indexes:
+                    conn.exec_driver_sql(sql)
+            conn.exec_driver_sql('ANALYZE')
+            conn.commit()
+            print(f'{"indexes + ANALYZE":<20}{"":>17}{time.perf_counter() - t0:>8.1f}s')
+        migrations.upgrade(db.engine) # Records every migration as applied (they are all no-ops here)
+
+    print(f'Done in {time.perf_counter() - started:.1f}s: {db_path} (seed {args.seed}).')
+    print(f"Log in as patient@test.com, doctor@test.com or insurer@test.com with password '{args.password}'.")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,129 @@
+"""Streaming export of a patient's complete medical history.
+
+Records and file metadata are read with column-only selects over the hot and
+archive tables together, `yield_per` rows at a time, and written out as they
+arrive. Memory use stays flat however long the history is, and the first
+bytes go out before the last rows are read.
+
+Formats:
+- ndjson: one JSON object per line, records then files, each with a "type".
+- csv: the same rows under one header.
+- zip: records.ndjson, files.ndjson and every uploaded file under files/.
+"""
+import csv
+import io
+import itertools
+import json
+import os
+from sqlalchemy import literal
+from models import db, DoctorProfile, MedicalRecord, ArchivedMedicalRecord, MedicalFile, ArchivedMedicalFile
+from invoices import stream_zip
+
+BATCH_SIZE = 500 # Rows fetched per round trip
+CHUNK_SIZE = 64 * 1024 # Output is sent in pieces of about this size
+
+# format -> (mimetype, file extension)
+EXPORT_FORMATS = {
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+    'csv': ('text/csv', 'csv'),
+    'zip': ('application/zip', 'zip'),
+}
+
+CSV_FIELDS = ['type', 'id', 'created_at', 'doctor_name', 'doctor_specialty', 'archived',
+              'diagnosis', 'notes', 'prescription',
+              'original_filename', 'description', 'size_bytes', 'sha256', 'path', 'missing']
+
+
+def _history_query(hot, archived, patient_id, columns):
+    """Oldest-first union of the same columns from a hot table and its archive twin."""
+    selects = [
+        db.select(*(getattr(model, name) for name in columns), DoctorProfile.full_name.label('doctor_name'),
+                  DoctorProfile.specialty.label('doctor_specialty'), literal(is_archived).label('archived'))
+        .join(DoctorProfile, model.doctor_id == DoctorProfile.id)
+        .where(model.patient_id == patient_id)
+        for model, is_archived in ((hot, False), (archived, True))
+    ]
+    combined = db.union_all(*selects).subquery()
+    return (
+        db.select(combined)
+        .order_by(combined.c.created_at, combined.c.id)
+        .execution_options(yield_per=BATCH_SIZE)
+    )
+
+
+def iter_records(patient_id):
+    query = _history_query(MedicalRecord, ArchivedMedicalRecord, patient_id,
+                           ['id', 'created_at', 'diagnosis', 'notes', 'prescription'])
+    for row in db.session.execute(query):
+        item = dict(row._mapping)
+        item['type'] = 'record'
+        item['created_at'] = row.created_at.isoformat()
+        item['archived'] = bool(row.archived)
+        yield item
+
+
+def iter_files(patient_id, upload_folder):
+    query = _history_query(MedicalFile, ArchivedMedicalFile, patient_id,
+                           ['id', 'created_at', 'filename', 'original_filename', 'description', 'size_bytes', 'sha256'])
+    for row in db.session.execute(query):
+        item = dict(row._mapping)
+        filename = item.pop('filename')
+        item['type'] = 'file'
+        item['created_at'] = row.created_at.isoformat()
+        item['archived'] = bool(row.archived)
+        item['path'] = f'files/{row.id}-{row.original_filename}'
+        item['missing'] = not os.path.isfile(os.path.join(upload_folder, filename))
+        item['_source'] = os.path.join(upload_folder, filename)
+        yield item
+
+
+def _public(item):
+    return {key: value for key, value in item.items() if not key.startswith('_')}
+
+
+def _ndjson(items):
+    buffer = io.StringIO()
+    for item in items:
+        buffer.write(json.dumps(_public(item)))
+        buffer.write('\n')
+        if buffer.tell() >= CHUNK_SIZE:
+            yield _drain(buffer)
+    yield _drain(buffer)
+
+
+def _csv(items):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=CSV_FIELDS, extrasaction='ignore')
+    writer.writeheader()
+    for item in items:
+        writer.writerow(item)
+        if buffer.tell() >= CHUNK_SIZE:
+            yield _drain(buffer)
+    yield _drain(buffer)
+
+
+def _drain(buffer):
+    """Empties a StringIO, returning its contents as UTF-8."""
+    data = buffer.getvalue().encode('utf-8')
+    buffer.seek(0)
+    buffer.truncate()
+    return data
+
+
+def _zip_entries(patient_id, upload_folder):
+    yield 'records.ndjson', _ndjson(iter_records(patient_id))
+    yield 'files.ndjson', _ndjson(iter_files(patient_id, upload_folder))
+    for item in iter_files(patient_id, upload_folder): # Second pass: the blobs themselves
+        if not item['missing']:
+            try:
+                yield item['path'], open(item['_source'], 'rb')
+            except FileNotFoundError: # Removed since the manifest was written
+                continue
+
+
+def generate_history_export(patient_id, upload_folder, export_format):
+    """Yields the export as byte chunks."""
+    if export_format == 'zip':
+        return stream_zip(_zip_entries(patient_id, upload_folder))
+    items = itertools.chain(iter_records(patient_id), iter_files(patient_id, upload_folder))
+    return _csv(items) if export_format == 'csv' else _ndjson(items)
@@ -1,5 +1,8 @@
 import os
-from main import app, db, bcrypt, User, PatientProfile, DoctorProfile, InsuranceProfile, DoctorReview, Appointment, MedicalRecord, MedicalFile
+from flask import Flask
+from flask_bcrypt import Bcrypt
+from models import db, User, PatientProfile, DoctorProfile, InsuranceProfile, DoctorReview, Appointment, MedicalRecord, MedicalFile
+import billing
 from faker import Faker
 import random
 import datetime
@@ -201,24 +204,22 @@ def create_fake_data():
         appointment_time = datetime.datetime.now() - datetime.timedelta(days=2),
         status = 'Completed',
         patient_id = profile_p.id,
-        doctor_id = profile_d.id,
-        bill_amount = 150.00,
-        bill_status = 'Unpaid', # Start as Unpaid
-        bill_description = 'Annual Checkup'
+        doctor_id = profile_d.id
     )
     db.session.add(completed_apt)
+    db.session.flush()
+    billing.issue_invoice(completed_apt, 150.00, 'Annual Checkup') # Starts as Unpaid
 
     # --- NEW: Add another completed appointment for patient@test.com ---
     completed_apt_2 = Appointment(
         appointment_time = datetime.datetime.now() - datetime.timedelta(days=5),
         status = 'Completed',
         patient_id = profile_p.id,
-        doctor_id = doctors[0].id, # Different doctor
-        bill_amount = 300.00,
-        bill_status = 'Unpaid', # Start as Unpaid
-        bill_description = 'Specialist Consultation'
+        doctor_id = doctors[0].id # Different doctor
     )
     db.session.add(completed_apt_2)
+    db.session.flush()
+    billing.issue_invoice(completed_apt_2, 300.00, 'Specialist Consultation') # Starts as Unpaid
     
     db.session.commit()
     print("Added test patient (patient@test.com) and test doctor (doctor@test.com). Password for both is 'password'.")
@@ -228,6 +229,12 @@ def create_fake_data():
 if __name__ == "__main__":
     basedir = os.path.abspath(os.path.dirname(__file__))
     db_path = os.path.join(basedir, 'site.db')
+
+    # A bare app is enough to reach the database; the web app (main.create_app) isn't needed
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + db_path
+    db.init_app(app)
+    bcrypt = Bcrypt(app)
     
     if os.path.exists(db_path):
         response = input("Database 'site.db' already exists. \nDo you want to DELETE it and create a new one with fake data? (yes/no): ")
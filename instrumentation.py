@@ -0,0 +1,199 @@
+"""Per-request SQL instrumentation and Prometheus metrics.
+
+init_instrumentation(app, db) hooks SQLAlchemy's before/after_cursor_execute
+events and Flask's request cycle to record, for every request:
+
+- the number of SQL statements and total time spent in SQL,
+- repeated statement shapes, logged as suspected N+1 patterns,
+- statements slower than SLOW_QUERY_MS, written to a separate slow-query log.
+
+Per-endpoint latency histograms and query counters are served from /metrics
+in the Prometheus text format, to a scraper sending "Authorization: Bearer
+<METRICS_TOKEN>" or to a signed-in admin (ADMIN_EMAILS). Anyone else gets a
+404. Metrics are per process; with several gunicorn workers, scrape each
+worker or aggregate them in Prometheus.
+"""
+import hmac
+import logging
+import os
+import re
+import threading
+import time
+from collections import Counter
+from logging.handlers import RotatingFileHandler
+from flask import g, request, has_request_context, abort
+from flask_login import current_user
+from sqlalchemy import event
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+_IN_LIST_RE = re.compile(r'\((?:\s*\?\s*,)+\s*\?\s*\)')
+_WHITESPACE_RE = re.compile(r'\s+')
+
+logger = logging.getLogger('loop.sql')
+slow_query_logger = logging.getLogger('loop.sql.slow')
+
+
+def statement_shape(statement):
+    """Collapses whitespace and expanded IN (?, ?, ...) lists so equivalent statements compare equal."""
+    return _IN_LIST_RE.sub('(?...)', _WHITESPACE_RE.sub(' ', statement).strip())
+
+
+# --- Minimal Prometheus metric types ---
+
+class CounterMetric:
+    def __init__(self, name, documentation, labelnames):
+        self.name, self.documentation, self.labelnames = name, documentation, labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels, amount=1.0):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_format_labels(self.labelnames, labels)} {value:g}')
+        return lines
+
+
+class HistogramMetric:
+    def __init__(self, name, documentation, labelnames, buckets):
+        self.name, self.documentation, self.labelnames, self.buckets = name, documentation, labelnames, buckets
+        self._values = {} # labels -> [bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        with self._lock:
+            series = self._values.get(labels)
+            if series is None:
+                series = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[len(self.buckets)] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for labels, series in sorted(self._values.items()):
+                for bound, count in zip(self.buckets, series):
+                    lines.append(f'{self.name}_bucket{_format_labels(self.labelnames + ("le",), labels + (f"{bound:g}",))} {count}')
+                lines.append(f'{self.name}_bucket{_format_labels(self.labelnames + ("le",), labels + ("+Inf",))} {series[len(self.buckets)]}')
+                lines.append(f'{self.name}_sum{_format_labels(self.labelnames, labels)} {series[-1]:g}')
+                lines.append(f'{self.name}_count{_format_labels(self.labelnames, labels)} {series[len(self.buckets)]}')
+        return lines
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for v in values)
+    return '{' + ','.join(f'{n}="{v}"' for n, v in zip(names, escaped)) + '}'
+
+
+REQUEST_LATENCY = HistogramMetric('loop_http_request_duration_seconds', 'Request latency by endpoint.',
+                            ('endpoint', 'method'), LATENCY_BUCKETS)
+REQUESTS = CounterMetric('loop_http_requests_total', 'Requests by endpoint and status.', ('endpoint', 'method', 'status'))
+REQUEST_QUERIES = HistogramMetric('loop_sql_queries_per_request', 'SQL statements issued per request.',
+                            ('endpoint',), QUERY_COUNT_BUCKETS)
+SQL_QUERIES = CounterMetric('loop_sql_queries_total', 'SQL statements by endpoint.', ('endpoint',))
+SQL_SECONDS = CounterMetric('loop_sql_seconds_total', 'Time spent in SQL by endpoint.', ('endpoint',))
+SLOW_QUERIES = CounterMetric('loop_sql_slow_queries_total', 'Statements slower than SLOW_QUERY_MS by endpoint.', ('endpoint',))
+SUSPECTED_N_PLUS_ONE = CounterMetric('loop_sql_suspected_n_plus_one_total', 'Requests with a repeated statement shape.', ('endpoint',))
+METRICS = [REQUEST_LATENCY, REQUESTS, REQUEST_QUERIES, SQL_QUERIES, SQL_SECONDS, SLOW_QUERIES, SUSPECTED_N_PLUS_ONE]
+
+
+def render_metrics():
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+def _endpoint():
+    return request.endpoint or 'unmatched'
+
+
+def init_instrumentation(app, db):
+    app.config.setdefault('SLOW_QUERY_MS', 100)
+    app.config.setdefault('N_PLUS_ONE_THRESHOLD', 10) # Same statement shape this many times in one request
+    app.config.setdefault('SLOW_QUERY_LOG', os.path.join(app.root_path, 'logs', 'slow_queries.log'))
+    app.config.setdefault('METRICS_TOKEN', None) # Scrapers send "Authorization: Bearer <token>"; unset = admins only
+
+    if app.config['SLOW_QUERY_LOG'] and not slow_query_logger.handlers:
+        os.makedirs(os.path.dirname(app.config['SLOW_QUERY_LOG']), exist_ok=True)
+        handler = RotatingFileHandler(app.config['SLOW_QUERY_LOG'], maxBytes=10 * 1024 * 1024, backupCount=5)
+        handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+        slow_query_logger.addHandler(handler)
+        slow_query_logger.setLevel(logging.WARNING)
+        slow_query_logger.propagate = False
+
+    slow_query_seconds = app.config['SLOW_QUERY_MS'] / 1000.0
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['query_start'].pop()
+        if not has_request_context() or 'sql_count' not in g:
+            return
+        g.sql_count += 1
+        g.sql_seconds += elapsed
+        g.sql_shapes[statement_shape(statement)] += 1
+        if elapsed >= slow_query_seconds:
+            SLOW_QUERIES.inc((_endpoint(),))
+            slow_query_logger.warning('%.1fms %s %s | %s | params=%r', elapsed * 1000, request.method, request.path,
+                                      _WHITESPACE_RE.sub(' ', statement), parameters)
+
+    with app.app_context():
+        for engine in db.engines.values(): # The default database and every region (see shards.py)
+            event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+            event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+
+    @app.before_request
+    def start_request_metrics():
+        g.request_started = time.perf_counter()
+        g.sql_count = 0
+        g.sql_seconds = 0.0
+        g.sql_shapes = Counter()
+
+    @app.after_request
+    def record_request_metrics(response):
+        if 'request_started' not in g:
+            return response
+        endpoint = _endpoint()
+        elapsed = time.perf_counter() - g.request_started
+        REQUEST_LATENCY.observe((endpoint, request.method), elapsed)
+        REQUESTS.inc((endpoint, request.method, str(response.status_code)))
+        REQUEST_QUERIES.observe((endpoint,), g.sql_count)
+        SQL_QUERIES.inc((endpoint,), g.sql_count)
+        SQL_SECONDS.inc((endpoint,), g.sql_seconds)
+
+        repeated = [(shape, count) for shape, count in g.sql_shapes.items() if count >= app.config['N_PLUS_ONE_THRESHOLD']]
+        if repeated:
+            SUSPECTED_N_PLUS_ONE.inc((endpoint,))
+            for shape, count in sorted(repeated, key=lambda item: -item[1]):
+                logger.warning('Suspected N+1 on %s: %d x %s', endpoint, count, shape[:300])
+
+        response.headers['Server-Timing'] = (
+            f'db;dur={g.sql_seconds * 1000:.1f};desc="{g.sql_count} queries", app;dur={elapsed * 1000:.1f}'
+        )
+        return response
+
+    def metrics_allowed():
+        token = app.config['METRICS_TOKEN']
+        if token and hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+            return True
+        return current_user.is_authenticated and current_user.email.lower() in app.config.get('ADMIN_EMAILS', ())
+
+    def metrics():
+        if not metrics_allowed():
+            abort(404) # Traffic and SQL timings are not public; don't advertise the endpoint either
+        return render_metrics(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+    app.add_url_rule('/metrics', 'metrics', metrics)
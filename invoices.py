@@ -0,0 +1,236 @@
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+import multiprocessing
+
+# --- Invoice rendering ---
+# Everything in this module works on plain dicts (see build_invoice_data), never on ORM objects,
+# so the render functions can run in a process pool without touching the database.
+
+def invoice_status_text(bill_status, insurance_claim_status, insurance_company_name):
+    status_text = bill_status
+    if bill_status == 'Pending Insurance':
+        status_text = f"Pending (Claim {insurance_claim_status})"
+    elif bill_status == 'Paid':
+         if insurance_claim_status == 'Accepted':
+             status_text = f"Paid (via {insurance_company_name})"
+         else:
+             status_text = "Paid (by Patient)"
+    return status_text
+
+def build_invoice_data(apt, invoice, record=None):
+    """Flattens an appointment, its invoice (and its related diagnosis) into plain values for render_invoice_pdf."""
+    claim = invoice.claim
+    return {
+        'appointment_id': apt.id,
+        'patient_name': apt.patient.full_name,
+        'doctor_name': apt.doctor.full_name,
+        'doctor_specialty': apt.doctor.specialty,
+        'appointment_time': apt.appointment_time.strftime("%Y-%m-%d %I:%M %p"),
+        'description': invoice.description or "Consultation",
+        'amount': invoice.amount,
+        'diagnosis': record.diagnosis if record else None,
+        'status_text': invoice_status_text(
+            invoice.status,
+            claim.status if claim else 'None',
+            claim.insurer.company_name if claim else None
+        ),
+    }
+
+def add_invoice_page(pdf, data):
+    """Draws one invoice onto a new page of `pdf`."""
+    pdf.add_page()
+
+    # Title
+    pdf.set_font('Arial', 'B', 20)
+    pdf.cell(0, 15, 'Medical Invoice', ln=True, align='C')
+    pdf.ln(10)
+
+    # Header Info
+    pdf.set_font('Arial', 'B', 12)
+    pdf.cell(40, 8, 'Patient:', border=1)
+    pdf.set_font('Arial', '', 12)
+    pdf.cell(0, 8, f' {data["patient_name"]}', border=1, ln=True)
+
+    pdf.set_font('Arial', 'B', 12)
+    pdf.cell(40, 8, 'Doctor:', border=1)
+    pdf.set_font('Arial', '', 12)
+    pdf.cell(0, 8, f' {data["doctor_name"]} ({data["doctor_specialty"]})', border=1, ln=True)
+
+    pdf.set_font('Arial', 'B', 12)
+    pdf.cell(40, 8, 'Appointment:', border=1)
+    pdf.set_font('Arial', '', 12)
+    pdf.cell(0, 8, f' {data["appointment_time"]}', border=1, ln=True)
+
+    pdf.ln(10)
+
+    # Body / Items
+    pdf.set_font('Arial', 'B', 12)
+    pdf.set_fill_color(240, 240, 240)
+    pdf.cell(130, 10, 'Description', border=1, fill=True)
+    pdf.cell(0, 10, 'Amount', border=1, fill=True, ln=True, align='R')
+
+    pdf.set_font('Arial', '', 12)
+    pdf.cell(130, 10, f' {data["description"]}', border=1)
+    pdf.cell(0, 10, f' ${data["amount"]:.2f}', border=1, ln=True, align='R')
+
+    # Diagnosis (if found)
+    if data['diagnosis']:
+        pdf.cell(130, 10, f' Related Diagnosis: {data["diagnosis"]}', border=1)
+        pdf.cell(0, 10, '', border=1, ln=True, align='R')
+
+    pdf.ln(5)
+
+    # Total
+    pdf.set_font('Arial', 'B', 14)
+    pdf.cell(130, 12, 'Total Due:', align='R')
+    pdf.cell(0, 12, f' ${data["amount"]:.2f}', align='R', ln=True)
+
+    pdf.ln(10)
+
+    # Status
+    pdf.set_font('Arial', 'B', 14)
+    pdf.cell(0, 10, f'Status: {data["status_text"]}', ln=True, align='C')
+
+    # --- Computer generated footer ---
+    pdf.set_y(-15) # Position 1.5 cm from bottom
+    pdf.set_font('Arial', 'I', 8)
+    pdf.cell(0, 10, 'This is a computer-generated invoice and requires no signature.', 0, 0, 'C')
+
+def render_invoice_pdf(data):
+    """Renders a single invoice to PDF bytes."""
+    from fpdf import FPDF # Imported on first use, so web workers that never render a PDF don't pay for it
+    pdf = FPDF()
+    add_invoice_page(pdf, data)
+    # FPDF output as string, encode to latin-1 for binary blob
+    return pdf.output(dest='S').encode('latin-1')
+
+def render_invoice_batch(batch):
+    """Process-pool worker: renders a list of invoices to [(zip entry name, pdf bytes), ...]."""
+    return [(f'Invoice-{data["appointment_id"]}.pdf', render_invoice_pdf(data)) for data in batch]
+
+def render_statement_pdf(title, period, rows):
+    """Renders a multi-page statement: one line per invoice plus a grand total."""
+    from fpdf import FPDF
+    pdf = FPDF()
+    pdf.set_auto_page_break(True, margin=20)
+    pdf.add_page()
+
+    pdf.set_font('Arial', 'B', 18)
+    pdf.cell(0, 12, 'Billing Statement', ln=True, align='C')
+    pdf.set_font('Arial', '', 12)
+    pdf.cell(0, 8, title, ln=True, align='C')
+    pdf.cell(0, 8, period, ln=True, align='C')
+    pdf.ln(6)
+
+    widths = (18, 34, 40, 40, 28, 30) # #, Date, Patient, Doctor, Amount, Status
+    headers = ('#', 'Date', 'Patient', 'Doctor', 'Amount', 'Status')
+    pdf.set_font('Arial', 'B', 9)
+    pdf.set_fill_color(240, 240, 240)
+    for width, header in zip(widths, headers):
+        pdf.cell(width, 8, header, border=1, fill=True)
+    pdf.ln()
+
+    total = 0.0
+    count = 0
+    pdf.set_font('Arial', '', 9)
+    for data in rows:
+        total += data['amount'] or 0.0
+        count += 1
+        values = (
+            str(data['appointment_id']),
+            data['appointment_time'][:10],
+            data['patient_name'][:22],
+            data['doctor_name'][:22],
+            f'${data["amount"]:.2f}',
+            data['status_text'][:16],
+        )
+        for width, value in zip(widths, values):
+            pdf.cell(width, 7, value, border=1)
+        pdf.ln()
+
+    pdf.ln(4)
+    pdf.set_font('Arial', 'B', 12)
+    pdf.cell(0, 10, f'{count} invoice(s) - Total: ${total:.2f}', ln=True, align='R')
+    return pdf.output(dest='S').encode('latin-1')
+
+
+# --- Bulk export helpers ---
+
+_export_pool = None
+
+def get_export_pool(max_workers=None):
+    """Lazily starts the shared render pool. 'spawn' avoids forking a threaded web worker."""
+    global _export_pool
+    if _export_pool is None:
+        _export_pool = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'))
+    return _export_pool
+
+def batched(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def bounded_map(pool, fn, iterable, max_in_flight):
+    """Like pool.map, but keeps at most `max_in_flight` tasks outstanding and yields results in order,
+    so a slow consumer (e.g. a client downloading a ZIP) never makes results pile up in memory."""
+    pending = deque()
+    for item in iterable:
+        pending.append(pool.submit(fn, item))
+        if len(pending) >= max_in_flight:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+class _ChunkBuffer:
+    """Write-only, unseekable sink for zipfile. zipfile falls back to data descriptors
+    when it cannot seek, so entries can be handed to the client as soon as they are written."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+def stream_zip(entries):
+    """Yields a ZIP archive chunk by chunk from an iterable of (name, content) entries.
+
+    content is bytes, a binary file object (read in blocks, then closed) or an
+    iterable of byte chunks, so large entries never have to sit in memory whole.
+    """
+    buffer = _ChunkBuffer()
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_STORED) as archive:
+        for name, content in entries:
+            if isinstance(content, bytes):
+                archive.writestr(name, content)
+            else:
+                if hasattr(content, 'read'):
+                    blocks, source = iter(lambda: content.read(64 * 1024), b''), content
+                else:
+                    blocks, source = content, None
+                with archive.open(name, 'w', force_zip64=True) as entry:
+                    for block in blocks:
+                        entry.write(block)
+                        chunk = buffer.drain()
+                        if chunk:
+                            yield chunk
+                if source is not None:
+                    source.close()
+            chunk = buffer.drain()
+            if chunk:
+                yield chunk
+    yield buffer.drain() # Central directory
@@ -0,0 +1,221 @@
+"""Durable background jobs kept in the `job` table.
+
+Routes call enqueue() after their own commit and return straight away;
+`flask jobs-worker` runs a pool of worker processes that claim due jobs, run
+the registered task and record the outcome. A task that raises is retried with
+exponential backoff until max_attempts, then left as 'failed' for an admin to
+look at, and retry, from /admin/jobs.
+
+A job can run more than once: a worker may die after its task finished but
+before the row was updated, and the job is handed out again once its lease
+expires. Tasks must therefore be idempotent. An idempotency key makes
+enqueue() return the existing job instead of queueing the same work twice.
+"""
+import datetime
+import json
+import multiprocessing
+import os
+import random
+import signal
+import socket
+import time
+import traceback
+from sqlalchemy import update, delete
+from sqlalchemy.exc import IntegrityError
+from models import db, Job
+
+RETRY_BASE_SECONDS = 10
+RETRY_MAX_SECONDS = 3600
+
+TASKS = {}
+
+
+def task(name):
+    """Registers a function as the task `name`. It is called with the job's payload as keyword arguments."""
+    def register(fn):
+        TASKS[name] = fn
+        return fn
+    return register
+
+
+def enqueue(name, payload=None, idempotency_key=None, run_at=None, max_attempts=5):
+    """Queues a job and commits it. Returns the new job, or the existing one with the same idempotency key."""
+    if name not in TASKS:
+        raise KeyError(f'Unknown task {name!r}')
+    job = Job(task=name, payload=json.dumps(payload or {}), idempotency_key=idempotency_key,
+              run_at=run_at or datetime.datetime.now(), max_attempts=max_attempts)
+    db.session.add(job)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        if idempotency_key is None:
+            raise
+        return db.session.scalar(db.select(Job).where(Job.idempotency_key == idempotency_key))
+    return job
+
+
+def retry_delay(attempts):
+    """Exponential backoff with jitter, so failing jobs don't retry in lockstep."""
+    delay = min(RETRY_BASE_SECONDS * 2 ** (attempts - 1), RETRY_MAX_SECONDS)
+    return datetime.timedelta(seconds=delay * random.uniform(0.5, 1.0))
+
+
+def claim_next(worker_id):
+    """Marks the oldest due job as running for this worker and returns it, or None if nothing is due."""
+    for _ in range(5): # Another worker may claim the same candidate first
+        now = datetime.datetime.now()
+        job_id = db.session.scalar(
+            db.select(Job.id).where(Job.status == 'queued', Job.run_at <= now).order_by(Job.run_at, Job.id).limit(1)
+        )
+        if job_id is None:
+            db.session.rollback()
+            return None
+        claimed = db.session.execute(
+            update(Job).where(Job.id == job_id, Job.status == 'queued')
+            .values(status='running', locked_by=worker_id, locked_at=now, attempts=Job.attempts + 1)
+        ).rowcount
+        db.session.commit()
+        if claimed:
+            return db.session.get(Job, job_id)
+    return None
+
+
+def run_job(job):
+    """Runs a claimed job and records success, a scheduled retry, or failure. Returns True on success."""
+    job_id = job.id
+    try:
+        fn = TASKS.get(job.task)
+        if fn is None:
+            raise LookupError(f'Unknown task {job.task!r}')
+        result = fn(**json.loads(job.payload))
+    except Exception:
+        db.session.rollback()
+        job = db.session.get(Job, job_id)
+        job.last_error = traceback.format_exc()[-4000:]
+        job.locked_by = job.locked_at = None
+        if job.attempts >= job.max_attempts:
+            job.status = 'failed'
+            job.finished_at = datetime.datetime.now()
+        else:
+            job.status = 'queued'
+            job.run_at = datetime.datetime.now() + retry_delay(job.attempts)
+        db.session.commit()
+        return False
+
+    job = db.session.get(Job, job_id) # The task may have committed or rolled back the session
+    job.status = 'succeeded'
+    job.result = json.dumps(result) if result is not None else None
+    job.locked_by = job.locked_at = None
+    job.finished_at = datetime.datetime.now()
+    db.session.commit()
+    return True
+
+
+def requeue_expired(lease_seconds):
+    """Hands jobs whose worker vanished mid-run back to the queue (or fails them if out of attempts)."""
+    now = datetime.datetime.now()
+    expired = (Job.status == 'running', Job.locked_at < now - datetime.timedelta(seconds=lease_seconds))
+    failed = db.session.execute(
+        update(Job).where(*expired, Job.attempts >= Job.max_attempts)
+        .values(status='failed', finished_at=now, locked_by=None, locked_at=None, last_error='Worker lease expired')
+    ).rowcount
+    requeued = db.session.execute(
+        update(Job).where(*expired).values(status='queued', run_at=now, locked_by=None, locked_at=None)
+    ).rowcount
+    db.session.commit()
+    return requeued + failed
+
+
+def retry_job(job):
+    """Puts a failed job back in the queue with a fresh set of attempts."""
+    job.status = 'queued'
+    job.attempts = 0
+    job.run_at = datetime.datetime.now()
+    job.finished_at = None
+    db.session.commit()
+
+
+def prune_jobs(retention_days):
+    """Deletes succeeded jobs older than `retention_days`. Failed jobs are kept for inspection."""
+    cutoff = datetime.datetime.now() - datetime.timedelta(days=retention_days)
+    deleted = db.session.execute(delete(Job).where(Job.status == 'succeeded', Job.finished_at < cutoff)).rowcount
+    db.session.commit()
+    return deleted
+
+
+def job_counts():
+    rows = db.session.execute(db.select(Job.status, db.func.count()).group_by(Job.status))
+    return {status: count for status, count in rows}
+
+
+# --- Worker processes ---
+
+def work(worker_id, stop, poll_interval, burst=False):
+    """Claims and runs jobs until `stop` is set (or, with burst, until nothing is due). Needs an app context."""
+    while not stop.is_set():
+        job = claim_next(worker_id)
+        if job is None:
+            db.session.remove()
+            if burst:
+                return
+            stop.wait(poll_interval)
+            continue
+        run_job(job)
+        db.session.remove()
+
+
+def _worker_main(app_factory, config, stop, poll_interval, burst):
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # The supervisor handles Ctrl-C and sets `stop`
+    app = app_factory({**config, 'AUTO_MIGRATE': False})
+    with app.app_context():
+        work(f'{socket.gethostname()}:{os.getpid()}', stop, poll_interval, burst)
+
+
+def run_worker_pool(app, app_factory, processes, poll_interval=1.0, burst=False, config=None, echo=print):
+    """Runs `processes` worker processes, each building its own app with app_factory(config).
+
+    The calling process supervises: it restarts workers that die, hands back jobs whose
+    lease expired and prunes old succeeded jobs. With burst, it returns once the queue is drained.
+    """
+    ctx = multiprocessing.get_context('spawn') # Workers must not inherit the parent's open SQLite connections
+    stop = ctx.Event()
+    config = config or {}
+
+    def start():
+        process = ctx.Process(target=_worker_main, args=(app_factory, config, stop, poll_interval, burst), daemon=True)
+        process.start()
+        return process
+
+    workers = [start() for _ in range(processes)]
+    echo(f'Started {processes} job worker(s).')
+    lease_seconds = app.config['JOB_LEASE_SECONDS']
+    next_maintenance = 0.0
+    try:
+        while workers:
+            if time.monotonic() >= next_maintenance:
+                with app.app_context():
+                    expired = requeue_expired(lease_seconds)
+                    pruned = prune_jobs(app.config['JOB_RETENTION_DAYS'])
+                    db.session.remove()
+                if expired or pruned:
+                    echo(f'Requeued {expired} expired job(s), pruned {pruned} finished job(s).')
+                next_maintenance = time.monotonic() + min(lease_seconds, 300)
+            time.sleep(poll_interval)
+            for i, process in enumerate(workers):
+                if process.is_alive():
+                    continue
+                if burst and process.exitcode == 0:
+                    workers[i] = None
+                else:
+                    echo(f'Job worker {process.pid} exited with {process.exitcode}; restarting.')
+                    workers[i] = start()
+            workers = [p for p in workers if p is not None]
+    except KeyboardInterrupt:
+        echo('Stopping job workers...')
+    finally:
+        stop.set()
+        for process in workers:
+            process.join(timeout=30)
+            if process.is_alive():
+                process.terminate()
@@ -1,174 +1,217 @@
 import os
 import uuid
-from flask import Flask, render_template, request, redirect, url_for, flash, abort, g, send_from_directory, jsonify, make_response
-from flask_sqlalchemy import SQLAlchemy
-from flask_login import LoginManager, UserMixin, login_user, logout_user, current_user, login_required
+import hashlib
+import json
+import time
+import threading
+from collections import OrderedDict
+from itertools import islice
+from flask import Flask, Blueprint, current_app, render_template, request, redirect, url_for, flash, abort, g, send_from_directory, jsonify, make_response, stream_with_context
+from flask_login import LoginManager, login_user, logout_user, current_user, login_required
 from flask_bcrypt import Bcrypt
 from functools import wraps
 from sqlalchemy.sql import func
-from sqlalchemy.sql.expression import extract
 import datetime
-from geopy.distance import great_circle
-from sqlalchemy import or_ # <-- IMPORT or_
-from fpdf import FPDF # <-- NEW: Import for PDF generation
+import click
+from sqlalchemy import or_, event, tuple_, inspect # <-- IMPORT or_
+from sqlalchemy.orm import aliased
+from sqlalchemy.exc import OperationalError
+import migrations
+from instrumentation import init_instrumentation
+import profiler
+import ratelimit
+import jobs
+import archive
+import billing
+import roster
+import schedule
+import reminders
+import read_models
+import shards
+import autocomplete
+import scrub
+from history_export import generate_history_export, EXPORT_FORMATS as HISTORY_EXPORT_FORMATS
+from events import feed, format_sse
+from invoices import (build_invoice_data, render_invoice_pdf, render_invoice_batch, render_statement_pdf,
+                      invoice_status_text, get_export_pool, batched, bounded_map, stream_zip)
+from models import (db, patient_doctor_permissions, User, PatientProfile, DoctorProfile, InsuranceProfile,
+                    MedicalRecord, Appointment, DoctorReview, MedicalFile, Job, ScheduleBlock, ScheduleException,
+                    Invoice, InsuranceClaim, ArchivedAppointment, ArchivedMedicalRecord, ArchivedMedicalFile)
 
-# --- App Setup (Unchanged) ---
-app = Flask(__name__)
 basedir = os.path.abspath(os.path.dirname(__file__))
-app.config['SECRET_KEY'] = 'a_very_secret_key_that_you_should_change'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(basedir, 'site.db')
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['UPLOAD_FOLDER'] = os.path.join(basedir, 'uploads')
-app.config['ALLOWED_EXTENSIONS'] = {'png', 'jpg', 'jpeg', 'pdf'}
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-
-# --- Initialize Extensions (Unchanged) ---
-db = SQLAlchemy(app)
-bcrypt = Bcrypt(app)
-login_manager = LoginManager(app)
-login_manager.login_view = 'login'
-login_manager.login_message_category = 'info'
-
-# --- Database Models (UPDATED) ---
-
-# (Permissions Table Unchanged)
-patient_doctor_permissions = db.Table('patient_doctor_permissions',
-    db.Column('patient_id', db.Integer, db.ForeignKey('patient_profile.id'), primary_key=True),
-    db.Column('doctor_id', db.Integer, db.ForeignKey('doctor_profile.id'), primary_key=True)
-)
-
-# (User Model Unchanged)
-class User(db.Model, UserMixin):
-    id = db.Column(db.Integer, primary_key=True)
-    email = db.Column(db.String(120), unique=True, nullable=False)
-    password_hash = db.Column(db.String(60), nullable=False)
-    role = db.Column(db.String(20), nullable=False)
-    
-    patient_profile = db.relationship('PatientProfile', backref='user', uselist=False, cascade="all, delete-orphan")
-    doctor_profile = db.relationship('DoctorProfile', backref='user', uselist=False, cascade="all, delete-orphan")
-    insurance_profile = db.relationship('InsuranceProfile', backref='user', uselist=False, cascade="all, delete-orphan")
-
-class PatientProfile(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    full_name = db.Column(db.String(100), nullable=False, default='Unnamed')
-    phone = db.Column(db.String(20))
-    address = db.Column(db.String(200))
-    pincode = db.Column(db.String(10))
-    latitude = db.Column(db.Float)
-    longitude = db.Column(db.Float)
-    
-    # --- NEW: Insurance Details for Patient ---
-    insurance_policy_id = db.Column(db.String(100), nullable=True)
-    insurance_company_id = db.Column(db.Integer, db.ForeignKey('insurance_profile.id'), nullable=True)
-    
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, unique=True)
-    
-    records = db.relationship('MedicalRecord', backref='patient', lazy='dynamic', foreign_keys='MedicalRecord.patient_id')
-    appointments = db.relationship('Appointment', backref='patient', lazy='dynamic', foreign_keys='Appointment.patient_id')
-    reviews = db.relationship('DoctorReview', backref='patient', lazy='dynamic', foreign_keys='DoctorReview.patient_id')
-    files = db.relationship('MedicalFile', backref='patient', lazy='dynamic', foreign_keys='MedicalFile.patient_id')
-    
-    permitted_doctors = db.relationship('DoctorProfile', secondary=patient_doctor_permissions,
-        back_populates='permitted_patients')
-    
-    # --- NEW: Relationship to their insurance company ---
-    insurance_company = db.relationship('InsuranceProfile', foreign_keys=[insurance_company_id])
-
-
-class DoctorProfile(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    full_name = db.Column(db.String(100), nullable=False, default='Dr. Unnamed')
-    phone = db.Column(db.String(20))
-    specialty = db.Column(db.String(100))
-    practice_address = db.Column(db.String(200))
-    pincode = db.Column(db.String(10))
-    latitude = db.Column(db.Float)
-    longitude = db.Column(db.Float)
-    
-    # --- NEW: Availability Fields ---
-    availability_start_time = db.Column(db.Time) # e.g., 09:00:00
-    availability_end_time = db.Column(db.Time)   # e.g., 17:00:00
-    slot_duration_minutes = db.Column(db.Integer, default=30)
-    
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, unique=True)
-    
-    records_written = db.relationship('MedicalRecord', backref='doctor', lazy='dynamic', foreign_keys='MedicalRecord.doctor_id')
-    appointments = db.relationship('Appointment', backref='doctor', lazy='dynamic', foreign_keys='Appointment.doctor_id')
-    reviews = db.relationship('DoctorReview', backref='doctor_profile', lazy='dynamic', foreign_keys='DoctorReview.doctor_id')
-    files_written = db.relationship('MedicalFile', backref='doctor', lazy='dynamic', foreign_keys='MedicalFile.doctor_id')
-    
-    permitted_patients = db.relationship('PatientProfile', secondary=patient_doctor_permissions,
-        back_populates='permitted_doctors')
-
-# (Other Models Unchanged)
-class InsuranceProfile(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    company_name = db.Column(db.String(100), nullable=False, default='Unnamed Company')
-    phone = db.Column(db.String(20))
-    company_address = db.Column(db.String(200))
-    pincode = db.Column(db.String(10))
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, unique=True)
-
-class MedicalRecord(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    diagnosis = db.Column(db.Text, nullable=False)
-    notes = db.Column(db.Text)
-    prescription = db.Column(db.String(500))
-    created_at = db.Column(db.DateTime, nullable=False, default=db.func.current_timestamp())
-    patient_id = db.Column(db.Integer, db.ForeignKey('patient_profile.id'), nullable=False)
-    doctor_id = db.Column(db.Integer, db.ForeignKey('doctor_profile.id'), nullable=False)
-
-class Appointment(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    appointment_time = db.Column(db.DateTime, nullable=False)
-    status = db.Column(db.String(20), nullable=False, default='Pending') # Pending, Confirmed, Cancelled, Completed
-    patient_id = db.Column(db.Integer, db.ForeignKey('patient_profile.id'), nullable=False)
-    doctor_id = db.Column(db.Integer, db.ForeignKey('doctor_profile.id'), nullable=False)
-    
-    # --- NEW: Billing Fields ---
-    bill_amount = db.Column(db.Float)
-    bill_status = db.Column(db.String(20), nullable=False, default='Unbilled') # Unbilled, Unpaid, Paid, Pending Insurance
-    bill_description = db.Column(db.Text)
-    
-    # --- NEW: Fields for Insurance Claim ---
-    insurance_id = db.Column(db.Integer, db.ForeignKey('insurance_profile.id'), nullable=True)
-    insurance_claim_status = db.Column(db.String(20), nullable=False, default='None') # None, Pending, Accepted, Rejected
 
-    # Link to the insurance company
-    insurance_company = db.relationship('InsuranceProfile', backref='claims', foreign_keys=[insurance_id])
-    
-    # --- NEW: Unique constraint for doctor and time ---
-    # This ensures only one patient can book a specific slot with a doctor
-    __table_args__ = (db.UniqueConstraint('doctor_id', 'appointment_time', name='_doctor_time_uc'),)
-
-
-class DoctorReview(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    cost_rating = db.Column(db.Integer, nullable=False) # 1-10
-    hospitality_rating = db.Column(db.Integer, nullable=False) # 1-10
-    med_rec_rating = db.Column(db.Integer, nullable=False) # 1-10
-    overall_rating = db.Column(db.Integer, nullable=False) # 1-10
-    comment = db.Column(db.Text)
-    created_at = db.Column(db.DateTime, nullable=False, default=db.func.current_timestamp())
-    patient_id = db.Column(db.Integer, db.ForeignKey('patient_profile.id'), nullable=False)
-    doctor_id = db.Column(db.Integer, db.ForeignKey('doctor_profile.id'), nullable=False)
-    __table_args__ = (db.UniqueConstraint('patient_id', 'doctor_id', name='_patient_doctor_review_uc'),)
-
-class MedicalFile(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    filename = db.Column(db.String(256), unique=True, nullable=False)
-    original_filename = db.Column(db.String(256), nullable=False)
-    description = db.Column(db.String(500))
-    created_at = db.Column(db.DateTime, nullable=False, default=db.func.current_timestamp())
-    patient_id = db.Column(db.Integer, db.ForeignKey('patient_profile.id'), nullable=False)
-    doctor_id = db.Column(db.Integer, db.ForeignKey('doctor_profile.id'), nullable=False)
+# --- NEW: SQLite engine profiles ---
+# 'production' switches to WAL so readers never wait on a writer, uses synchronous=NORMAL
+# (safe in WAL mode, far fewer fsyncs) and makes writers wait for a lock instead of
+# failing with "database is locked". 'default' keeps SQLite's stock settings.
+SQLITE_PROFILES = {
+    'default': {
+        'pragmas': {},
+        'engine_options': {},
+    },
+    'production': {
+        'pragmas': {
+            'journal_mode': 'WAL',
+            'synchronous': 'NORMAL',
+            'busy_timeout': 5000,    # ms to wait for a write lock
+            'cache_size': -65536,    # negative = KiB, i.e. 64 MiB page cache per connection
+            'mmap_size': 268435456,  # 256 MiB memory-mapped reads
+            'temp_store': 'MEMORY',
+        },
+        'engine_options': {
+            'pool_size': 10,
+            'max_overflow': 20,
+            'pool_timeout': 30,
+            'pool_recycle': 3600,
+            'connect_args': {'timeout': 5}, # sqlite3-level lock wait, in seconds
+        },
+    },
+}
+
+# --- Extensions (bound to an app in create_app) ---
+bcrypt = Bcrypt()
+login_manager = LoginManager()
+login_manager.login_view = 'main.login'
+login_manager.login_message_category = 'info'
 
+# Every route, error handler and CLI command below hangs off this blueprint.
+# cli_group=None keeps the commands at the top level (`flask db-upgrade`, not `flask main db-upgrade`).
+bp = Blueprint('main', __name__, cli_group=None)
+
+# --- App Factory ---
+# Run with `flask --app main run` or `gunicorn 'main:create_app()'`.
+def create_app(config=None):
+    app = Flask(__name__)
+    app.config['SECRET_KEY'] = 'a_very_secret_key_that_you_should_change'
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///' + os.path.join(basedir, 'site.db'))
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['UPLOAD_FOLDER'] = os.path.join(basedir, 'uploads')
+    app.config['ALLOWED_EXTENSIONS'] = {'png', 'jpg', 'jpeg', 'pdf'}
+    app.config['INVOICE_CACHE_SIZE'] = 256 # Max rendered invoice PDFs kept in memory
+    app.config['INVOICE_DIR'] = os.path.join(basedir, 'invoices') # Invoice PDFs pre-rendered by the render_invoice job
+    app.config['EXPORT_WORKERS'] = None # Render processes for bulk exports (None = one per CPU)
+    app.config['EXPORT_BATCH_SIZE'] = 50 # Invoices rendered per pool task
+    app.config['EXPORT_STATEMENT_MAX_ROWS'] = 5000 # A statement is one PDF built in memory; longer ranges must use the ZIP
+    app.config['REVIEWS_PAGE_SIZE'] = 10 # Reviews per page on the booking page
+    app.config['RATING_CACHE_SIZE'] = 1024 # Doctors whose rating summary is kept in memory
+    app.config['RATING_CACHE_TTL'] = 300 # Seconds; bounds how stale another worker's summary can get
+    app.config['REFERENCE_DATA_TTL'] = 600 # Seconds the insurer / specialty lists are cached per worker
+    app.config['SCHEDULE_CACHE_SIZE'] = 4096 # Compiled (doctor, date) schedules kept in memory
+    app.config['EVENTS_HEARTBEAT'] = 15 # Seconds between keepalive comments on an idle /events stream
+    app.config['EVENTS_MAX_STREAM'] = 300 # Seconds before /events closes; the browser reconnects with Last-Event-ID
+    app.config['SQLITE_PROFILE'] = os.environ.get('SQLITE_PROFILE', 'production')
+    # Per-request SQL counters, N+1 / slow query logs and /metrics (see instrumentation.py)
+    app.config['SLOW_QUERY_MS'] = 100
+    app.config['N_PLUS_ONE_THRESHOLD'] = 10
+    app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN') # Bearer token for scrapers; without one only admins can read /metrics
+    # On-demand request profiling, configured from /admin/profiling (see profiler.py)
+    app.config['ADMIN_EMAILS'] = {e.strip().lower() for e in os.environ.get('ADMIN_EMAILS', '').split(',') if e.strip()}
+    # Background jobs, run by `flask jobs-worker` (see jobs.py)
+    app.config['JOB_LEASE_SECONDS'] = 600 # A running job whose worker vanished is handed out again after this
+    app.config['JOB_RETENTION_DAYS'] = 7 # Succeeded jobs older than this are deleted
+    # Settled history older than this moves to the archive tables (see archive.py)
+    app.config['ARCHIVE_AFTER_DAYS'] = 365
+    app.config['ARCHIVE_BATCH_SIZE'] = 1000
+    # Doctor roster imports (see roster.py)
+    app.config['ROSTER_IMPORT_WORKERS'] = None # Password-hashing processes (None = one per CPU)
+    app.config['ROSTER_ONLINE_GEOCODING'] = False # Look up unknown pincodes on Nominatim (one request per second)
+    # Appointment reminders, run by `flask reminders-run` (see reminders.py)
+    app.config['REMINDER_OFFSETS'] = (1440, 60) # Minutes before a confirmed appointment that reminders go out
+    app.config['REMINDER_LOOKAHEAD_MINUTES'] = 60 # How far past the next reminders each window load reaches
+    app.config['REMINDER_SENDER'] = 'file'
+    app.config['REMINDER_OUTBOX_DIR'] = os.path.join(basedir, 'outbox') # Where the file sender writes
+    app.config['REMINDER_BATCH_SIZE'] = 100
+    # Admission control for CPU-heavy endpoints (see ratelimit.py)
+    app.config['RATE_LIMITS'] = { # endpoint -> token buckets per IP (ip_per_minute / ip_burst) and per signed-in user
+        'main.login': {'per_minute': 10, 'burst': 5, 'methods': ('POST',)}, # bcrypt
+        'main.register': {'per_minute': 5, 'burst': 3, 'methods': ('POST',)}, # bcrypt
+        'api.create_session': {'per_minute': 10, 'burst': 5, 'methods': ('POST',)},
+        # Signed-in routes: an IP allowance several users wide, for clinics behind one address
+        'main.generate_invoice_pdf': {'per_minute': 30, 'burst': 10, 'ip_per_minute': 120, 'ip_burst': 40}, # FPDF
+        'main.search_doctors': {'per_minute': 30, 'burst': 10, 'ip_per_minute': 120, 'ip_burst': 40}, # distance loop
+        'api.search_doctors': {'per_minute': 30, 'burst': 10, 'ip_per_minute': 120, 'ip_burst': 40},
+    }
+    app.config['CONCURRENCY_LIMITS'] = { # endpoint -> requests run at once per process; more get a 503
+        'main.login': 4,
+        'main.register': 2,
+        'api.create_session': 4,
+        'main.generate_invoice_pdf': 2,
+        'main.search_doctors': 4,
+        'api.search_doctors': 4,
+    }
+    app.config['RATE_LIMIT_STORAGE'] = os.environ.get('RATE_LIMIT_STORAGE', 'memory') # or sqlite:///path, shared by workers
+    app.config['RATE_LIMIT_ENABLED'] = os.environ.get('RATE_LIMIT_ENABLED', '1') == '1' # 0 for load tests, whose users all share one IP
+    # Bring existing databases up to the models (see migrations.py)
+    app.config['AUTO_MIGRATE'] = os.environ.get('AUTO_MIGRATE', '1') == '1'
+    # One database per region, picked by pincode (see shards.py). Empty = one database for everyone.
+    app.config['SHARDS'] = shards.parse_shards(os.environ.get('SHARDS', '')) # region -> database URI
+    app.config['SHARD_REGIONS'] = shards.ZONE_REGIONS # pincode prefix -> region
+    app.config['SHARD'] = os.environ.get('SHARD') or None # Region that commands (jobs-worker, archive-history, ...) work in
+    # Typeahead for doctor names and specialties (see autocomplete.py)
+    app.config['AUTOCOMPLETE_LIMIT'] = 8 # Suggestions returned when the client does not ask for a number
+    app.config['AUTOCOMPLETE_MAX_LIMIT'] = 20
+    app.config['AUTOCOMPLETE_REFRESH'] = 30 # Seconds between checks for other workers' new doctors and reviews
+    app.config['AUTOCOMPLETE_PRELOAD'] = os.environ.get('AUTOCOMPLETE_PRELOAD', '1') == '1' # Build the index when the worker starts
+    # Upload folder / file row reconciliation, run by `flask scrub-uploads` (see scrub.py)
+    app.config['SCRUB_DIR'] = os.path.join(basedir, 'scrub') # Checkpoint and reports
+    app.config['SCRUB_QUARANTINE_DIR'] = os.path.join(basedir, 'scrub', 'quarantine') # Where --quarantine moves orphans
+    app.config['SCRUB_WORKERS'] = 8 # Threads stat-ing and hashing files
+    app.config['SCRUB_BATCH_SIZE'] = 1000 # Rows or file names per lookup; the checkpoint is saved after each
+    app.config['SCRUB_PARTITIONS'] = 16 # Passes the listing is split into; each can be resumed on its own
+    app.config['SCRUB_ORPHAN_GRACE_MINUTES'] = 60 # Younger files may still be waiting on their row
+    if config:
+        app.config.update(config)
+
+    if app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+        sqlite_profile = SQLITE_PROFILES[app.config['SQLITE_PROFILE']]
+        app.config['SQLITE_PRAGMAS'] = sqlite_profile['pragmas']
+        app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', sqlite_profile['engine_options'])
+    else:
+        app.config['SQLITE_PRAGMAS'] = {}
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+
+    shards.init_sharding(app) # Before init_app: adds a bind per region
+    db.init_app(app)
+    bcrypt.init_app(app)
+    login_manager.init_app(app)
+
+    def apply_sqlite_pragmas(dbapi_connection, connection_record):
+        """Runs the profile's PRAGMAs on every new pooled connection."""
+        cursor = dbapi_connection.cursor()
+        for name, value in app.config['SQLITE_PRAGMAS'].items():
+            cursor.execute(f'PRAGMA {name}={value}')
+        cursor.close()
+
+    with app.app_context():
+        for region in shards.regions():
+            engine = db.engines[region]
+            if app.config['SQLITE_PRAGMAS']:
+                event.listen(engine, 'connect', apply_sqlite_pragmas)
+            if app.config['AUTO_MIGRATE']:
+                if region is not None and not inspect(engine).has_table('appointment'):
+                    db.metadata.create_all(engine) # A new region starts from the models
+                migrations.upgrade(engine, echo=app.logger.info)
+
+    init_instrumentation(app, db)
+    profiler.init_profiler(app)
+    ratelimit.init_rate_limiting(app)
+    autocomplete.init_autocomplete(app)
+    app.register_blueprint(bp)
+    from api import api_bp # Imported here: api.py builds on this module's helpers
+    app.register_blueprint(api_bp)
+    return app
 
 # (Helpers, Decorators, General Routes Unchanged)
 # ...
 @login_manager.user_loader
 def load_user(user_id):
-    return db.session.get(User, int(user_id))
+    # The id is qualified with the account's region when the app is sharded (see User.get_id)
+    try:
+        region, user_id = shards.parse_id(user_id)
+        shards.set_region(region)
+    except (ValueError, KeyError):
+        return None # Malformed, or a region this deployment no longer has
+    return db.session.get(User, user_id)
 
 def role_required(role_name):
     def decorator(f):
@@ -186,18 +229,399 @@ def role_required(role_name):
         return decorated_function
     return decorator
 
+def admin_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if not current_user.is_authenticated or current_user.email.lower() not in current_app.config['ADMIN_EMAILS']:
+            abort(403)
+        return f(*args, **kwargs)
+    return decorated_function
+
 def allowed_file(filename):
     return '.' in filename and \
-           filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
+           filename.rsplit('.', 1)[1].lower() in current_app.config['ALLOWED_EXTENSIONS']
+
+# --- NEW: Invoice cache ---
+# Rendered invoice PDFs are kept in a bounded LRU keyed by invoice_key(): the appointment id,
+# the invoice version and the id of the latest medical record between the patient and the
+# doctor, whose diagnosis the PDF prints. Every change made through billing.py bumps the
+# version and a new record has a new id, so old entries are never hit again and simply age
+# out. Both live in the database, so every worker agrees on them.
+# Ids repeat across regions, so with sharding on, the keys, ETags and files carry the region.
+_invoice_cache = OrderedDict()
+_invoice_cache_lock = threading.Lock()
+
+def latest_related_record_id(patient_id, doctor_id):
+    """Id of the record latest_related_record() returns, or 0. Archived records keep their ids."""
+    for model in (MedicalRecord, ArchivedMedicalRecord):
+        record_id = db.session.scalar(
+            db.select(model.id)
+            .where(model.patient_id == patient_id, model.doctor_id == doctor_id)
+            .order_by(model.created_at.desc())
+            .limit(1)
+        )
+        if record_id is not None:
+            return record_id
+    return 0
+
+def invoice_key(invoice):
+    return invoice.appointment_id, invoice.version, latest_related_record_id(invoice.patient_id, invoice.doctor_id)
+
+def invoice_etag(key):
+    region = shards.current_region()
+    appointment_id, version, record_id = key
+    return f'invoice-{f"{region}-" if region else ""}{appointment_id}-v{version}-r{record_id}'
+
+def get_cached_invoice(key):
+    key = shards.scoped(key)
+    with _invoice_cache_lock:
+        pdf_content = _invoice_cache.get(key)
+        if pdf_content is not None:
+            _invoice_cache.move_to_end(key)
+        return pdf_content
+
+def store_cached_invoice(key, pdf_content):
+    key = shards.scoped(key)
+    with _invoice_cache_lock:
+        _invoice_cache[key] = pdf_content
+        _invoice_cache.move_to_end(key)
+        while len(_invoice_cache) > current_app.config['INVOICE_CACHE_SIZE']:
+            _invoice_cache.popitem(last=False)
+
+# Invoices pre-rendered by the render_invoice job are shared by every worker through INVOICE_DIR,
+# one folder per appointment so the job can clear out its older renders without listing them all
+def invoice_dir(appointment_id):
+    return os.path.join(current_app.config['INVOICE_DIR'], shards.current_region() or '', str(appointment_id))
+
+def invoice_file_path(key):
+    appointment_id, version, record_id = key
+    return os.path.join(invoice_dir(appointment_id), f'v{version}-r{record_id}.pdf')
+
+def load_rendered_invoice(key):
+    try:
+        with open(invoice_file_path(key), 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+# --- NEW: Doctor rating summaries ---
+# The booking page shows averages and a histogram over every review of a doctor. They take
+# one GROUP BY to compute and are kept in a bounded LRU keyed by doctor id. leave_review()
+# drops the doctor's entry in this worker; other workers see the new review within RATING_CACHE_TTL.
+_rating_cache = OrderedDict()
+_rating_cache_lock = threading.Lock()
+
+def compute_rating_summary(doctor_id):
+    rows = db.session.execute(
+        db.select(
+            DoctorReview.overall_rating,
+            func.count(),
+            func.sum(DoctorReview.cost_rating),
+            func.sum(DoctorReview.hospitality_rating),
+            func.sum(DoctorReview.med_rec_rating),
+        ).where(DoctorReview.doctor_id == doctor_id).group_by(DoctorReview.overall_rating)
+    ).all()
+    histogram = dict.fromkeys(range(10, 0, -1), 0)
+    count = overall_sum = cost_sum = hospitality_sum = med_rec_sum = 0
+    for overall, n, cost, hospitality, med_rec in rows:
+        histogram[overall] = n
+        count += n
+        overall_sum += overall * n
+        cost_sum += cost
+        hospitality_sum += hospitality
+        med_rec_sum += med_rec
+    average = lambda total: round(total / count, 1) if count else None
+    return {
+        'count': count,
+        'avg_overall': average(overall_sum),
+        'avg_cost': average(cost_sum),
+        'avg_hospitality': average(hospitality_sum),
+        'avg_med_rec': average(med_rec_sum),
+        'histogram': [(rating, n, round(100 * n / count) if count else 0) for rating, n in histogram.items()],
+    }
+
+def get_rating_summary(doctor_id):
+    now = time.monotonic()
+    key = shards.scoped(doctor_id)
+    with _rating_cache_lock:
+        entry = _rating_cache.get(key)
+        if entry is not None and entry[0] > now:
+            _rating_cache.move_to_end(key)
+            return entry[1]
+    summary = compute_rating_summary(doctor_id)
+    with _rating_cache_lock:
+        _rating_cache[key] = (now + current_app.config['RATING_CACHE_TTL'], summary)
+        _rating_cache.move_to_end(key)
+        while len(_rating_cache) > current_app.config['RATING_CACHE_SIZE']:
+            _rating_cache.popitem(last=False)
+    return summary
+
+def invalidate_rating_summary(doctor_id):
+    with _rating_cache_lock:
+        _rating_cache.pop(shards.scoped(doctor_id), None)
+
+def get_review_page(doctor_id, before_id=None):
+    """Returns (reviews, id to pass as before_id for the next page or None), newest first.
+
+    Keyset paging on (created_at, id) walks ix_doctor_review_doctor_created, so every
+    page costs the same however many reviews the doctor has. The anchor's created_at
+    is read in SQL so it compares against the stored value exactly.
+    """
+    page_size = current_app.config['REVIEWS_PAGE_SIZE']
+    query = db.select(DoctorReview).where(DoctorReview.doctor_id == doctor_id)
+    if before_id:
+        anchor = aliased(DoctorReview)
+        anchor_time = db.select(anchor.created_at).where(anchor.id == before_id, anchor.doctor_id == doctor_id).scalar_subquery()
+        query = query.where(tuple_(DoctorReview.created_at, DoctorReview.id) < tuple_(anchor_time, before_id))
+    reviews = db.session.scalars(
+        query.order_by(DoctorReview.created_at.desc(), DoctorReview.id.desc()).limit(page_size + 1)
+    ).all()
+    if len(reviews) > page_size:
+        return reviews[:page_size], reviews[page_size - 1].id
+    return reviews, None
+
+# --- NEW: Reference data (insurers and specialties) ---
+# Dropdowns and datalists read these on every page view, but they only change when an
+# insurer or doctor registers. The lists are cached per worker for REFERENCE_DATA_TTL;
+# register() invalidates them in its own worker. `version` is a hash of the content, so
+# every worker derives the same stamp for the same data and clients can cache by it.
+_reference_data = {} # region -> (expires, data)
+_reference_data_lock = threading.Lock()
+
+def load_reference_data():
+    insurers = [list(row) for row in db.session.execute(
+        db.select(InsuranceProfile.id, InsuranceProfile.company_name).order_by(InsuranceProfile.company_name, InsuranceProfile.id)
+    )]
+    # A skip scan over ix_doctor_profile_specialty: one index seek per distinct specialty, however many doctors
+    names = db.select(func.min(DoctorProfile.specialty).label('name')).where(DoctorProfile.specialty > '').cte(
+        'specialties', recursive=True)
+    names = names.union_all(
+        db.select(db.select(func.min(DoctorProfile.specialty)).where(DoctorProfile.specialty > names.c.name).scalar_subquery())
+        .where(names.c.name.is_not(None))
+    )
+    specialties = db.session.scalars(db.select(names.c.name).where(names.c.name.is_not(None))).all()
+    content = {'insurers': insurers, 'specialties': specialties}
+    content['version'] = hashlib.sha1(json.dumps(content, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+    return content
+
+def get_reference_data():
+    """Returns {'insurers': [[id, name], ...], 'specialties': [...], 'version': str}."""
+    now, region = time.monotonic(), shards.current_region()
+    with _reference_data_lock:
+        expires, data = _reference_data.get(region, (0.0, None))
+        if data is not None and expires > now:
+            return data
+    data = load_reference_data()
+    with _reference_data_lock:
+        _reference_data[region] = (now + current_app.config['REFERENCE_DATA_TTL'], data)
+    return data
+
+def invalidate_reference_data():
+    with _reference_data_lock:
+        _reference_data.pop(shards.current_region(), None)
+
+def insurer_choices():
+    """(value, label) for the registration form's insurer list.
+
+    Sharded, insurers from every region are listed by name and region, and each value
+    carries its region so register() can check it is the patient's own.
+    """
+    if not shards.is_sharded():
+        return get_reference_data()['insurers']
+    choices = [(shards.qualify_id(insurer_id, region), f'{name} ({region})' if region else name)
+               for region, data in shards.fan_out(get_reference_data).items() for insurer_id, name in data['insurers']]
+    return sorted(choices, key=lambda choice: choice[1])
+
+# --- NEW: Compiled doctor schedules (see schedule.py) ---
+# A doctor's sessions for a date are compiled from their weekly blocks and that date's
+# exceptions, then kept in a bounded LRU keyed by (doctor id, schedule_version, date).
+# Schedule edits call bump_schedule_version(), so like the invoice cache, every worker
+# stops using the old entries as soon as it reads the new version.
+_schedule_cache = OrderedDict()
+_schedule_cache_lock = threading.Lock()
+
+def bump_schedule_version(doctor):
+    doctor.schedule_version = (doctor.schedule_version or 0) + 1
+
+def compile_day_schedule(doctor, day):
+    blocks = db.session.execute(
+        db.select(ScheduleBlock.start_time, ScheduleBlock.end_time, ScheduleBlock.slot_duration_minutes, ScheduleBlock.location)
+        .where(ScheduleBlock.doctor_id == doctor.id, ScheduleBlock.weekday == day.weekday())
+    ).all()
+    default = None
+    if not blocks and not db.session.scalar(db.select(ScheduleBlock.id).where(ScheduleBlock.doctor_id == doctor.id).limit(1)):
+        # No weekly template: the doctor's single set of daily hours applies
+        if not doctor.availability_start_time or not doctor.availability_end_time or not doctor.slot_duration_minutes:
+            default = (0, 0, 1) # Availability not set up: nothing to offer
+        else:
+            default = (schedule.to_minutes(doctor.availability_start_time), schedule.to_minutes(doctor.availability_end_time),
+                       doctor.slot_duration_minutes)
+    exceptions = db.session.execute(
+        db.select(ScheduleException.kind, ScheduleException.start_time, ScheduleException.end_time,
+                  ScheduleException.slot_duration_minutes, ScheduleException.location)
+        .where(ScheduleException.doctor_id == doctor.id, ScheduleException.date == day)
+    ).all()
+    return schedule.compile_day(
+        [(schedule.to_minutes(start), schedule.to_minutes(end), slot, location) for start, end, slot, location in blocks],
+        [(kind, schedule.to_minutes(start) if start else None, schedule.to_minutes(end) if end else None,
+          slot or doctor.slot_duration_minutes or 30, location) for kind, start, end, slot, location in exceptions],
+        default,
+    )
+
+def get_day_schedule(doctor, day):
+    """The doctor's sessions on `day`: a sorted tuple of schedule.Session."""
+    key = shards.scoped((doctor.id, doctor.schedule_version or 0, day))
+    with _schedule_cache_lock:
+        sessions = _schedule_cache.get(key)
+        if sessions is not None:
+            _schedule_cache.move_to_end(key)
+            return sessions
+    sessions = compile_day_schedule(doctor, day)
+    with _schedule_cache_lock:
+        _schedule_cache[key] = sessions
+        _schedule_cache.move_to_end(key)
+        while len(_schedule_cache) > current_app.config['SCHEDULE_CACHE_SIZE']:
+            _schedule_cache.popitem(last=False)
+    return sessions
+
+def booked_intervals(doctor, day, sessions):
+    """Merged (start, end) minutes taken by the doctor's Pending or Confirmed appointments on `day`."""
+    booked_times = db.session.scalars(
+        db.select(Appointment.appointment_time)
+        .where(
+            Appointment.doctor_id == doctor.id,
+            # A plain range (not extract()) so the (doctor_id, appointment_time) index can be used
+            Appointment.appointment_time >= datetime.datetime.combine(day, datetime.time.min),
+            Appointment.appointment_time < datetime.datetime.combine(day + datetime.timedelta(days=1), datetime.time.min),
+            Appointment.status.in_(['Pending', 'Confirmed'])
+        )
+    ).all()
+    return schedule.busy_intervals(sessions, [schedule.to_minutes(t) for t in booked_times], doctor.slot_duration_minutes or 30)
+
+def parse_schedule_times(form, required=True):
+    """(start, end, slot minutes) from a schedule form, or raises ValueError with a message for the doctor."""
+    start_str, end_str = form.get('start_time'), form.get('end_time')
+    if not start_str and not end_str and not required:
+        return None, None, None
+    if not start_str or not end_str:
+        raise ValueError('Start time and end time are required.')
+    try:
+        start_time, end_time = datetime.time.fromisoformat(start_str), datetime.time.fromisoformat(end_str)
+        duration = int(form.get('slot_duration') or 30)
+    except ValueError:
+        raise ValueError('Invalid times or slot duration.')
+    if start_time >= end_time:
+        raise ValueError('Start time must be before end time.')
+    if duration < 10:
+        raise ValueError('Slot duration must be at least 10 minutes.')
+    return start_time, end_time, duration
+
+# --- NEW: Read-through to archived history (see archive.py) ---
+def wants_history():
+    """True when a history view was asked to include archived rows (?history=all)."""
+    return request.args.get('history') == 'all'
+
+def get_appointment(appointment_id, include_archived=False):
+    apt = db.session.get(Appointment, appointment_id)
+    if apt is None and include_archived:
+        apt = db.session.get(ArchivedAppointment, appointment_id)
+    return apt
+
+def visited_doctor_ids(patient_id):
+    """Ids of every doctor the patient has had an appointment with, archived or not."""
+    return set(db.session.scalars(
+        db.union(
+            db.select(Appointment.doctor_id).where(Appointment.patient_id == patient_id),
+            db.select(ArchivedAppointment.doctor_id).where(ArchivedAppointment.patient_id == patient_id)
+        )
+    ))
+
+
+# --- NEW: Dashboard change feed (see events.py) ---
+def publish_appointment_change(apt):
+    """Tells the doctor's and the insurer's open dashboards that an appointment changed. Call after commit."""
+    channels = [shards.scoped(('doctor', apt.doctor_id))]
+    claim = apt.invoice.claim if apt.invoice else None
+    if claim:
+        channels.append(shards.scoped(('insurance', claim.insurer_id)))
+    feed.publish(channels, {'appointment_id': apt.id})
+
+def render_appointment_change(role, profile_id, appointment_id):
+    """The dashboard section an appointment now belongs in and its rendered HTML, as the client applies them."""
+    apt = read_models.appointment_row(appointment_id)
+    change = {'id': appointment_id, 'section': None, 'html': ''}
+    if role == 'doctor' and apt and apt.doctor_id == profile_id:
+        change['section'] = f'apts-{apt.status}'
+        change['html'] = render_template('_doctor_appointment.html', apt=apt)
+    elif role == 'insurance' and apt and apt.insurance_id == profile_id:
+        if apt.insurance_claim_status == 'Pending':
+            change['section'] = 'claims-pending'
+        elif apt.insurance_claim_status in ('Accepted', 'Rejected'):
+            change['section'] = 'claims-processed'
+        if change['section']:
+            change['html'] = render_template('_insurance_claim.html', claim=apt)
+    return change
+
+# --- NEW: Background tasks (run by `flask jobs-worker`, see jobs.py) ---
+# Routes enqueue these after their own commit. Tasks may run more than once, so each
+# one checks whether its work is still needed or already done.
+@jobs.task('render_invoice')
+def render_invoice_task(appointment_id, bill_version):
+    """Renders an invoice into INVOICE_DIR so the first view doesn't pay for FPDF."""
+    apt = db.session.get(Appointment, appointment_id)
+    invoice = billing.get_invoice(appointment_id)
+    if not apt or not invoice or invoice.version != bill_version:
+        return {'skipped': 'bill changed since the job was queued'}
+    key = invoice_key(invoice)
+    path = invoice_file_path(key)
+    if not os.path.exists(path):
+        pdf_content = render_invoice_pdf(build_invoice_data(apt, invoice, latest_related_record(apt)))
+        os.makedirs(invoice_dir(apt.id), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(pdf_content)
+        os.replace(tmp_path, path) # Readers never see a half-written PDF
+    for name in os.listdir(invoice_dir(apt.id)): # Older versions and records can no longer be requested
+        if name != os.path.basename(path) and not name.endswith('.tmp'):
+            try:
+                os.remove(os.path.join(invoice_dir(apt.id), name))
+            except FileNotFoundError:
+                pass
+    return {'path': os.path.relpath(path, current_app.config['INVOICE_DIR'])}
+
+@jobs.task('fingerprint_upload')
+def fingerprint_upload_task(file_id):
+    """Records the size and SHA-256 of an uploaded file."""
+    medical_file = db.session.get(MedicalFile, file_id)
+    if not medical_file:
+        return {'skipped': 'file row deleted'}
+    digest, size = hashlib.sha256(), 0
+    with open(os.path.join(current_app.config['UPLOAD_FOLDER'], medical_file.filename), 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+            size += len(chunk)
+    medical_file.size_bytes, medical_file.sha256 = size, digest.hexdigest()
+    db.session.commit()
+    return {'size_bytes': size, 'sha256': medical_file.sha256}
+
+@jobs.task('archive_history')
+def archive_history_task(days=None):
+    """Moves settled history older than `days` (default ARCHIVE_AFTER_DAYS) to the archive tables."""
+    cutoff = datetime.datetime.now() - datetime.timedelta(days=days or current_app.config['ARCHIVE_AFTER_DAYS'])
+    return archive.archive_history(cutoff, batch_size=current_app.config['ARCHIVE_BATCH_SIZE'])
 
-@app.route("/")
+def enqueue_invoice_render(invoice):
+    jobs.enqueue('render_invoice', {'appointment_id': invoice.appointment_id, 'bill_version': invoice.version},
+                 idempotency_key=f'render_invoice:{invoice.appointment_id}:v{invoice.version}')
+
+@bp.route("/")
 def home():
     return render_template('home.html')
 
-@app.route("/register", methods=['GET', 'POST'])
+@bp.route("/register", methods=['GET', 'POST'])
 def register():
     if current_user.is_authenticated:
-        return redirect(url_for('dashboard'))
+        return redirect(url_for('main.dashboard'))
     
     if request.method == 'POST':
         email = request.form.get('email')
@@ -208,10 +632,24 @@ def register():
         address = request.form.get('address')
         pincode = request.form.get('pincode')
         
-        existing_user = db.session.scalar(db.select(User).where(User.email == email))
+        existing_user = find_user_by_email(email)
         if existing_user:
             flash('Email already registered. Please log in.', 'danger')
-            return redirect(url_for('login'))
+            return redirect(url_for('main.login'))
+
+        # --- NEW: The account is created in its pincode's region (see shards.py) ---
+        region = shards.region_for_pincode(pincode)
+        company_id = None
+        if role == 'patient' and request.form.get('insurance_company_id'):
+            try:
+                company_region, company_id = shards.parse_id(request.form.get('insurance_company_id'))
+                listed = company_region == region
+            except ValueError: # Not an id from the form's list at all
+                listed = False
+            if not listed:
+                flash('That insurance company does not cover your pincode. Please choose one listed for your region.', 'danger')
+                return redirect(url_for('main.register'))
+        shards.set_region(region)
 
         hashed_password = bcrypt.generate_password_hash(password).decode('utf-8')
         new_user = User(email=email, password_hash=hashed_password, role=role)
@@ -221,7 +659,6 @@ def register():
         if role == 'patient':
             # --- NEW: Get optional insurance info ---
             policy_id = request.form.get('insurance_policy_id')
-            company_id = request.form.get('insurance_company_id')
             profile = PatientProfile(
                 full_name=full_name, 
                 phone=phone, 
@@ -229,7 +666,7 @@ def register():
                 pincode=pincode, 
                 user_id=new_user.id,
                 insurance_policy_id=policy_id if policy_id else None,
-                insurance_company_id=int(company_id) if company_id else None
+                insurance_company_id=company_id
             )
         elif role == 'doctor':
             # --- UPDATED: Set default availability ---
@@ -251,91 +688,108 @@ def register():
         if profile:
             db.session.add(profile)
             db.session.commit()
+            if role in ('doctor', 'insurance'):
+                invalidate_reference_data() # New insurer or possibly a new specialty
+            if role == 'doctor':
+                autocomplete.invalidate()
             flash(f'Account created for {email} as a {role}. You can now log in.', 'success')
-            return redirect(url_for('login'))
+            return redirect(url_for('main.login'))
         else:
             flash('Error creating profile.', 'danger')
             db.session.delete(new_user)
             db.session.commit()
-            return redirect(url_for('register'))
+            return redirect(url_for('main.register'))
+
+    # --- UPDATED: Insurance companies and specialties come from the reference-data cache ---
+    return render_template('register.html', reference_data=get_reference_data(), insurer_choices=insurer_choices())
 
-    # --- NEW: Get insurance companies for dropdown ---
-    insurance_companies = db.session.scalars(db.select(InsuranceProfile)).all()
-    return render_template('register.html', insurance_companies=insurance_companies)
 
+def find_user_by_email(email):
+    """The account with this email, or None. Sharded, every region is asked at once and the
+    account's region becomes the request's, so login_user() records it in the session."""
+    found = shards.fan_out(lambda: db.session.scalar(db.select(User).where(User.email == email)))
+    for region, user in found.items():
+        if user is not None:
+            shards.set_region(region)
+            return db.session.merge(user, load=False) # Found in another session when sharded
+    return None
 
-@app.route("/login", methods=['GET', 'POST'])
+@bp.route("/login", methods=['GET', 'POST'])
 def login():
     # ... (This route is unchanged) ...
     if current_user.is_authenticated:
-        return redirect(url_for('dashboard'))
+        return redirect(url_for('main.dashboard'))
     
     if request.method == 'POST':
         email = request.form.get('email')
         password = request.form.get('password')
-        user = db.session.scalar(db.select(User).where(User.email == email))
+        user = find_user_by_email(email)
         
         if user and bcrypt.check_password_hash(user.password_hash, password):
             login_user(user, remember=True)
-            return redirect(url_for('dashboard'))
+            return redirect(url_for('main.dashboard'))
         else:
             flash('Login unsuccessful. Please check email and password.', 'danger')
     return render_template('login.html')
 
-@app.route("/logout")
+@bp.route("/logout")
 @login_required
 def logout():
     # ... (This route is unchanged) ...
     logout_user()
     flash('You have been logged out.', 'info')
-    return redirect(url_for('home'))
+    return redirect(url_for('main.home'))
 
-@app.route("/dashboard")
+@bp.route("/dashboard")
 @login_required
 def dashboard():
     # ... (This route is unchanged) ...
     if current_user.role == 'patient':
-        return redirect(url_for('patient_dashboard'))
+        return redirect(url_for('main.patient_dashboard'))
     elif current_user.role == 'doctor':
-        return redirect(url_for('doctor_dashboard'))
+        return redirect(url_for('main.doctor_dashboard'))
     elif current_user.role == 'insurance':
-        return redirect(url_for('insurance_dashboard'))
+        return redirect(url_for('main.insurance_dashboard'))
     else:
         return "Error: Unknown user role.", 403
 
 # --- Patient Routes (UPDATED) ---
-@app.route("/patient_dashboard")
+@bp.route("/patient_dashboard")
 @login_required
 @role_required('patient')
 def patient_dashboard():
-    # ... (This route logic is unchanged) ...
-    records = g.profile.records.all()
-    files = g.profile.files.all()
-    timeline_items = sorted(records + files, key=lambda x: x.created_at, reverse=True)
+    # --- UPDATED: Read-only rows (see read_models.py) instead of ORM objects ---
+    show_history = wants_history()
+    timeline_items = read_models.patient_timeline(g.profile.id, include_archived=show_history)
     
     # --- UPDATED: Get all appointments for billing ---
-    all_appointments = g.profile.appointments.order_by(Appointment.appointment_time.desc()).all()
+    all_appointments = read_models.patient_appointments(g.profile.id, include_archived=show_history)
     
     # --- Review logic now uses the `all_appointments` list ---
     completed_apts = [apt for apt in all_appointments if apt.status == 'Completed']
-    reviewed_doctor_ids = {review.doctor_id for review in g.profile.reviews.all()}
+    reviewed_doctor_ids = set(db.session.scalars(db.select(DoctorReview.doctor_id).where(DoctorReview.patient_id == g.profile.id)))
     doctors_to_review = []
     seen_doctor_ids = set()
     for apt in completed_apts:
         if apt.doctor_id not in reviewed_doctor_ids and apt.doctor_id not in seen_doctor_ids:
-            doctors_to_review.append(apt.doctor)
+            doctors_to_review.append(read_models.DoctorSummary(apt.doctor_id, apt.doctor_name, apt.doctor_specialty))
             seen_doctor_ids.add(apt.doctor_id)
 
-    doctor_ids = {apt.doctor_id for apt in g.profile.appointments.all()}
-    permissioned_doctors = {doc.id for doc in g.profile.permitted_doctors}
-    doctors = db.session.scalars(db.select(DoctorProfile).where(DoctorProfile.id.in_(doctor_ids))).all()
+    doctor_ids = visited_doctor_ids(g.profile.id)
+    permissioned_doctors = set(db.session.scalars(
+        db.select(patient_doctor_permissions.c.doctor_id).where(patient_doctor_permissions.c.patient_id == g.profile.id)
+    ))
+    doctors = list(read_models.doctor_summaries(doctor_ids).values())
 
     return render_template('patient_dashboard.html', 
+                           reference_data=get_reference_data(),
                            timeline_items=timeline_items, 
                            doctors=doctors, 
                            permissioned_doctors=permissioned_doctors,
                            doctors_to_review=doctors_to_review,
-                           appointments=all_appointments) # <-- Pass all appointments for billing
+                           appointments=all_appointments, # <-- Pass all appointments for billing
+                           home_region=shards.current_region(),
+                           show_history=show_history)
 
 # --- REMOVED: Route for patient to accept/reject appointment ---
 # (The entire 'patient_appointment_action' route has been deleted)
@@ -343,7 +797,7 @@ def patient_dashboard():
 
 # --- NEW: Bill Payment Routes ---
 
-@app.route("/pay_bill/<int:appointment_id>", methods=['GET'])
+@bp.route("/pay_bill/<int:appointment_id>", methods=['GET'])
 @login_required
 @role_required('patient')
 def pay_bill(appointment_id):
@@ -352,16 +806,15 @@ def pay_bill(appointment_id):
         abort(404)
     if apt.patient_id != g.profile.id:
         abort(403) # Not this patient's bill
-    if apt.bill_status != 'Unpaid':
+    invoice = billing.get_invoice(apt.id)
+    if not invoice or invoice.status not in billing.PAYABLE:
         flash('This bill is not currently marked as unpaid.', 'info')
-    if apt.bill_status not in ['Unpaid', 'Rejected']: # <-- Allow payment if Unpaid or Rejected
-        flash('This bill is not currently marked as unpaid.', 'info')
-        return redirect(url_for('patient_dashboard'))
+        return redirect(url_for('main.patient_dashboard'))
     
     # --- REMOVED: No longer need to query all companies ---
-    return render_template('pay_bill.html', apt=apt)
+    return render_template('pay_bill.html', apt=apt, invoice=invoice)
 
-@app.route("/pay_upi/<int:appointment_id>")
+@bp.route("/pay_upi/<int:appointment_id>")
 @login_required
 @role_required('patient')
 def pay_upi(appointment_id):
@@ -372,16 +825,19 @@ def pay_upi(appointment_id):
     if apt.patient_id != g.profile.id:
         abort(403)
     
-    if apt.bill_status in ['Unpaid', 'Rejected']: # <-- Allow payment if Unpaid or Rejected
-        apt.bill_status = 'Paid'
+    # --- UPDATED: Payments are recorded against the invoice (see billing.py) ---
+    invoice = billing.get_invoice(apt.id)
+    if billing.record_payment(invoice, 'upi', current_user.id):
         db.session.commit()
+        publish_appointment_change(apt)
+        enqueue_invoice_render(invoice)
         flash('Payment successful! Thank you.', 'success')
     else:
         flash('This bill is not currently marked as unpaid.', 'info')
         
-    return redirect(url_for('patient_dashboard'))
+    return redirect(url_for('main.patient_dashboard'))
 
-@app.route("/claim_insurance/<int:appointment_id>", methods=['POST']) # <-- UPDATED to POST
+@bp.route("/claim_insurance/<int:appointment_id>", methods=['POST']) # <-- UPDATED to POST
 @login_required
 @role_required('patient')
 def claim_insurance(appointment_id):
@@ -397,55 +853,83 @@ def claim_insurance(appointment_id):
 
     if not g.profile.insurance_policy_id or not g.profile.insurance_company_id:
         flash('You do not have an insurance policy registered on your profile.', 'danger')
-        return redirect(url_for('pay_bill', appointment_id=appointment_id))
+        return redirect(url_for('main.pay_bill', appointment_id=appointment_id))
         
     if submitted_policy_id != g.profile.insurance_policy_id:
         flash('The Policy ID you entered does not match the ID on your profile.', 'danger')
-        return redirect(url_for('pay_bill', appointment_id=appointment_id))
+        return redirect(url_for('main.pay_bill', appointment_id=appointment_id))
     # --- END NEW VALIDATION ---
     
-    if apt.bill_status in ['Unpaid', 'Rejected']:
-        apt.bill_status = 'Pending Insurance'
-        apt.insurance_id = g.profile.insurance_company_id # <-- NEW: Link claim to patient's company
-        apt.insurance_claim_status = 'Pending' # <-- NEW: Set claim status
+    invoice = billing.get_invoice(apt.id)
+    if billing.submit_claim(invoice, g.profile.insurance_company_id, submitted_policy_id, current_user.id):
         db.session.commit()
+        publish_appointment_change(apt)
+        enqueue_invoice_render(invoice)
         flash(f'Bill claim submitted to {g.profile.insurance_company.company_name} for processing.', 'info')
     else:
         flash('This bill cannot be claimed at this time.', 'info')
         
-    return redirect(url_for('patient_dashboard'))
+    return redirect(url_for('main.patient_dashboard'))
 
 
-# --- REFACTORED/FIXED SEARCH ROUTE ---
-@app.route("/search_doctors", methods=['POST'])
-@login_required
-@role_required('patient')
-def search_doctors():
-    # --- FIXED: Get new form fields ---
-    specialty = request.form.get('specialty')
-    min_rating = int(request.form.get('min_rating', 1)) # Form default is 1
-    sort_by = request.form.get('sort_by', 'default') # <-- FIXED: Default to 'default'
+# --- NEW: Search logic shared with the JSON API ---
+def find_doctors(patient, specialty=None, min_rating=1, sort_by='default'):
+    """Doctor search shared by the search page and the JSON API.
+
+    Returns (doctor, avg_overall, avg_cost, avg_hospitality, distance_km) tuples, where
+    doctor is a read_models.DoctorSearchRow. When the app is sharded, every region is
+    searched in parallel and the results are merged before sorting.
+    """
+    patient_loc_missing = not patient.latitude or not patient.longitude
+    patient_coords = None if patient_loc_missing else (patient.latitude, patient.longitude)
+
+    final_results = [result for results in shards.fan_out(find_doctors_in_region, patient_coords, specialty, min_rating).values()
+                     for result in results]
+
+    # --- FIXED: Make sorting optional ---
+    # 5. Sort the results in Python
+    if sort_by == 'distance':
+        if patient_loc_missing:
+            # Fallback to sorting by rating
+            final_results.sort(key=lambda x: (x[1] is None, x[1]), reverse=True)
+        else:
+            # Sort by distance (index 4), putting "None" distances at the end
+            final_results.sort(key=lambda x: (x[4] is None, x[4]))
+    elif sort_by == 'rating': # Make this an explicit check
+        # Sort by rating (index 1), putting "None" ratings at the end
+        final_results.sort(key=lambda x: (x[1] is None, x[1]), reverse=True)
+    # else: (if sort_by is 'default') ... do nothing. The results will be in DB order.
     # --- END FIX ---
 
-    # Handle missing patient location
-    patient_loc_missing = False # <-- FIX: Initialize variable
-    patient_coords = None # <-- FIX: Initialize variable
-    if not g.profile.latitude or not g.profile.longitude:
-        flash('Please update your profile with a valid address to use the distance search. Distances are not available.', 'info')
-        patient_loc_missing = True
-    else:
-        patient_coords = (g.profile.latitude, g.profile.longitude)
+    return final_results
+
+def find_doctors_in_region(patient_coords, specialty, min_rating):
+    """find_doctors() for the current region's doctors, unsorted."""
+    from geopy.distance import great_circle # Imported on first use; only search needs geopy
+    region = shards.current_region()
+
+    # --- UPDATED: The specialty matches as a case-insensitive prefix ("cardio" finds Cardiologist). SQLite's
+    # LIKE is case-insensitive, so a pattern without a leading wildcard is a range seek on
+    # ix_doctor_profile_specialty_nocase, and the reviews are read from ix_doctor_review_doctor_ratings. ---
+    doctor_filter = None
+    if specialty and specialty.strip():
+        pattern = specialty.strip().replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        doctor_filter = DoctorProfile.specialty.like(pattern, escape='\\')
 
     avg_ratings_subquery = db.select(
         DoctorReview.doctor_id,
         func.avg(DoctorReview.overall_rating).label('avg_overall'),
         func.avg(DoctorReview.cost_rating).label('avg_cost'),
         func.avg(DoctorReview.hospitality_rating).label('avg_hospitality')
-    ).group_by(DoctorReview.doctor_id).subquery()
+    ).group_by(DoctorReview.doctor_id)
+    if doctor_filter is not None:
+        avg_ratings_subquery = avg_ratings_subquery.where(DoctorReview.doctor_id.in_(db.select(DoctorProfile.id).where(doctor_filter)))
+    avg_ratings_subquery = avg_ratings_subquery.subquery()
 
     # --- SYNTAX FIX: Correctly structure the .select().join() ---
     query = db.select(
-        DoctorProfile,
+        DoctorProfile.id, DoctorProfile.full_name, DoctorProfile.specialty, DoctorProfile.practice_address,
+        DoctorProfile.pincode, DoctorProfile.latitude, DoctorProfile.longitude,
         avg_ratings_subquery.c.avg_overall,
         avg_ratings_subquery.c.avg_cost,
         avg_ratings_subquery.c.avg_hospitality
@@ -456,8 +940,8 @@ def search_doctors():
     )
     # --- END SYNTAX FIX ---
 
-    if specialty:
-        query = query.where(DoctorProfile.specialty.ilike(f'%{specialty}%'))
+    if doctor_filter is not None:
+        query = query.where(doctor_filter)
 
     # --- FIXED: Handle min_rating to include NULLs (unrated) ---
     if min_rating > 1: # The form default is 1. Only filter if user selects 2 or more.
@@ -473,7 +957,7 @@ def search_doctors():
     
     final_results = []
     for row in results:
-        doctor = row.DoctorProfile
+        doctor = read_models.DoctorSearchRow(*row[:7], region=region)
         avg_overall = row.avg_overall
         avg_cost = row.avg_cost
         avg_hospitality = row.avg_hospitality
@@ -484,24 +968,28 @@ def search_doctors():
             distance_km = great_circle(patient_coords, doctor_coords).km
         
         final_results.append((doctor, avg_overall, avg_cost, avg_hospitality, distance_km))
-    
-    # --- FIXED: Make sorting optional ---
-    # 5. Sort the results in Python
-    if sort_by == 'distance':
-        if patient_loc_missing:
-            # Fallback to sorting by rating
-            final_results.sort(key=lambda x: (x[1] is None, x[1]), reverse=True)
-        else:
-            # Sort by distance (index 4), putting "None" distances at the end
-            final_results.sort(key=lambda x: (x[4] is None, x[4]))
-    elif sort_by == 'rating': # Make this an explicit check
-        # Sort by rating (index 1), putting "None" ratings at the end
-        final_results.sort(key=lambda x: (x[1] is None, x[1]), reverse=True)
-    # else: (if sort_by is 'default') ... do nothing. The results will be in DB order.
+    return final_results
+
+# --- REFACTORED/FIXED SEARCH ROUTE ---
+@bp.route("/search_doctors", methods=['POST'])
+@login_required
+@role_required('patient')
+def search_doctors():
+    # --- FIXED: Get new form fields ---
+    specialty = request.form.get('specialty')
+    min_rating = int(request.form.get('min_rating', 1)) # Form default is 1
+    sort_by = request.form.get('sort_by', 'default') # <-- FIXED: Default to 'default'
     # --- END FIX ---
 
+    # Handle missing patient location
+    if not g.profile.latitude or not g.profile.longitude:
+        flash('Please update your profile with a valid address to use the distance search. Distances are not available.', 'info')
+
+    final_results = find_doctors(g.profile, specialty, min_rating, sort_by)
+
     return render_template('search_results.html', 
                            results=final_results, 
+                           home_region=shards.current_region(), 
                            specialty=specialty, 
                            min_rating=min_rating,
                            sort_by=sort_by)
@@ -511,54 +999,29 @@ def get_available_slots(doctor, selected_date):
     """
     Calculates the available appointment slots for a given doctor on a specific date.
     """
-    if not doctor.availability_start_time or not doctor.availability_end_time or not doctor.slot_duration_minutes:
-        return [] # Doctor has not set up their availability
+    # --- UPDATED: Slots come from the compiled schedule minus booked and past time ---
+    sessions = get_day_schedule(doctor, selected_date)
+    if not sessions:
+        return [] # Day off, or the doctor has not set up their availability
 
-    # Get all 'Pending' or 'Confirmed' appointments for this doctor on this day
-    booked_appointments = db.session.scalars(
-        db.select(Appointment)
-        .where(
-            Appointment.doctor_id == doctor.id,
-            extract('year', Appointment.appointment_time) == selected_date.year,
-            extract('month', Appointment.appointment_time) == selected_date.month,
-            extract('day', Appointment.appointment_time) == selected_date.day,
-            Appointment.status.in_(['Pending', 'Confirmed'])
-        )
-    ).all()
-    
-    # Create a set of booked datetimes for fast lookup
-    booked_times = {apt.appointment_time for apt in booked_appointments}
-
-    available_slots = []
-    
-    # Combine the selected date with the doctor's start time
-    current_slot_time = datetime.datetime.combine(selected_date, doctor.availability_start_time)
-    
-    # Combine the selected date with the doctor's end time
-    end_time = datetime.datetime.combine(selected_date, doctor.availability_end_time)
-    
-    slot_delta = datetime.timedelta(minutes=doctor.slot_duration_minutes)
     now = datetime.datetime.now()
-
-    while current_slot_time < end_time:
-        # Check if the slot is in the future and not in the booked set
-        if current_slot_time > now and current_slot_time not in booked_times:
-            available_slots.append(current_slot_time)
-        
-        current_slot_time += slot_delta
-
-    return available_slots
+    if selected_date < now.date():
+        return []
+    not_before = schedule.to_minutes(now) + 1 if selected_date == now.date() else 0
+    free = schedule.free_slots(sessions, booked_intervals(doctor, selected_date, sessions), not_before)
+    midnight = datetime.datetime.combine(selected_date, datetime.time.min)
+    return [midnight + datetime.timedelta(minutes=minute) for minute in free]
 
 
 # --- HEAVILY UPDATED BOOKING ROUTE ---
-@app.route("/book_appointment/<int:doctor_id>", methods=['GET', 'POST'])
+@bp.route("/book_appointment/<int:doctor_id>", methods=['GET', 'POST'])
 @login_required
 @role_required('patient')
 def book_appointment(doctor_id):
     doctor = db.session.get(DoctorProfile, doctor_id)
     if not doctor:
         flash('Doctor not found.', 'danger')
-        return redirect(url_for('patient_dashboard'))
+        return redirect(url_for('main.patient_dashboard'))
 
     # --- POST: Handle the booking submission ---
     if request.method == 'POST':
@@ -568,19 +1031,21 @@ def book_appointment(doctor_id):
             
             if apt_time < datetime.datetime.now():
                 flash('Cannot book an appointment in the past.', 'danger')
-                return redirect(url_for('book_appointment', doctor_id=doctor.id, date=apt_time.date().isoformat()))
+                return redirect(url_for('main.book_appointment', doctor_id=doctor.id, date=apt_time.date().isoformat()))
+
+            # --- UPDATED: The time must be a slot in the doctor's schedule ---
+            sessions = get_day_schedule(doctor, apt_time.date())
+            minute = schedule.to_minutes(apt_time)
+            session = schedule.session_at(sessions, minute)
+            if session is None or apt_time.second or apt_time.microsecond:
+                flash('That time is not one of the doctor\'s available slots.', 'danger')
+                return redirect(url_for('main.book_appointment', doctor_id=doctor.id, date=apt_time.date().isoformat()))
 
-            # --- NEW: Check if this *exact* slot is already taken ---
+            # --- UPDATED: Check the slot does not overlap a booked one ---
             # This is a critical check to prevent double-booking
-            existing_apt = db.session.scalar(db.select(Appointment).where(
-                Appointment.doctor_id == doctor.id,
-                Appointment.appointment_time == apt_time,
-                Appointment.status.in_(['Pending', 'Confirmed'])
-            ))
-            
-            if existing_apt:
+            if schedule.overlaps(booked_intervals(doctor, apt_time.date(), sessions), minute, minute + session.slot):
                 flash(f'This slot ({apt_time.strftime("%I:%M %p")}) was just booked by someone else. Please select a different slot.', 'danger')
-                return redirect(url_for('book_appointment', doctor_id=doctor.id, date=apt_time.date().isoformat()))
+                return redirect(url_for('main.book_appointment', doctor_id=doctor.id, date=apt_time.date().isoformat()))
             # --- END NEW CHECK ---
 
             new_apt = Appointment(
@@ -591,15 +1056,21 @@ def book_appointment(doctor_id):
             )
             db.session.add(new_apt)
             db.session.commit()
+            publish_appointment_change(new_apt)
             flash(f'Appointment request sent to {doctor.full_name} for {apt_time.strftime("%Y-%m-%d %I:%M %p")}.', 'success')
-            return redirect(url_for('patient_dashboard'))
+            return redirect(url_for('main.patient_dashboard'))
         
         except ValueError:
             flash('Invalid slot selected.', 'danger')
+        except OperationalError:
+            # --- NEW: Lock contention is not a double booking; tell the patient to retry ---
+            db.session.rollback()
+            flash('The booking system is busy right now. Please try again in a moment.', 'danger')
+            return redirect(url_for('main.book_appointment', doctor_id=doctor_id))
         except Exception as e:
             db.session.rollback() # Rollback if the unique constraint fails
             flash(f'An error occurred. It\'s possible this slot was just booked. Please try again.', 'danger')
-            return redirect(url_for('book_appointment', doctor_id=doctor_id))
+            return redirect(url_for('main.book_appointment', doctor_id=doctor_id))
 
     # --- GET: Show available slots for a given date ---
     selected_date_str = request.args.get('date')
@@ -619,24 +1090,27 @@ def book_appointment(doctor_id):
     # --- NEW: Get today's date for the min attribute ---
     today_date = datetime.date.today().isoformat()
     
-    # Fetch reviews for this doctor (unchanged)
-    reviews = doctor.reviews.order_by(DoctorReview.created_at.desc()).all()
+    # One page of reviews plus the cached summary, instead of every review on each date change
+    reviews, older_reviews_before = get_review_page(doctor.id, request.args.get('reviews_before', type=int))
     
     return render_template('book_appointment.html', 
                            doctor=doctor, 
                            reviews=reviews,
+                           rating_summary=get_rating_summary(doctor.id),
+                           older_reviews_before=older_reviews_before,
+                           showing_older_reviews='reviews_before' in request.args,
                            selected_date=selected_date,
                            available_slots=available_slots,
                            today_date=today_date) # <-- Pass today's date to the template
 
 # (Manage Permissions Route is Unchanged)
-@app.route("/manage_permissions", methods=['POST'])
+@bp.route("/manage_permissions", methods=['POST'])
 @login_required
 @role_required('patient')
 def manage_permissions():
     # ... (This route is unchanged) ...
     selected_doctor_ids = request.form.getlist('doctor_ids', type=int)
-    all_seen_doctors_ids = {apt.doctor_id for apt in g.profile.appointments.all()}
+    all_seen_doctors_ids = visited_doctor_ids(g.profile.id)
     all_seen_doctors = db.session.scalars(db.select(DoctorProfile).where(DoctorProfile.id.in_(all_seen_doctors_ids))).all()
     
     g.profile.permitted_doctors.clear()
@@ -646,11 +1120,11 @@ def manage_permissions():
             
     db.session.commit()
     flash('Permissions updated successfully.', 'success')
-    return redirect(url_for('patient_dashboard'))
+    return redirect(url_for('main.patient_dashboard'))
 
 
 # (Leave Review Route is Unchanged)
-@app.route("/leave_review/<int:doctor_id>", methods=['GET', 'POST'])
+@bp.route("/leave_review/<int:doctor_id>", methods=['GET', 'POST'])
 @login_required
 @role_required('patient')
 def leave_review(doctor_id):
@@ -658,17 +1132,21 @@ def leave_review(doctor_id):
     doctor = db.session.get(DoctorProfile, doctor_id)
     if not doctor:
         flash('Doctor not found.', 'danger')
-        return redirect(url_for('patient_dashboard'))
+        return redirect(url_for('main.patient_dashboard'))
 
     had_completed_apt = db.session.scalar(db.select(Appointment).where(
         Appointment.patient_id == g.profile.id,
         Appointment.doctor_id == doctor.id,
         Appointment.status == 'Completed'
+    ).limit(1)) or db.session.scalar(db.select(ArchivedAppointment.id).where(
+        ArchivedAppointment.patient_id == g.profile.id,
+        ArchivedAppointment.doctor_id == doctor.id,
+        ArchivedAppointment.status == 'Completed'
     ).limit(1))
     
     if not had_completed_apt:
         flash('You can only review doctors after a completed appointment.', 'danger')
-        return redirect(url_for('patient_dashboard'))
+        return redirect(url_for('main.patient_dashboard'))
         
     existing_review = db.session.scalar(db.select(DoctorReview).where(
         DoctorReview.patient_id == g.profile.id,
@@ -677,7 +1155,7 @@ def leave_review(doctor_id):
     
     if existing_review:
         flash('You have already reviewed this doctor.', 'info')
-        return redirect(url_for('patient_dashboard'))
+        return redirect(url_for('main.patient_dashboard'))
 
     if request.method == 'POST':
         try:
@@ -701,8 +1179,10 @@ def leave_review(doctor_id):
             )
             db.session.add(new_review)
             db.session.commit()
+            invalidate_rating_summary(doctor.id)
+            autocomplete.invalidate() # The doctor's suggestion rank
             flash('Thank you! Your review has been submitted.', 'success')
-            return redirect(url_for('patient_dashboard'))
+            return redirect(url_for('main.patient_dashboard'))
         except ValueError as e:
             flash(f'Invalid input. {e}', 'danger')
         
@@ -710,12 +1190,12 @@ def leave_review(doctor_id):
 
 
 # --- Doctor Routes (UPDATED) ---
-@app.route("/doctor_dashboard")
+@bp.route("/doctor_dashboard")
 @login_required
 @role_required('doctor')
 def doctor_dashboard():
-    # ... (This route is unchanged) ...
-    appointments = g.profile.appointments.order_by(Appointment.appointment_time.asc()).all()
+    # --- UPDATED: Read-only rows with the patient and insurer names joined in (see read_models.py) ---
+    appointments = read_models.doctor_appointments(g.profile.id)
     pending_apts = [a for a in appointments if a.status == 'Pending']
     # --- REMOVED: waiting_patient_apts ---
     confirmed_apts = [a for a in appointments if a.status == 'Confirmed']
@@ -723,7 +1203,16 @@ def doctor_dashboard():
     # --- UPDATED: Show simple cancelled appointments ---
     cancelled_apts = [a for a in appointments if a.status == 'Cancelled']
     
+    # --- NEW: Weekly schedule and upcoming exceptions ---
+    schedule_blocks = g.profile.schedule_blocks.order_by(ScheduleBlock.weekday, ScheduleBlock.start_time).all()
+    schedule_exceptions = g.profile.schedule_exceptions.where(ScheduleException.date >= datetime.date.today()) \
+        .order_by(ScheduleException.date, ScheduleException.start_time).all()
+
     return render_template('doctor_dashboard.html', 
+                           schedule_blocks=schedule_blocks,
+                           schedule_exceptions=schedule_exceptions,
+                           weekdays=WEEKDAYS,
+                           today=datetime.date.today().isoformat(),
                            pending_apts=pending_apts, 
                            # --- REMOVED: waiting_patient_apts ---
                            confirmed_apts=confirmed_apts,
@@ -731,7 +1220,7 @@ def doctor_dashboard():
                            cancelled_apts=cancelled_apts) # <-- UPDATED
 
 # --- NEW: Route to manage availability ---
-@app.route("/manage_availability", methods=['POST'])
+@bp.route("/manage_availability", methods=['POST'])
 @login_required
 @role_required('doctor')
 def manage_availability():
@@ -742,14 +1231,14 @@ def manage_availability():
 
         if not start_time_str or not end_time_str:
             flash('Start time and end time are required.', 'danger')
-            return redirect(url_for('doctor_dashboard'))
+            return redirect(url_for('main.doctor_dashboard'))
 
         start_time = datetime.time.fromisoformat(start_time_str)
         end_time = datetime.time.fromisoformat(end_time_str)
 
         if start_time >= end_time:
             flash('Start time must be before end time.', 'danger')
-            return redirect(url_for('doctor_dashboard'))
+            return redirect(url_for('main.doctor_dashboard'))
         
         if duration < 10:
             flash('Slot duration must be at least 10 minutes.', 'danger')
@@ -758,6 +1247,7 @@ def manage_availability():
         g.profile.availability_start_time = start_time
         g.profile.availability_end_time = end_time
         g.profile.slot_duration_minutes = duration
+        bump_schedule_version(g.profile)
         
         db.session.commit()
         flash('Availability updated successfully.', 'success')
@@ -765,11 +1255,103 @@ def manage_availability():
     except Exception as e:
         flash(f'Error updating availability: {e}', 'danger')
     
-    return redirect(url_for('doctor_dashboard'))
+    return redirect(url_for('main.doctor_dashboard'))
+
+
+# --- NEW: Weekly schedule blocks and dated exceptions ---
+WEEKDAYS = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+
+@bp.route("/schedule/blocks", methods=['POST'])
+@login_required
+@role_required('doctor')
+def add_schedule_block():
+    try:
+        start_time, end_time, duration = parse_schedule_times(request.form)
+    except ValueError as e:
+        flash(str(e), 'danger')
+        return redirect(url_for('main.doctor_dashboard'))
+    weekdays = sorted({int(day) for day in request.form.getlist('weekdays') if day.isdigit()})
+    if not weekdays or any(day not in range(7) for day in weekdays):
+        flash('Choose at least one day of the week.', 'danger')
+        return redirect(url_for('main.doctor_dashboard'))
+
+    clashes = db.session.scalars(db.select(ScheduleBlock).where(
+        ScheduleBlock.doctor_id == g.profile.id, ScheduleBlock.weekday.in_(weekdays),
+        ScheduleBlock.start_time < end_time, ScheduleBlock.end_time > start_time
+    )).all()
+    if clashes:
+        flash(f'Those hours overlap your existing {WEEKDAYS[clashes[0].weekday]} session '
+              f'({clashes[0].start_time.strftime("%H:%M")}-{clashes[0].end_time.strftime("%H:%M")}).', 'danger')
+        return redirect(url_for('main.doctor_dashboard'))
+
+    location = request.form.get('location') or None
+    for day in weekdays:
+        db.session.add(ScheduleBlock(doctor_id=g.profile.id, weekday=day, start_time=start_time, end_time=end_time,
+                                     slot_duration_minutes=duration, location=location))
+    bump_schedule_version(g.profile)
+    db.session.commit()
+    flash('Weekly schedule updated.', 'success')
+    return redirect(url_for('main.doctor_dashboard'))
+
+@bp.route("/schedule/blocks/<int:block_id>/delete", methods=['POST'])
+@login_required
+@role_required('doctor')
+def delete_schedule_block(block_id):
+    block = db.session.get(ScheduleBlock, block_id)
+    if not block or block.doctor_id != g.profile.id:
+        abort(404)
+    db.session.delete(block)
+    bump_schedule_version(g.profile)
+    db.session.commit()
+    flash('Session removed from your weekly schedule.', 'success')
+    return redirect(url_for('main.doctor_dashboard'))
+
+@bp.route("/schedule/exceptions", methods=['POST'])
+@login_required
+@role_required('doctor')
+def add_schedule_exception():
+    kind = request.form.get('kind')
+    if kind not in ('available', 'unavailable'):
+        abort(400)
+    try:
+        day = datetime.date.fromisoformat(request.form.get('date', ''))
+    except ValueError:
+        flash('Invalid date.', 'danger')
+        return redirect(url_for('main.doctor_dashboard'))
+    try:
+        start_time, end_time, duration = parse_schedule_times(request.form, required=(kind == 'available'))
+    except ValueError as e:
+        flash(str(e), 'danger')
+        return redirect(url_for('main.doctor_dashboard'))
+    if day < datetime.date.today():
+        flash('Cannot change the schedule of a past date.', 'danger')
+        return redirect(url_for('main.doctor_dashboard'))
+
+    db.session.add(ScheduleException(doctor_id=g.profile.id, date=day, kind=kind, start_time=start_time, end_time=end_time,
+                                     slot_duration_minutes=duration if kind == 'available' else None,
+                                     location=request.form.get('location') or None,
+                                     reason=request.form.get('reason') or None))
+    bump_schedule_version(g.profile)
+    db.session.commit()
+    flash(f'Schedule for {day.strftime("%A, %B %d")} updated. Existing appointments are not changed.', 'success')
+    return redirect(url_for('main.doctor_dashboard'))
+
+@bp.route("/schedule/exceptions/<int:exception_id>/delete", methods=['POST'])
+@login_required
+@role_required('doctor')
+def delete_schedule_exception(exception_id):
+    exception = db.session.get(ScheduleException, exception_id)
+    if not exception or exception.doctor_id != g.profile.id:
+        abort(404)
+    db.session.delete(exception)
+    bump_schedule_version(g.profile)
+    db.session.commit()
+    flash('Schedule change removed.', 'success')
+    return redirect(url_for('main.doctor_dashboard'))
 
 
 # (Appointment Action Route is Unchanged)
-@app.route("/appointment_action/<int:appointment_id>/<string:action>")
+@bp.route("/appointment_action/<int:appointment_id>/<string:action>")
 @login_required
 @role_required('doctor')
 def appointment_action(appointment_id, action):
@@ -777,7 +1359,7 @@ def appointment_action(appointment_id, action):
     apt = db.session.get(Appointment, appointment_id)
     if not apt or apt.doctor_id != g.profile.id:
         flash('Appointment not found or not authorized.', 'danger')
-        return redirect(url_for('doctor_dashboard'))
+        return redirect(url_for('main.doctor_dashboard'))
 
     if action == 'confirm':
         # --- UPDATED: Change status directly to 'Confirmed' ---
@@ -798,21 +1380,22 @@ def appointment_action(appointment_id, action):
         flash('Invalid action.', 'danger')
 
     db.session.commit()
-    return redirect(url_for('doctor_dashboard'))
+    publish_appointment_change(apt)
+    return redirect(url_for('main.doctor_dashboard'))
 
 # --- NEW: Route for setting a bill ---
-@app.route("/set_bill/<int:appointment_id>", methods=['POST'])
+@bp.route("/set_bill/<int:appointment_id>", methods=['POST'])
 @login_required
 @role_required('doctor')
 def set_bill(appointment_id):
     apt = db.session.get(Appointment, appointment_id)
     if not apt or apt.doctor_id != g.profile.id:
         flash('Appointment not found or not authorized.', 'danger')
-        return redirect(url_for('doctor_dashboard'))
+        return redirect(url_for('main.doctor_dashboard'))
     
     if apt.status != 'Completed':
         flash('Can only bill for completed appointments.', 'danger')
-        return redirect(url_for('doctor_dashboard'))
+        return redirect(url_for('main.doctor_dashboard'))
     
     try:
         amount = float(request.form.get('bill_amount'))
@@ -820,44 +1403,46 @@ def set_bill(appointment_id):
         
         if amount <= 0:
             flash('Bill amount must be greater than zero.', 'danger')
-            return redirect(url_for('doctor_dashboard'))
+            return redirect(url_for('main.doctor_dashboard'))
 
-        apt.bill_amount = amount
-        apt.bill_description = description
-        apt.bill_status = 'Unpaid' # Set status to Unpaid
+        invoice = billing.issue_invoice(apt, amount, description, current_user.id) # Unpaid until paid or claimed
         db.session.commit()
+        publish_appointment_change(apt)
+        enqueue_invoice_render(invoice)
         flash(f'Bill sent to {apt.patient.full_name} for ${amount:.2f}.', 'success')
 
     except ValueError:
         flash('Invalid bill amount.', 'danger')
     
-    return redirect(url_for('doctor_dashboard'))
+    return redirect(url_for('main.doctor_dashboard'))
 
 # --- NEW: Route for marking a bill as paid ---
-@app.route("/bill_action/<int:appointment_id>/<string:action>")
+@bp.route("/bill_action/<int:appointment_id>/<string:action>")
 @login_required
 @role_required('doctor')
 def bill_action(appointment_id, action):
     apt = db.session.get(Appointment, appointment_id)
     if not apt or apt.doctor_id != g.profile.id:
         flash('Appointment not found or not authorized.', 'danger')
-        return redirect(url_for('doctor_dashboard'))
+        return redirect(url_for('main.doctor_dashboard'))
 
     if action == 'pay':
-        if apt.bill_status in ['Unpaid', 'Pending Insurance']: # <-- Allow marking as paid even if pending
-            apt.bill_status = 'Paid'
+        invoice = billing.get_invoice(apt.id)
+        if billing.record_payment(invoice, 'at_clinic', current_user.id, allowed=billing.PAYABLE_AT_CLINIC):
             db.session.commit()
+            publish_appointment_change(apt)
+            enqueue_invoice_render(invoice)
             flash(f'Bill for {apt.patient.full_name} marked as paid.', 'success')
         else:
             flash('Bill is not in a state that can be marked as paid.', 'info')
     else:
         flash('Invalid action.', 'danger')
 
-    return redirect(url_for('doctor_dashboard'))
+    return redirect(url_for('main.doctor_dashboard'))
 
 
 # (Update Record Route is Unchanged)
-@app.route("/update_record/<int:patient_id>", methods=['GET', 'POST'])
+@bp.route("/update_record/<int:patient_id>", methods=['GET', 'POST'])
 @login_required
 @role_required('doctor')
 def update_record(patient_id):
@@ -865,7 +1450,7 @@ def update_record(patient_id):
     patient = db.session.get(PatientProfile, patient_id)
     if not patient:
         flash('Patient not found.', 'danger')
-        return redirect(url_for('doctor_dashboard'))
+        return redirect(url_for('main.doctor_dashboard'))
 
     has_permission = patient in g.profile.permitted_patients
     
@@ -887,23 +1472,19 @@ def update_record(patient_id):
             db.session.add(new_record)
             db.session.commit()
             flash(f'New medical record added for {patient.full_name}.', 'success')
-            return redirect(url_for('update_record', patient_id=patient.id))
+            return redirect(url_for('main.update_record', patient_id=patient.id))
     
-    timeline_items = []
-    if has_permission:
-        records = patient.records.all()
-        files = patient.files.all()
-        timeline_items = sorted(records + files, key=lambda x: x.created_at, reverse=True)
-    else:
-        records = patient.records.filter_by(doctor_id=g.profile.id).all()
-        files = patient.files.filter_by(doctor_id=g.profile.id).all()
-        timeline_items = sorted(records + files, key=lambda x: x.created_at, reverse=True)
+    # --- UPDATED: Read-only timeline rows (see read_models.py); without permission, only this doctor's own entries ---
+    show_history = wants_history()
+    timeline_items = read_models.patient_timeline(patient.id, doctor_id=None if has_permission else g.profile.id,
+                                                  include_archived=show_history)
 
-    return render_template('update_record.html', patient=patient, timeline_items=timeline_items, has_permission=has_permission)
+    return render_template('update_record.html', patient=patient, timeline_items=timeline_items, has_permission=has_permission,
+                           show_history=show_history)
 
 
 # (Upload File Route is Unchanged)
-@app.route('/upload_file/<int:patient_id>', methods=['POST'])
+@bp.route('/upload_file/<int:patient_id>', methods=['POST'])
 @login_required
 @role_required('doctor')
 def upload_file(patient_id):
@@ -911,18 +1492,18 @@ def upload_file(patient_id):
     patient = db.session.get(PatientProfile, patient_id)
     if not patient:
         flash('Patient not found.', 'danger')
-        return redirect(url_for('doctor_dashboard'))
+        return redirect(url_for('main.doctor_dashboard'))
     
     if 'file' not in request.files:
         flash('No file part', 'danger')
-        return redirect(url_for('update_record', patient_id=patient_id))
+        return redirect(url_for('main.update_record', patient_id=patient_id))
     
     file = request.files['file']
     description = request.form.get('description', '')
 
     if file.filename == '':
         flash('No selected file', 'danger')
-        return redirect(url_for('update_record', patient_id=patient_id))
+        return redirect(url_for('main.update_record', patient_id=patient_id))
 
     if file and allowed_file(file.filename):
         from werkzeug.utils import secure_filename
@@ -930,7 +1511,7 @@ def upload_file(patient_id):
         ext = original_filename.rsplit('.', 1)[1].lower()
         unique_filename = f"{uuid.uuid4()}.{ext}"
         
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
+        file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], unique_filename)
         file.save(file_path)
         
         new_file = MedicalFile(
@@ -942,16 +1523,17 @@ def upload_file(patient_id):
         )
         db.session.add(new_file)
         db.session.commit()
+        jobs.enqueue('fingerprint_upload', {'file_id': new_file.id}, idempotency_key=f'fingerprint_upload:{new_file.id}')
         
         flash('File uploaded successfully.', 'success')
     else:
         flash('File type not allowed. Allowed types are: png, jpg, jpeg, pdf.', 'danger')
         
-    return redirect(url_for('update_record', patient_id=patient_id))
+    return redirect(url_for('main.update_record', patient_id=patient_id))
 
 
 # (Get File Route is Unchanged, including the fix from before)
-@app.route('/uploads/<path:filename>')
+@bp.route('/uploads/<path:filename>')
 @login_required
 def get_file(filename):
     # --- FIX: Restore the g.profile setup logic ---
@@ -963,6 +1545,8 @@ def get_file(filename):
         g.profile = current_user.insurance_profile
     
     medical_file = db.session.scalar(db.select(MedicalFile).where(MedicalFile.filename == filename))
+    if not medical_file: # Older files may have been archived
+        medical_file = db.session.scalar(db.select(ArchivedMedicalFile).where(ArchivedMedicalFile.filename == filename))
     if not medical_file:
         abort(404)
 
@@ -979,11 +1563,12 @@ def get_file(filename):
     
     # --- NEW: Allow insurance to see files for patients they have claims with ---
     elif current_user.role == 'insurance':
-        # Check if this insurance company has any appointments (claims) with this patient
-        has_claim = db.session.scalar(db.select(Appointment).where(
-            Appointment.patient_id == medical_file.patient_id,
-            Appointment.insurance_id == g.profile.id
-        ).limit(1))
+        # Check if this insurance company has any claims for this patient (invoices outlive archiving)
+        has_claim = db.session.scalar(
+            db.select(InsuranceClaim.id).join(Invoice, InsuranceClaim.invoice_id == Invoice.id)
+            .where(Invoice.patient_id == medical_file.patient_id, InsuranceClaim.insurer_id == g.profile.id)
+            .limit(1)
+        )
         
         if has_claim:
             is_authorized = True
@@ -994,7 +1579,7 @@ def get_file(filename):
         
     try:
         return send_from_directory(
-            app.config['UPLOAD_FOLDER'], 
+            current_app.config['UPLOAD_FOLDER'], 
             filename, 
             as_attachment=False,
             download_name=medical_file.original_filename
@@ -1002,13 +1587,31 @@ def get_file(filename):
     except FileNotFoundError:
         abort(404)
 
+def latest_related_record(apt):
+    # Find the most recent diagnosis from this doctor for this patient
+    # This is an approximation, as records aren't directly linked to appointments
+    for model in (MedicalRecord, ArchivedMedicalRecord): # Archived records are all older than hot ones
+        record = db.session.scalar(
+            db.select(model)
+            .where(
+                model.patient_id == apt.patient_id,
+                model.doctor_id == apt.doctor_id
+            )
+            .order_by(model.created_at.desc())
+            .limit(1)
+        )
+        if record:
+            return record
+    return None
+
 # --- NEW: Route to generate PDF invoice ---
-@app.route('/generate_invoice_pdf/<int:appointment_id>')
+@bp.route('/generate_invoice_pdf/<int:appointment_id>')
 @login_required
 def generate_invoice_pdf(appointment_id):
-    apt = db.session.get(Appointment, appointment_id)
+    apt = get_appointment(appointment_id, include_archived=True)
     if not apt:
         abort(44)
+    invoice = billing.get_invoice(apt.id)
         
     # Authorize: Must be the patient or the doctor
     is_authorized = False
@@ -1018,170 +1621,636 @@ def generate_invoice_pdf(appointment_id):
     elif current_user.role == 'doctor' and apt.doctor_id == current_user.doctor_profile.id:
         is_authorized = True
     # --- NEW: Allow insurance company to view if claim is theirs ---
-    elif current_user.role == 'insurance' and apt.insurance_id == current_user.insurance_profile.id:
+    elif current_user.role == 'insurance' and invoice and invoice.claim \
+            and invoice.claim.insurer_id == current_user.insurance_profile.id:
         is_authorized = True
     # --- END FIX ---
         
     if not is_authorized:
         abort(403)
         
-    if apt.bill_status == 'Unbilled':
+    if not invoice:
         flash('This bill has not been generated yet.', 'danger')
-        return redirect(url_for('patient_dashboard'))
-        
-    # Find the most recent diagnosis from this doctor for this patient
-    # This is an approximation, as records aren't directly linked to appointments
-    record = db.session.scalar(
-        db.select(MedicalRecord)
-        .where(
-            MedicalRecord.patient_id == apt.patient_id,
-            MedicalRecord.doctor_id == apt.doctor_id
-        )
-        .order_by(MedicalRecord.created_at.desc())
-        .limit(1)
-    )
-    
-    # --- Generate PDF ---
-    pdf = FPDF()
-    pdf.add_page()
-    
-    # Title
-    pdf.set_font('Arial', 'B', 20)
-    pdf.cell(0, 15, 'Medical Invoice', ln=True, align='C')
-    pdf.ln(10)
-    
-    # Header Info
-    pdf.set_font('Arial', 'B', 12)
-    pdf.cell(40, 8, 'Patient:', border=1)
-    pdf.set_font('Arial', '', 12)
-    pdf.cell(0, 8, f' {apt.patient.full_name}', border=1, ln=True)
-    
-    pdf.set_font('Arial', 'B', 12)
-    pdf.cell(40, 8, 'Doctor:', border=1)
-    pdf.set_font('Arial', '', 12)
-    pdf.cell(0, 8, f' {apt.doctor.full_name} ({apt.doctor.specialty})', border=1, ln=True)
-    
-    pdf.set_font('Arial', 'B', 12)
-    pdf.cell(40, 8, 'Appointment:', border=1)
-    pdf.set_font('Arial', '', 12)
-    pdf.cell(0, 8, f' {apt.appointment_time.strftime("%Y-%m-%d %I:%M %p")}', border=1, ln=True)
-    
-    pdf.ln(10)
-    
-    # Body / Items
-    pdf.set_font('Arial', 'B', 12)
-    pdf.set_fill_color(240, 240, 240)
-    pdf.cell(130, 10, 'Description', border=1, fill=True)
-    pdf.cell(0, 10, 'Amount', border=1, fill=True, ln=True, align='R')
-    
-    pdf.set_font('Arial', '', 12)
-    pdf.cell(130, 10, f' {apt.bill_description or "Consultation"}', border=1)
-    pdf.cell(0, 10, f' ${apt.bill_amount:.2f}', border=1, ln=True, align='R')
-    
-    # Diagnosis (if found)
-    if record:
-        pdf.cell(130, 10, f' Related Diagnosis: {record.diagnosis}', border=1)
-        pdf.cell(0, 10, '', border=1, ln=True, align='R')
-        
-    pdf.ln(5)
-    
-    # Total
-    pdf.set_font('Arial', 'B', 14)
-    pdf.cell(130, 12, 'Total Due:', align='R')
-    pdf.cell(0, 12, f' ${apt.bill_amount:.2f}', align='R', ln=True)
-    
-    pdf.ln(10)
-    
-    # Status
-    pdf.set_font('Arial', 'B', 14)
-    status_text = apt.bill_status
-    if apt.bill_status == 'Pending Insurance':
-        status_text = f"Pending (Claim {apt.insurance_claim_status})"
-    elif apt.bill_status == 'Paid':
-         if apt.insurance_claim_status == 'Accepted':
-             status_text = f"Paid (via {apt.insurance_company.company_name})"
-         else:
-             status_text = "Paid (by Patient)"
-             
-    pdf.cell(0, 10, f'Status: {status_text}', ln=True, align='C')
-
-    # --- NEW: Add computer generated footer ---
-    pdf.set_y(-15) # Position 1.5 cm from bottom
-    pdf.set_font('Arial', 'I', 8)
-    pdf.cell(0, 10, 'This is a computer-generated invoice and requires no signature.', 0, 0, 'C')
-    # --- END NEW FOOTER ---
+        return redirect(url_for('main.patient_dashboard'))
+
+    # --- NEW: Cheap revalidation. The ETag only depends on the invoice version and the latest record id. ---
+    key = invoice_key(invoice)
+    etag = invoice_etag(key)
+    if request.if_none_match.contains(etag):
+        response = make_response('', 304)
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
 
     # --- Create Flask response ---
     try:
-        # FPDF output as string, encode to latin-1 for binary blob
-        pdf_content = pdf.output(dest='S').encode('latin-1')
+        pdf_content = get_cached_invoice(key)
+        if pdf_content is None:
+            pdf_content = load_rendered_invoice(key) # Usually there already, rendered in the background
+            if pdf_content is None:
+                pdf_content = render_invoice_pdf(build_invoice_data(apt, invoice, latest_related_record(apt)))
+            store_cached_invoice(key, pdf_content)
         response = make_response(pdf_content)
         response.headers['Content-Type'] = 'application/pdf'
         response.headers['Content-Disposition'] = f'inline; filename=Invoice-{apt.id}.pdf'
+        response.headers['Cache-Control'] = 'private, no-cache' # Browsers must revalidate with the ETag
+        response.set_etag(etag)
         return response
     except Exception as e:
-        app.logger.error(f"Error generating PDF: {e}")
+        current_app.logger.error(f"Error generating PDF: {e}")
         abort(500)
 
 
+# --- NEW: Bulk invoice / statement export ---
+def invoice_rows_query(owner_role, owner_id, start_date, end_date):
+    """Invoices of an insurer (through their current claim) or a patient for visits in the date range."""
+    def latest_diagnosis(record_model):
+        return (
+            db.select(record_model.diagnosis)
+            .where(
+                record_model.patient_id == Invoice.patient_id,
+                record_model.doctor_id == Invoice.doctor_id
+            )
+            .order_by(record_model.created_at.desc())
+            .limit(1)
+            .correlate(Invoice)
+            .scalar_subquery()
+        )
+    query = (
+        db.select(
+            Invoice.appointment_id,
+            Invoice.appointment_time,
+            Invoice.amount,
+            Invoice.status,
+            Invoice.description,
+            InsuranceClaim.status.label('claim_status'),
+            PatientProfile.full_name.label('patient_name'),
+            DoctorProfile.full_name.label('doctor_name'),
+            DoctorProfile.specialty,
+            InsuranceProfile.company_name,
+            func.coalesce(latest_diagnosis(MedicalRecord), latest_diagnosis(ArchivedMedicalRecord)).label('diagnosis')
+        )
+        .join(PatientProfile, Invoice.patient_id == PatientProfile.id)
+        .join(DoctorProfile, Invoice.doctor_id == DoctorProfile.id)
+        # Matching invoice_id too lets an insurer's export start from their claims
+        .outerjoin(InsuranceClaim, db.and_(InsuranceClaim.id == Invoice.claim_id, InsuranceClaim.invoice_id == Invoice.id))
+        .outerjoin(InsuranceProfile, InsuranceClaim.insurer_id == InsuranceProfile.id)
+        .where(
+            Invoice.appointment_time >= datetime.datetime.combine(start_date, datetime.time.min),
+            Invoice.appointment_time < datetime.datetime.combine(end_date + datetime.timedelta(days=1), datetime.time.min)
+        )
+    )
+    if owner_role == 'insurance':
+        return query.where(InsuranceClaim.insurer_id == owner_id)
+    return query.where(Invoice.patient_id == owner_id)
+
+def iter_invoice_rows(owner_role, owner_id, start_date, end_date):
+    """Streams invoices for an insurer or patient as plain dicts, in batches from the database.
+
+    Invoices are never archived, so one query covers archived appointments too.
+    """
+    query = (
+        invoice_rows_query(owner_role, owner_id, start_date, end_date)
+        .order_by(Invoice.appointment_time.asc(), Invoice.appointment_id.asc())
+        .execution_options(yield_per=500)
+    )
+
+    for row in db.session.execute(query):
+        yield {
+            'appointment_id': row.appointment_id,
+            'patient_name': row.patient_name,
+            'doctor_name': row.doctor_name,
+            'doctor_specialty': row.specialty,
+            'appointment_time': row.appointment_time.strftime("%Y-%m-%d %I:%M %p"),
+            'description': row.description or "Consultation",
+            'amount': row.amount,
+            'diagnosis': row.diagnosis,
+            'status_text': invoice_status_text(row.status, row.claim_status or 'None', row.company_name),
+        }
+
+def statement_size_error(owner_role, owner_id, start_date, end_date):
+    """Why a statement for this range can't be built, or None.
+
+    A statement is a single PDF, rendered in one pool task with every row in memory, so its
+    size is capped at EXPORT_STATEMENT_MAX_ROWS. The ZIP export streams and has no cap.
+    """
+    max_rows = current_app.config['EXPORT_STATEMENT_MAX_ROWS']
+    count = db.session.scalar(
+        invoice_rows_query(owner_role, owner_id, start_date, end_date).with_only_columns(func.count())
+    )
+    if count > max_rows:
+        return (f'This range has {count} invoices; a statement can list at most {max_rows}. '
+                f'Pick a shorter range or export the invoices as a ZIP.')
+    return None
+
+def generate_invoice_export(owner_role, owner_id, owner_name, start_date, end_date, export_format):
+    """Yields the export as byte chunks. Rendering runs in the shared process pool.
+
+    Check statements with statement_size_error() first; rows past the cap are left out.
+    """
+    pool = get_export_pool(current_app.config['EXPORT_WORKERS'])
+    rows = iter_invoice_rows(owner_role, owner_id, start_date, end_date)
+    if export_format == 'statement':
+        period = f'{start_date.isoformat()} to {end_date.isoformat()}'
+        rows = list(islice(rows, current_app.config['EXPORT_STATEMENT_MAX_ROWS']))
+        pdf_content = pool.submit(render_statement_pdf, owner_name, period, rows).result()
+        for offset in range(0, len(pdf_content), 64 * 1024):
+            yield pdf_content[offset:offset + 64 * 1024]
+    else:
+        batches = batched(rows, current_app.config['EXPORT_BATCH_SIZE'])
+        max_in_flight = 2 * (current_app.config['EXPORT_WORKERS'] or os.cpu_count() or 1)
+        rendered = bounded_map(pool, render_invoice_batch, batches, max_in_flight)
+        yield from stream_zip(entry for batch in rendered for entry in batch)
+
+def parse_export_range(start_str, end_str):
+    today = datetime.date.today()
+    start_date = datetime.date.fromisoformat(start_str) if start_str else today.replace(day=1)
+    end_date = datetime.date.fromisoformat(end_str) if end_str else today
+    if start_date > end_date:
+        raise ValueError('Start date must be on or before end date.')
+    return start_date, end_date
+
+@bp.route('/export_invoices')
+@login_required
+def export_invoices():
+    if current_user.role == 'insurance':
+        owner_id, owner_name = current_user.insurance_profile.id, current_user.insurance_profile.company_name
+    elif current_user.role == 'patient':
+        owner_id, owner_name = current_user.patient_profile.id, current_user.patient_profile.full_name
+    else:
+        abort(403)
+
+    export_format = request.args.get('format', 'zip')
+    if export_format not in ('zip', 'statement'):
+        flash('Invalid export format.', 'danger')
+        return redirect(url_for('main.dashboard'))
+    try:
+        start_date, end_date = parse_export_range(request.args.get('start'), request.args.get('end'))
+    except ValueError as e:
+        flash(f'Invalid date range. {e}', 'danger')
+        return redirect(url_for('main.dashboard'))
+    if export_format == 'statement':
+        error = statement_size_error(current_user.role, owner_id, start_date, end_date)
+        if error:
+            flash(error, 'danger')
+            return redirect(url_for('main.dashboard'))
+
+    chunks = generate_invoice_export(current_user.role, owner_id, owner_name, start_date, end_date, export_format)
+    if export_format == 'statement':
+        mimetype, filename = 'application/pdf', f'Statement-{start_date}-{end_date}.pdf'
+    else:
+        mimetype, filename = 'application/zip', f'Invoices-{start_date}-{end_date}.zip'
+    response = current_app.response_class(stream_with_context(chunks), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename={filename}'
+    return response
+
+# --- NEW: Full medical history export ---
+@bp.route('/export_history')
+@bp.route('/export_history/<int:patient_id>')
+@login_required
+def export_history(patient_id=None):
+    """Streams every record and file of a patient, archived ones included, for the patient or a permitted doctor."""
+    if current_user.role == 'patient':
+        patient = current_user.patient_profile
+        if patient_id is not None and patient_id != patient.id:
+            abort(403)
+    elif current_user.role == 'doctor':
+        patient = db.session.get(PatientProfile, patient_id) if patient_id else None
+        if not patient:
+            abort(404)
+        if patient not in current_user.doctor_profile.permitted_patients:
+            abort(403)
+    else:
+        abort(403)
+
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in HISTORY_EXPORT_FORMATS:
+        abort(400)
+    mimetype, extension = HISTORY_EXPORT_FORMATS[export_format]
+    chunks = generate_history_export(patient.id, current_app.config['UPLOAD_FOLDER'], export_format)
+    response = current_app.response_class(stream_with_context(chunks), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename=History-{patient.id}.{extension}'
+    response.headers['Cache-Control'] = 'private, no-store'
+    return response
+
+@bp.cli.command('export-history')
+@click.option('--patient', 'patient_id', type=int, required=True, help='PatientProfile id to export.')
+@click.option('--format', 'export_format', type=click.Choice(sorted(HISTORY_EXPORT_FORMATS)), default='ndjson')
+@click.option('--output', '-o', required=True, type=click.Path(dir_okay=False), help='File to write.')
+def export_history_command(patient_id, export_format, output):
+    """Exports a patient's complete medical history as NDJSON, CSV or a ZIP with the files."""
+    if not db.session.get(PatientProfile, patient_id):
+        raise click.UsageError('Patient not found.')
+    written = 0
+    with open(output, 'wb') as f:
+        for chunk in generate_history_export(patient_id, current_app.config['UPLOAD_FOLDER'], export_format):
+            f.write(chunk)
+            written += len(chunk)
+    click.echo(f'Wrote {written} bytes to {output}.')
+
+@bp.cli.command('export-invoices')
+@click.option('--insurer', 'insurer_id', type=int, help='InsuranceProfile id to export claims for.')
+@click.option('--patient', 'patient_id', type=int, help='PatientProfile id to export bills for.')
+@click.option('--start', 'start_str', help='First day (YYYY-MM-DD). Defaults to the start of this month.')
+@click.option('--end', 'end_str', help='Last day (YYYY-MM-DD). Defaults to today.')
+@click.option('--format', 'export_format', type=click.Choice(['zip', 'statement']), default='zip')
+@click.option('--output', '-o', required=True, type=click.Path(dir_okay=False), help='File to write.')
+def export_invoices_command(insurer_id, patient_id, start_str, end_str, export_format, output):
+    """Exports invoices for an insurer or patient as a ZIP or a statement PDF."""
+    if bool(insurer_id) == bool(patient_id):
+        raise click.UsageError('Pass exactly one of --insurer or --patient.')
+    if insurer_id:
+        profile = db.session.get(InsuranceProfile, insurer_id)
+        owner_role, owner_name = 'insurance', profile.company_name if profile else None
+    else:
+        profile = db.session.get(PatientProfile, patient_id)
+        owner_role, owner_name = 'patient', profile.full_name if profile else None
+    if not profile:
+        raise click.UsageError('Profile not found.')
+    try:
+        start_date, end_date = parse_export_range(start_str, end_str)
+    except ValueError as e:
+        raise click.UsageError(str(e))
+    if export_format == 'statement':
+        error = statement_size_error(owner_role, profile.id, start_date, end_date)
+        if error:
+            raise click.UsageError(error)
+
+    written = 0
+    with open(output, 'wb') as f:
+        for chunk in generate_invoice_export(owner_role, profile.id, owner_name, start_date, end_date, export_format):
+            f.write(chunk)
+            written += len(chunk)
+    click.echo(f'Wrote {written} bytes to {output}.')
+
+
 # --- Insurance Routes (UPDATED) ---
-@app.route("/insurance_dashboard")
+@bp.route("/insurance_dashboard")
 @login_required
 @role_required('insurance')
 def insurance_dashboard():
     # --- NEW: Find all claims submitted to this company ---
-    pending_claims = db.session.scalars(
-        db.select(Appointment).where(
-            Appointment.insurance_id == g.profile.id,
-            Appointment.insurance_claim_status == 'Pending'
-        ).order_by(Appointment.appointment_time.asc())
-    ).all()
-    
-    processed_claims = db.session.scalars(
-        db.select(Appointment).where(
-            Appointment.insurance_id == g.profile.id,
-            Appointment.insurance_claim_status.in_(['Accepted', 'Rejected'])
-        ).order_by(Appointment.appointment_time.desc())
-    ).all()
+    # --- UPDATED: Read-only rows with the patient and doctor names joined in (see read_models.py) ---
+    pending_claims = read_models.insurer_claims(g.profile.id, ['Pending'])
+    processed_claims = read_models.insurer_claims(g.profile.id, ['Accepted', 'Rejected'], newest_first=True)
 
     return render_template('insurance_dashboard.html',
                            pending_claims=pending_claims,
                            processed_claims=processed_claims)
 
 # --- NEW: Route for insurance to process a claim ---
-@app.route("/process_claim/<int:appointment_id>/<string:action>")
+@bp.route("/process_claim/<int:appointment_id>/<string:action>")
 @login_required
 @role_required('insurance')
 def process_claim(appointment_id, action):
     apt = db.session.get(Appointment, appointment_id)
-    if not apt or apt.insurance_id != g.profile.id:
+    invoice = billing.get_invoice(appointment_id) if apt else None
+    claim = invoice.claim if invoice else None
+    if not claim or claim.insurer_id != g.profile.id:
         flash('Claim not found or not assigned to your company.', 'danger')
-        return redirect(url_for('insurance_dashboard'))
+        return redirect(url_for('main.insurance_dashboard'))
 
-    if apt.insurance_claim_status != 'Pending':
+    if claim.status != 'Pending':
         flash('This claim has already been processed.', 'info')
-        return redirect(url_for('insurance_dashboard'))
+        return redirect(url_for('main.insurance_dashboard'))
 
-    if action == 'accept':
-        apt.insurance_claim_status = 'Accepted'
-        apt.bill_status = 'Paid' # Mark the bill as Paid
-        db.session.commit()
-        flash(f'Claim for {apt.patient.full_name} (Amount: ${apt.bill_amount:.2f}) has been ACCEPTED and marked as Paid.', 'success')
-    elif action == 'reject':
-        apt.insurance_claim_status = 'Rejected'
-        apt.bill_status = 'Unpaid' # Mark the bill as Unpaid again so patient must pay
+    # --- UPDATED: Decisions go through the billing ledger (see billing.py) ---
+    if action in ('accept', 'reject'):
+        billing.decide_claim(invoice, action == 'accept', current_user.id)
         db.session.commit()
-        flash(f'Claim for {apt.patient.full_name} (Amount: ${apt.bill_amount:.2f}) has been REJECTED. Patient notified to pay.', 'danger')
+        publish_appointment_change(apt)
+        enqueue_invoice_render(invoice)
+        if action == 'accept':
+            flash(f'Claim for {apt.patient.full_name} (Amount: ${invoice.amount:.2f}) has been ACCEPTED and marked as Paid.', 'success')
+        else:
+            flash(f'Claim for {apt.patient.full_name} (Amount: ${invoice.amount:.2f}) has been REJECTED. Patient notified to pay.', 'danger')
     else:
         flash('Invalid action.', 'danger')
 
-    return redirect(url_for('insurance_dashboard'))
+    return redirect(url_for('main.insurance_dashboard'))
+
+
+# --- NEW: Live dashboard updates (Server-Sent Events) ---
+@bp.route("/events")
+@login_required
+def events():
+    """Streams changes to the appointments on the current doctor's or insurer's dashboard."""
+    role = current_user.role
+    if role not in ('doctor', 'insurance'):
+        abort(403)
+    profile = current_user.doctor_profile if role == 'doctor' else current_user.insurance_profile
+    if not profile:
+        abort(403)
+    profile_id = profile.id
+    subscription = feed.subscribe(shards.scoped((role, profile_id)), request.headers.get('Last-Event-ID'))
+    db.session.rollback() # Don't hold a read transaction open while the stream idles
+    heartbeat = current_app.config['EVENTS_HEARTBEAT']
+    deadline = time.monotonic() + current_app.config['EVENTS_MAX_STREAM']
+
+    def stream():
+        try:
+            yield 'retry: 3000\n\n'
+            while time.monotonic() < deadline:
+                if subscription.needs_reset:
+                    yield format_sse('{}', event='reset')
+                    return
+                item = subscription.get(timeout=heartbeat)
+                if item is None:
+                    yield ': keepalive\n\n'
+                    continue
+                event_id, change = item
+                payload = render_appointment_change(role, profile_id, change['appointment_id'])
+                db.session.rollback() # Ends the read so the next event sees fresh rows
+                yield format_sse(json.dumps(payload), event='appointment', event_id=event_id)
+        finally:
+            subscription.close()
+
+    response = current_app.response_class(stream_with_context(stream()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no' # Stop nginx from buffering the stream
+    return response
+
+
+# --- NEW: Schema and query-plan CLI commands ---
+@bp.cli.command('db-upgrade')
+def db_upgrade_command():
+    """Applies pending schema migrations."""
+    applied = migrations.upgrade(shards.engine(), echo=click.echo)
+    click.echo(f'{len(applied)} migration(s) applied.' if applied else 'Database is up to date.')
+
+@bp.cli.command('db-status')
+def db_status_command():
+    """Lists schema migrations and whether they have been applied."""
+    pending = {version for version, _, _ in migrations.pending_migrations(shards.engine())}
+    for version, description, _ in migrations.MIGRATIONS:
+        click.echo(f'{version:>4}  {"pending" if version in pending else "applied":<8} {description}')
+
+@bp.cli.command('check-query-plans')
+def check_query_plans_command():
+    """Runs EXPLAIN QUERY PLAN on every route's queries; fails on full scans of hot tables."""
+    import query_plans
+
+    def busiest(column):
+        return db.session.scalar(
+            db.select(column).where(column.is_not(None)).group_by(column).order_by(func.count().desc()).limit(1)
+        )
+    patient = db.session.get(PatientProfile, busiest(Appointment.patient_id))
+    doctor = db.session.get(DoctorProfile, busiest(Appointment.doctor_id))
+    insurer = db.session.get(InsuranceProfile, busiest(InsuranceClaim.insurer_id) or db.session.scalar(db.select(InsuranceProfile.id)))
+    if not (patient and doctor and insurer):
+        raise click.ClickException('Need at least one appointment and one insurance company to exercise the routes.')
+    billed = db.session.scalar(
+        db.select(Appointment).join(Invoice, Invoice.appointment_id == Appointment.id).limit(1)
+    )
+    medical_file = db.session.scalar(db.select(MedicalFile).limit(1))
+    tomorrow = (datetime.date.today() + datetime.timedelta(days=1)).isoformat()
+
+    def client_for(user_id=None):
+        client = current_app.test_client()
+        if user_id:
+            with client.session_transaction() as sess:
+                sess['_user_id'] = str(user_id)
+                sess['_fresh'] = True
+        return client
+
+    anonymous = client_for()
+    as_patient, as_doctor, as_insurer = client_for(patient.user_id), client_for(doctor.user_id), client_for(insurer.user_id)
+    requests = [
+        ('register', anonymous, 'GET', '/register', None),
+        ('patient_dashboard', as_patient, 'GET', '/patient_dashboard', None),
+        ('search_doctors', as_patient, 'POST', '/search_doctors', {'specialty': 'Cardio', 'min_rating': '5', 'sort_by': 'rating'}),
+        ('book_appointment', as_patient, 'GET', f'/book_appointment/{doctor.id}?date={tomorrow}', None),
+        ('leave_review', as_patient, 'GET', f'/leave_review/{doctor.id}', None),
+        ('doctor_dashboard', as_doctor, 'GET', '/doctor_dashboard', None),
+        ('update_record', as_doctor, 'GET', f'/update_record/{patient.id}', None),
+        ('insurance_dashboard', as_insurer, 'GET', '/insurance_dashboard', None),
+        ('update_record (history)', as_doctor, 'GET', f'/update_record/{patient.id}?history=all', None),
+        ('export_history', as_patient, 'GET', '/export_history?format=ndjson', None),
+        # JSON API (see api.py)
+        ('api.me', as_patient, 'GET', '/api/v1/me', None),
+        ('api.reference', as_patient, 'GET', '/api/v1/reference', None),
+        ('api.patient_appointments', as_patient, 'GET', '/api/v1/patient/appointments', None),
+        ('api.patient_records', as_patient, 'GET', '/api/v1/patient/records', None),
+        ('api.patient_files', as_patient, 'GET', '/api/v1/patient/files', None),
+        ('api.search_doctors', as_patient, 'GET', '/api/v1/doctors?specialty=Cardio&min_rating=5&sort_by=rating', None),
+        ('api.doctor_slots', as_patient, 'GET', f'/api/v1/doctors/{doctor.id}/slots?date={tomorrow}', None),
+        ('api.suggest_doctors', as_patient, 'GET', '/api/v1/doctors/suggest?q=ca', None),
+        ('api.doctor_appointments', as_doctor, 'GET', '/api/v1/doctor/appointments', None),
+        ('api.insurance_claims', as_insurer, 'GET', '/api/v1/insurance/claims', None),
+    ]
+    if billed:
+        owner = client_for(billed.patient.user_id)
+        requests.append(('pay_bill', owner, 'GET', f'/pay_bill/{billed.id}', None))
+        requests.append(('generate_invoice_pdf', owner, 'GET', f'/generate_invoice_pdf/{billed.id}', None))
+        requests.append(('export_invoices', owner, 'GET', '/export_invoices?start=2000-01-01&format=statement', None))
+        requests.append(('export_invoices (zip)', owner, 'GET', '/export_invoices?start=2000-01-01&format=zip', None))
+    if medical_file:
+        requests.append(('get_file', client_for(medical_file.patient.user_id), 'GET', f'/uploads/{medical_file.filename}', None))
+    db.session.remove()
+    # The autocomplete index is built once per worker (at startup with AUTOCOMPLETE_PRELOAD) by reading every
+    # doctor and their ratings. Build it now, outside the capture, so only the per-request lookups are
+    # checked, whatever the preload setting. This also waits for a preload that is still running.
+    shards.fan_out(autocomplete.get_index)
+
+    failures = query_plans.check_requests(current_app._get_current_object(), shards.engine(), requests, echo=click.echo)
+    if failures:
+        raise click.ClickException(f'{failures} full scan(s) of hot tables found.')
+    click.echo('No full scans of hot tables.')
+
+
+# --- NEW: History archival ---
+@bp.cli.command('archive-history')
+@click.option('--days', type=int, default=None, help='Archive settled history older than this (default ARCHIVE_AFTER_DAYS).')
+@click.option('--dry-run', is_flag=True, help='Only count the rows that would move.')
+@click.option('--background', is_flag=True, help='Queue the archival for `flask jobs-worker` instead of running it here.')
+def archive_history_command(days, dry_run, background):
+    """Moves cancelled or paid appointments and old records and files to the archive tables."""
+    days = days or current_app.config['ARCHIVE_AFTER_DAYS']
+    if background:
+        job = jobs.enqueue('archive_history', {'days': days},
+                           idempotency_key=f'archive_history:{datetime.date.today().isoformat()}:{days}')
+        click.echo(f'Queued job {job.id}.')
+        return
+    cutoff = datetime.datetime.now() - datetime.timedelta(days=days)
+    moved = archive.archive_history(cutoff, batch_size=current_app.config['ARCHIVE_BATCH_SIZE'], dry_run=dry_run)
+    for table, count in moved.items():
+        click.echo(f'{table}: {count} row(s) {"would be " if dry_run else ""}archived')
+
+
+# --- NEW: Upload store scrubbing ---
+@bp.cli.command('scrub-uploads')
+@click.option('--verify', is_flag=True, help='Also recompute every SHA-256 (reads every file).')
+@click.option('--quarantine', is_flag=True, help='Move orphaned files to SCRUB_QUARANTINE_DIR.')
+@click.option('--max-seconds', type=int, default=None, help='Stop after this long; the next run carries on from there.')
+@click.option('--workers', type=int, default=None, help='Threads checking files (default SCRUB_WORKERS).')
+@click.option('--restart', is_flag=True, help='Start over instead of resuming an unfinished scrub.')
+def scrub_uploads_command(verify, quarantine, max_seconds, workers, restart):
+    """Reconciles the upload folder with the file rows: missing, corrupt and orphaned files."""
+    config = current_app.config
+    state = scrub.scrub_uploads(
+        config['UPLOAD_FOLDER'], config['SCRUB_DIR'],
+        quarantine_dir=config['SCRUB_QUARANTINE_DIR'] if quarantine else None,
+        verify=verify,
+        workers=workers or config['SCRUB_WORKERS'],
+        batch_size=config['SCRUB_BATCH_SIZE'],
+        partitions=config['SCRUB_PARTITIONS'],
+        grace=datetime.timedelta(minutes=config['SCRUB_ORPHAN_GRACE_MINUTES']),
+        max_seconds=max_seconds,
+        restart=restart,
+        echo=click.echo,
+    )
+    click.echo(', '.join(f'{name}: {count}' for name, count in state['counts'].items()))
+    click.echo(f'Report: {state["report"]}')
+    if not state['finished_at']:
+        click.echo('Stopped early; run again to carry on.')
+
+# --- NEW: Bulk doctor roster import ---
+def run_roster_import(stream, file_format, dry_run=False):
+    result = roster.import_roster(
+        stream, file_format,
+        rounds=current_app.config.get('BCRYPT_LOG_ROUNDS', 12),
+        prefix=current_app.config.get('BCRYPT_HASH_PREFIX', '2b'),
+        processes=current_app.config['ROSTER_IMPORT_WORKERS'],
+        geocoder=roster.NominatimGeocoder() if current_app.config['ROSTER_ONLINE_GEOCODING'] else None,
+        dry_run=dry_run,
+    )
+    if result['imported'] and not dry_run:
+        invalidate_reference_data() # Possibly new specialties
+        autocomplete.invalidate()
+    return result
+
+@bp.cli.command('import-roster')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'file_format', type=click.Choice(['csv', 'ndjson']), help='Defaults to the file extension.')
+@click.option('--dry-run', is_flag=True, help='Validate and check for existing accounts without importing.')
+def import_roster_command(path, file_format, dry_run):
+    """Creates doctor accounts from a CSV or NDJSON roster."""
+    with open(path, encoding='utf-8-sig', newline='') as f:
+        result = run_roster_import(f, file_format or roster.detect_format(path), dry_run=dry_run)
+    for error in result['errors']:
+        click.echo(f"line {error['line']} {error['email'] or '-'}: {'; '.join(error['errors'])}")
+    click.echo(f"{result['imported']} doctor(s) {'would be ' if dry_run else ''}imported, "
+               f"{len(result['errors'])} row(s) rejected in {result['seconds']}s.")
+
+@bp.route('/admin/roster_import', methods=['GET', 'POST'])
+@login_required
+@admin_required
+def admin_roster_import():
+    result = None
+    if request.method == 'POST':
+        upload = request.files.get('roster')
+        if not upload or upload.filename == '':
+            flash('Choose a CSV or NDJSON file to import.', 'danger')
+            return redirect(url_for('main.admin_roster_import'))
+        dry_run = request.form.get('dry_run') == 'on'
+        file_format = request.form.get('format') or roster.detect_format(upload.filename)
+        if file_format not in ('csv', 'ndjson'):
+            abort(400)
+        result = run_roster_import(roster.text_stream(upload.stream), file_format, dry_run=dry_run)
+        result['dry_run'] = dry_run
+    return render_template('admin_roster_import.html', result=result)
+
+
+# --- NEW: Appointment reminders ---
+@bp.cli.command('reminders-run')
+@click.option('--interval', default=30.0, show_default=True, help='Longest wait in seconds between ticks.')
+@click.option('--once', is_flag=True, help='Run a single tick (for cron) instead of looping.')
+def reminders_run_command(interval, once):
+    """Queues reminders for confirmed appointments and sends them from the outbox."""
+    config = current_app.config
+    scheduler = reminders.ReminderScheduler(config['REMINDER_OFFSETS'], config['REMINDER_LOOKAHEAD_MINUTES'])
+    reminder_sender = reminders.SENDERS[config['REMINDER_SENDER']](config)
+    try:
+        reminders.run_scheduler(scheduler, reminder_sender, interval=interval,
+                                batch_size=config['REMINDER_BATCH_SIZE'], once=once, echo=click.echo)
+    except KeyboardInterrupt:
+        pass
+    click.echo(', '.join(f'{count} {status}' for status, count in sorted(reminders.outbox_counts().items())) or 'Outbox empty.')
+
+
+# --- NEW: Background job worker and status view ---
+@bp.cli.command('jobs-worker')
+@click.option('--processes', default=2, show_default=True, help='Worker processes to run.')
+@click.option('--poll-interval', default=1.0, show_default=True, help='Seconds between polls when the queue is empty.')
+@click.option('--burst', is_flag=True, help='Exit once no job is due instead of waiting for more.')
+def jobs_worker_command(processes, poll_interval, burst):
+    """Runs queued background jobs in a pool of worker processes."""
+    config = {'SQLALCHEMY_DATABASE_URI': current_app.config['SQLALCHEMY_DATABASE_URI'], 'AUTOCOMPLETE_PRELOAD': False}
+    jobs.run_worker_pool(current_app._get_current_object(), create_app, processes, poll_interval=poll_interval,
+                         burst=burst, config=config, echo=click.echo)
+
+@bp.route('/admin/jobs')
+@login_required
+@admin_required
+def admin_jobs():
+    status = request.args.get('status')
+    query = db.select(Job).order_by(Job.id.desc()).limit(100)
+    if status:
+        query = query.where(Job.status == status)
+    return render_template('admin_jobs.html', jobs=db.session.scalars(query).all(),
+                           counts=jobs.job_counts(), status=status)
+
+@bp.route('/admin/jobs/<int:job_id>/retry', methods=['POST'])
+@login_required
+@admin_required
+def admin_retry_job(job_id):
+    job = db.session.get(Job, job_id)
+    if not job:
+        abort(404)
+    if job.status != 'failed':
+        flash('Only failed jobs can be retried.', 'info')
+    else:
+        jobs.retry_job(job)
+        flash(f'Job {job.id} ({job.task}) queued again.', 'success')
+    return redirect(url_for('main.admin_jobs', status=request.args.get('status')))
+
+
+# --- NEW: Admin request profiling ---
+@bp.route('/admin/profiling', methods=['GET', 'POST'])
+@login_required
+@admin_required
+def admin_profiling():
+    profile_dir = current_app.config['PROFILE_DIR']
+    if request.method == 'POST':
+        endpoints = [e for e in request.form.getlist('endpoints') if e in current_app.view_functions]
+        try:
+            sample_rate = float(request.form.get('sample_rate', '0.1'))
+        except ValueError:
+            flash('Sample rate must be a number between 0 and 1.', 'danger')
+            return redirect(url_for('main.admin_profiling'))
+        settings = profiler.save_settings(profile_dir, request.form.get('enabled') == 'on', endpoints, sample_rate)
+        flash(f"Profiling {'enabled' if settings['enabled'] else 'disabled'} for {len(settings['endpoints'])} endpoint(s).", 'success')
+        return redirect(url_for('main.admin_profiling'))
+
+    endpoints = sorted(e for e in current_app.view_functions if e != 'static' and not e.startswith('main.admin_'))
+    return render_template('admin_profiling.html', settings=profiler.load_settings(profile_dir),
+                           endpoints=endpoints, profiles=profiler.list_profiles(profile_dir))
+
+@bp.route('/admin/profiling/<profile_id>')
+@login_required
+@admin_required
+def admin_profile_detail(profile_id):
+    meta = profiler.load_profile_meta(current_app.config['PROFILE_DIR'], profile_id)
+    if meta is None:
+        abort(404)
+    sort = request.args.get('sort', 'cumulative')
+    rows, total_time = profiler.top_functions(current_app.config['PROFILE_DIR'], profile_id, sort=sort)
+    return render_template('admin_profile.html', meta=meta, rows=rows, total_time=total_time,
+                           sort=sort, sort_keys=profiler.SORT_KEYS)
+
+@bp.route('/admin/profiling/<profile_id>.prof')
+@login_required
+@admin_required
+def admin_profile_download(profile_id):
+    if profiler.load_profile_meta(current_app.config['PROFILE_DIR'], profile_id) is None:
+        abort(404)
+    return send_from_directory(current_app.config['PROFILE_DIR'], profile_id + '.prof', as_attachment=True)
 
 
-@app.errorhandler(403)
+@bp.app_errorhandler(403)
 def forbidden(e):
     return render_template('403.html'), 403
 
 # --- Run the App ---
 if __name__ == '__main__':
-    app.run(debug=True)
\ No newline at end of file
+    create_app().run(debug=True)
\ No newline at end of file
@@ -0,0 +1,329 @@
+"""Lightweight, versioned schema migrations for existing databases.
+
+db.create_all() builds new databases straight from the models, but never alters
+tables that already exist. Each migration below brings an older site.db up to
+what the models declare. Migrations are plain functions of a connection and
+must be idempotent, so a migration that races another worker, or runs against
+a database created by create_all(), is harmless.
+
+Applied versions are recorded in the `schema_migrations` table.
+"""
+import datetime
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import IntegrityError
+
+
+def add_column_if_missing(conn, table, column, ddl):
+    columns = {c['name'] for c in inspect(conn).get_columns(table)}
+    if column not in columns:
+        conn.execute(text(f'ALTER TABLE {table} ADD COLUMN {column} {ddl}'))
+
+
+def create_index_if_missing(conn, name, table, columns):
+    conn.execute(text(f'CREATE INDEX IF NOT EXISTS {name} ON {table} ({", ".join(columns)})'))
+
+
+def rebuild_table(conn, table, ddl, columns, indexes):
+    """Recreates `table` from `ddl` (with {table} for its name), keeping `columns` and recreating `indexes`.
+
+    SQLite's ALTER TABLE cannot drop a column named in a table-level FOREIGN KEY, which is how
+    create_all() declares them, so the table is copied instead.
+    """
+    conn.execute(text(ddl.format(table=f'{table}_rebuild')))
+    conn.execute(text(f'INSERT INTO {table}_rebuild ({", ".join(columns)}) SELECT {", ".join(columns)} FROM {table}'))
+    conn.execute(text(f'DROP TABLE {table}'))
+    conn.execute(text(f'ALTER TABLE {table}_rebuild RENAME TO {table}'))
+    for name, index_table, index_columns in indexes:
+        if index_table == table:
+            create_index_if_missing(conn, name, table, index_columns)
+
+
+def m001_bill_version(conn):
+    if 'invoice' in inspect(conn).get_table_names():
+        return # Built with the billing ledger (m007), where the version lives on the invoice
+    add_column_if_missing(conn, 'appointment', 'bill_version', 'INTEGER NOT NULL DEFAULT 0')
+
+
+# Index names must match the db.Index() declarations on the models.
+HOT_PATH_INDEXES = [
+    # Patient dashboard: appointments for a patient, newest first
+    ('ix_appointment_patient_time', 'appointment', ['patient_id', 'appointment_time']),
+    # (ix_appointment_insurance_claim_time was here; claims moved to insurance_claim in m007)
+    # Timelines and the invoice diagnosis lookup (patient + doctor, latest first)
+    ('ix_medical_record_patient_doctor_created', 'medical_record', ['patient_id', 'doctor_id', 'created_at']),
+    ('ix_medical_record_doctor_id', 'medical_record', ['doctor_id']),
+    ('ix_medical_file_patient_doctor', 'medical_file', ['patient_id', 'doctor_id']),
+    ('ix_medical_file_doctor_id', 'medical_file', ['doctor_id']),
+    # Booking page reviews (newest first) and per-doctor rating aggregates
+    ('ix_doctor_review_doctor_created', 'doctor_review', ['doctor_id', 'created_at']),
+    # Doctor -> permitted patients (the primary key only covers patient -> doctors)
+    ('ix_patient_doctor_permissions_doctor_id', 'patient_doctor_permissions', ['doctor_id']),
+    ('ix_patient_profile_insurance_company_id', 'patient_profile', ['insurance_company_id']),
+]
+
+
+def m002_hot_path_indexes(conn):
+    for name, table, columns in HOT_PATH_INDEXES:
+        create_index_if_missing(conn, name, table, columns)
+
+
+def m003_jobs(conn):
+    conn.execute(text(
+        'CREATE TABLE IF NOT EXISTS job ('
+        'id INTEGER PRIMARY KEY, task VARCHAR(100) NOT NULL, payload TEXT NOT NULL, status VARCHAR(20) NOT NULL, '
+        'attempts INTEGER NOT NULL, max_attempts INTEGER NOT NULL, run_at DATETIME NOT NULL, '
+        'idempotency_key VARCHAR(200) UNIQUE, locked_by VARCHAR(100), locked_at DATETIME, last_error TEXT, '
+        'result TEXT, created_at DATETIME NOT NULL, finished_at DATETIME)'
+    ))
+    create_index_if_missing(conn, 'ix_job_status_run_at', 'job', ['status', 'run_at'])
+    add_column_if_missing(conn, 'medical_file', 'size_bytes', 'INTEGER')
+    add_column_if_missing(conn, 'medical_file', 'sha256', 'VARCHAR(64)')
+
+
+# Index names must match the db.Index() declarations on the archive models.
+ARCHIVE_INDEXES = [
+    ('ix_appointment_archive_patient_time', 'appointment_archive', ['patient_id', 'appointment_time']),
+    ('ix_appointment_archive_doctor_patient', 'appointment_archive', ['doctor_id', 'patient_id']),
+    ('ix_medical_record_archive_patient_doctor_created', 'medical_record_archive', ['patient_id', 'doctor_id', 'created_at']),
+    ('ix_medical_file_archive_patient_doctor', 'medical_file_archive', ['patient_id', 'doctor_id']),
+]
+
+
+def m004_archive_tables(conn):
+    conn.execute(text(
+        'CREATE TABLE IF NOT EXISTS appointment_archive ('
+        'id INTEGER PRIMARY KEY, appointment_time DATETIME NOT NULL, status VARCHAR(20) NOT NULL, '
+        'patient_id INTEGER NOT NULL REFERENCES patient_profile (id), doctor_id INTEGER NOT NULL REFERENCES doctor_profile (id), '
+        'bill_amount FLOAT, bill_status VARCHAR(20) NOT NULL, bill_description TEXT, '
+        'insurance_id INTEGER REFERENCES insurance_profile (id), insurance_claim_status VARCHAR(20) NOT NULL, '
+        'bill_version INTEGER NOT NULL, archived_at DATETIME NOT NULL)'
+    ))
+    conn.execute(text(
+        'CREATE TABLE IF NOT EXISTS medical_record_archive ('
+        'id INTEGER PRIMARY KEY, diagnosis TEXT NOT NULL, notes TEXT, prescription VARCHAR(500), created_at DATETIME NOT NULL, '
+        'patient_id INTEGER NOT NULL REFERENCES patient_profile (id), doctor_id INTEGER NOT NULL REFERENCES doctor_profile (id), '
+        'archived_at DATETIME NOT NULL)'
+    ))
+    conn.execute(text(
+        'CREATE TABLE IF NOT EXISTS medical_file_archive ('
+        'id INTEGER PRIMARY KEY, filename VARCHAR(256) NOT NULL UNIQUE, original_filename VARCHAR(256) NOT NULL, '
+        'description VARCHAR(500), created_at DATETIME NOT NULL, '
+        'patient_id INTEGER NOT NULL REFERENCES patient_profile (id), doctor_id INTEGER NOT NULL REFERENCES doctor_profile (id), '
+        'size_bytes INTEGER, sha256 VARCHAR(64), archived_at DATETIME NOT NULL)'
+    ))
+    for name, table, columns in ARCHIVE_INDEXES:
+        create_index_if_missing(conn, name, table, columns)
+
+
+def m005_schedules(conn):
+    add_column_if_missing(conn, 'doctor_profile', 'schedule_version', 'INTEGER NOT NULL DEFAULT 0')
+    conn.execute(text(
+        'CREATE TABLE IF NOT EXISTS schedule_block ('
+        'id INTEGER PRIMARY KEY, doctor_id INTEGER NOT NULL REFERENCES doctor_profile (id), weekday INTEGER NOT NULL, '
+        'start_time TIME NOT NULL, end_time TIME NOT NULL, slot_duration_minutes INTEGER NOT NULL, location VARCHAR(200))'
+    ))
+    conn.execute(text(
+        'CREATE TABLE IF NOT EXISTS schedule_exception ('
+        'id INTEGER PRIMARY KEY, doctor_id INTEGER NOT NULL REFERENCES doctor_profile (id), date DATE NOT NULL, '
+        'kind VARCHAR(20) NOT NULL, start_time TIME, end_time TIME, slot_duration_minutes INTEGER, '
+        'location VARCHAR(200), reason VARCHAR(200))'
+    ))
+    create_index_if_missing(conn, 'ix_schedule_block_doctor_weekday', 'schedule_block', ['doctor_id', 'weekday'])
+    create_index_if_missing(conn, 'ix_schedule_exception_doctor_date', 'schedule_exception', ['doctor_id', 'date'])
+
+
+def m006_reminders(conn):
+    # SQLite cannot ADD COLUMN with a non-constant default; existing rows start out NULL
+    add_column_if_missing(conn, 'appointment', 'updated_at', 'DATETIME')
+    add_column_if_missing(conn, 'appointment_archive', 'updated_at', 'DATETIME')
+    create_index_if_missing(conn, 'ix_appointment_status_time', 'appointment', ['status', 'appointment_time'])
+    create_index_if_missing(conn, 'ix_appointment_updated_at', 'appointment', ['updated_at'])
+    conn.execute(text(
+        'CREATE TABLE IF NOT EXISTS reminder_outbox ('
+        'id INTEGER PRIMARY KEY, appointment_id INTEGER NOT NULL, appointment_time DATETIME NOT NULL, '
+        'offset_minutes INTEGER NOT NULL, recipient VARCHAR(120) NOT NULL, subject VARCHAR(200) NOT NULL, '
+        'body TEXT NOT NULL, status VARCHAR(20) NOT NULL, attempts INTEGER NOT NULL, last_error TEXT, '
+        'created_at DATETIME NOT NULL, sent_at DATETIME, '
+        'CONSTRAINT _reminder_outbox_uc UNIQUE (appointment_id, appointment_time, offset_minutes))'
+    ))
+    create_index_if_missing(conn, 'ix_reminder_outbox_status_id', 'reminder_outbox', ['status', 'id'])
+
+
+# Index names must match the db.Index() declarations on the billing models.
+BILLING_INDEXES = [
+    ('ix_invoice_patient_time', 'invoice', ['patient_id', 'appointment_time']),
+    ('ix_insurance_claim_insurer_status', 'insurance_claim', ['insurer_id', 'status']),
+    ('ix_insurance_claim_invoice_id', 'insurance_claim', ['invoice_id']),
+    ('ix_payment_invoice_id', 'payment', ['invoice_id']),
+    ('ix_billing_event_invoice_id', 'billing_event', ['invoice_id', 'id']),
+]
+
+# Appointment columns replaced by the billing tables
+LEGACY_BILLING_COLUMNS = {'bill_amount', 'bill_status', 'bill_description', 'insurance_id', 'insurance_claim_status',
+                          'bill_version'}
+# The appointment tables as m007 leaves them: (table, DDL, columns, indexes)
+APPOINTMENT_TABLES_V7 = [
+    ('appointment',
+     'CREATE TABLE {table} (id INTEGER NOT NULL PRIMARY KEY, appointment_time DATETIME NOT NULL, status VARCHAR(20) NOT NULL, '
+     'patient_id INTEGER NOT NULL REFERENCES patient_profile (id), doctor_id INTEGER NOT NULL REFERENCES doctor_profile (id), '
+     'updated_at DATETIME, CONSTRAINT _doctor_time_uc UNIQUE (doctor_id, appointment_time))',
+     ['id', 'appointment_time', 'status', 'patient_id', 'doctor_id', 'updated_at'],
+     HOT_PATH_INDEXES + [('ix_appointment_status_time', 'appointment', ['status', 'appointment_time']),
+                         ('ix_appointment_updated_at', 'appointment', ['updated_at'])]),
+    ('appointment_archive',
+     'CREATE TABLE {table} (id INTEGER NOT NULL PRIMARY KEY, appointment_time DATETIME NOT NULL, status VARCHAR(20) NOT NULL, '
+     'patient_id INTEGER NOT NULL REFERENCES patient_profile (id), doctor_id INTEGER NOT NULL REFERENCES doctor_profile (id), '
+     'updated_at DATETIME, archived_at DATETIME NOT NULL)',
+     ['id', 'appointment_time', 'status', 'patient_id', 'doctor_id', 'updated_at', 'archived_at'],
+     ARCHIVE_INDEXES),
+]
+
+
+def m007_billing_ledger(conn):
+    conn.execute(text(
+        'CREATE TABLE IF NOT EXISTS invoice ('
+        'id INTEGER PRIMARY KEY, appointment_id INTEGER NOT NULL UNIQUE, '
+        'patient_id INTEGER NOT NULL REFERENCES patient_profile (id), doctor_id INTEGER NOT NULL REFERENCES doctor_profile (id), '
+        'appointment_time DATETIME NOT NULL, amount FLOAT NOT NULL, description TEXT, status VARCHAR(20) NOT NULL, '
+        'claim_id INTEGER, version INTEGER NOT NULL DEFAULT 0, issued_at DATETIME NOT NULL, updated_at DATETIME NOT NULL)'
+    ))
+    conn.execute(text(
+        'CREATE TABLE IF NOT EXISTS insurance_claim ('
+        'id INTEGER PRIMARY KEY, invoice_id INTEGER NOT NULL REFERENCES invoice (id), '
+        'insurer_id INTEGER NOT NULL REFERENCES insurance_profile (id), policy_id VARCHAR(100), amount FLOAT NOT NULL, '
+        'status VARCHAR(20) NOT NULL, submitted_at DATETIME NOT NULL, decided_at DATETIME)'
+    ))
+    conn.execute(text(
+        'CREATE TABLE IF NOT EXISTS payment ('
+        'id INTEGER PRIMARY KEY, invoice_id INTEGER NOT NULL REFERENCES invoice (id), amount FLOAT NOT NULL, '
+        'method VARCHAR(20) NOT NULL, claim_id INTEGER REFERENCES insurance_claim (id), paid_at DATETIME NOT NULL)'
+    ))
+    conn.execute(text(
+        'CREATE TABLE IF NOT EXISTS billing_event ('
+        'id INTEGER PRIMARY KEY, invoice_id INTEGER NOT NULL REFERENCES invoice (id), kind VARCHAR(30) NOT NULL, '
+        'amount FLOAT, claim_id INTEGER, payment_id INTEGER, actor_user_id INTEGER, status_after VARCHAR(20) NOT NULL, '
+        'created_at DATETIME NOT NULL)'
+    ))
+    for name, table, columns in BILLING_INDEXES:
+        create_index_if_missing(conn, name, table, columns)
+
+    tables = set(inspect(conn).get_table_names())
+    legacy = [t for t in ('appointment', 'appointment_archive')
+              if t in tables and 'bill_status' in {c['name'] for c in inspect(conn).get_columns(t)}]
+    now = datetime.datetime.now()
+    # Copy every billed appointment's bill and claim. Old rows never recorded how or when they
+    # were paid, so those payments are marked 'migrated' (or 'insurance' for accepted claims).
+    for table in legacy:
+        conn.execute(text(
+            'INSERT INTO invoice (appointment_id, patient_id, doctor_id, appointment_time, amount, description, status, '
+            'version, issued_at, updated_at) '
+            'SELECT a.id, a.patient_id, a.doctor_id, a.appointment_time, COALESCE(a.bill_amount, 0), a.bill_description, '
+            "CASE WHEN a.bill_status IN ('Paid', 'Pending Insurance') THEN a.bill_status ELSE 'Unpaid' END, "
+            'a.bill_version, COALESCE(a.updated_at, a.appointment_time), COALESCE(a.updated_at, a.appointment_time) '
+            f'FROM {table} a '
+            "WHERE a.bill_status != 'Unbilled' AND NOT EXISTS (SELECT 1 FROM invoice i WHERE i.appointment_id = a.id)"
+        ))
+        conn.execute(text(
+            'INSERT INTO insurance_claim (invoice_id, insurer_id, amount, status, submitted_at, decided_at) '
+            "SELECT i.id, a.insurance_id, i.amount, a.insurance_claim_status, i.issued_at, "
+            "CASE WHEN a.insurance_claim_status != 'Pending' THEN i.updated_at END "
+            f'FROM {table} a JOIN invoice i ON i.appointment_id = a.id '
+            "WHERE a.insurance_id IS NOT NULL AND a.insurance_claim_status IN ('Pending', 'Accepted', 'Rejected') "
+            'AND i.claim_id IS NULL AND NOT EXISTS (SELECT 1 FROM insurance_claim c WHERE c.invoice_id = i.id)'
+        ))
+    conn.execute(text(
+        'UPDATE invoice SET claim_id = (SELECT max(c.id) FROM insurance_claim c WHERE c.invoice_id = invoice.id) '
+        'WHERE claim_id IS NULL'
+    ))
+    conn.execute(text(
+        'INSERT INTO payment (invoice_id, amount, method, claim_id, paid_at) '
+        "SELECT i.id, i.amount, CASE WHEN c.status = 'Accepted' THEN 'insurance' ELSE 'migrated' END, "
+        "CASE WHEN c.status = 'Accepted' THEN c.id END, i.updated_at "
+        'FROM invoice i LEFT JOIN insurance_claim c ON c.id = i.claim_id '
+        "WHERE i.status = 'Paid' AND NOT EXISTS (SELECT 1 FROM payment p WHERE p.invoice_id = i.id)"
+    ))
+    conn.execute(text(
+        'INSERT INTO billing_event (invoice_id, kind, amount, claim_id, payment_id, status_after, created_at) '
+        "SELECT i.id, 'migrated', i.amount, i.claim_id, (SELECT max(p.id) FROM payment p WHERE p.invoice_id = i.id), "
+        'i.status, :now FROM invoice i WHERE NOT EXISTS (SELECT 1 FROM billing_event e WHERE e.invoice_id = i.id)'
+    ), {'now': now})
+
+    # Drops the old columns (and the claim indexes on them); m001 may have added bill_version alone
+    for table, ddl, columns, indexes in APPOINTMENT_TABLES_V7:
+        if table in tables and LEGACY_BILLING_COLUMNS & {c['name'] for c in inspect(conn).get_columns(table)}:
+            rebuild_table(conn, table, ddl, columns, indexes)
+
+
+SEARCH_INDEXES = [
+    # Doctor search and the booking page: rating averages per doctor, from the index alone
+    ('ix_doctor_review_doctor_ratings', 'doctor_review',
+     ['doctor_id', 'overall_rating', 'cost_rating', 'hospitality_rating', 'med_rec_rating']),
+    # Doctor search by specialty, and the list of distinct specialties
+    ('ix_doctor_profile_specialty', 'doctor_profile', ['specialty']),
+]
+
+
+def m008_search_indexes(conn):
+    for name, table, columns in SEARCH_INDEXES:
+        create_index_if_missing(conn, name, table, columns)
+
+
+def m009_specialty_nocase_index(conn):
+    conn.execute(text('CREATE INDEX IF NOT EXISTS ix_doctor_profile_specialty_nocase ON doctor_profile (specialty COLLATE NOCASE)'))
+
+
+MIGRATIONS = [
+    (1, 'Add appointment.bill_version', m001_bill_version),
+    (2, 'Foreign-key and hot-path indexes', m002_hot_path_indexes),
+    (3, 'Background job table and upload fingerprints', m003_jobs),
+    (4, 'Archive tables for settled history', m004_archive_tables),
+    (5, 'Doctor schedule templates and exceptions', m005_schedules),
+    (6, 'Appointment change tracking and reminder outbox', m006_reminders),
+    (7, 'Billing ledger: invoices, claims, payments and events', m007_billing_ledger),
+    (8, 'Doctor search indexes', m008_search_indexes),
+    (9, 'Case-insensitive doctor specialty index', m009_specialty_nocase_index),
+]
+
+
+def ensure_migrations_table(conn):
+    conn.execute(text(
+        'CREATE TABLE IF NOT EXISTS schema_migrations ('
+        'version INTEGER PRIMARY KEY, description VARCHAR(200) NOT NULL, applied_at DATETIME NOT NULL)'
+    ))
+
+
+def applied_versions(conn):
+    ensure_migrations_table(conn)
+    return set(conn.execute(text('SELECT version FROM schema_migrations')).scalars())
+
+
+def pending_migrations(engine):
+    with engine.begin() as conn:
+        done = applied_versions(conn)
+    return [m for m in MIGRATIONS if m[0] not in done]
+
+
+def upgrade(engine, echo=None):
+    """Applies every pending migration, each in its own transaction. Returns the versions applied.
+
+    A database without any application tables is left alone: create_all() will
+    build it from the models, which already include every migration.
+    """
+    if 'appointment' not in inspect(engine).get_table_names():
+        return []
+
+    applied = []
+    for version, description, migrate in pending_migrations(engine):
+        try:
+            with engine.begin() as conn:
+                migrate(conn)
+                conn.execute(
+                    text('INSERT INTO schema_migrations (version, description, applied_at) VALUES (:v, :d, :t)'),
+                    {'v': version, 'd': description, 't': datetime.datetime.now()}
+                )
+        except IntegrityError:
+            continue # Another worker recorded it first
+        applied.append(version)
+        if echo:
+            echo(f'Applied migration {version}: {description}')
+    return applied
@@ -0,0 +1,405 @@
+"""SQLAlchemy models.
+
+Kept free of the Flask app so scripts (init_db.py, generate_data.py) and
+tools can import the schema without building the whole application. The
+`db` extension is bound to an app in main.create_app().
+"""
+import datetime
+from flask_sqlalchemy import SQLAlchemy
+from flask_login import UserMixin
+from shards import RoutingSession, qualify_id
+
+db = SQLAlchemy(session_options={'class_': RoutingSession}) # Routes each request to its region (see shards.py)
+
+# --- Database Models (UPDATED) ---
+
+# (Permissions Table Unchanged)
+patient_doctor_permissions = db.Table('patient_doctor_permissions',
+    db.Column('patient_id', db.Integer, db.ForeignKey('patient_profile.id'), primary_key=True),
+    db.Column('doctor_id', db.Integer, db.ForeignKey('doctor_profile.id'), primary_key=True),
+    db.Index('ix_patient_doctor_permissions_doctor_id', 'doctor_id')
+)
+
+# (User Model Unchanged)
+class User(db.Model, UserMixin):
+    id = db.Column(db.Integer, primary_key=True)
+    email = db.Column(db.String(120), unique=True, nullable=False)
+    password_hash = db.Column(db.String(60), nullable=False)
+    role = db.Column(db.String(20), nullable=False)
+    
+    patient_profile = db.relationship('PatientProfile', backref='user', uselist=False, cascade="all, delete-orphan")
+    doctor_profile = db.relationship('DoctorProfile', backref='user', uselist=False, cascade="all, delete-orphan")
+    insurance_profile = db.relationship('InsuranceProfile', backref='user', uselist=False, cascade="all, delete-orphan")
+
+    def get_id(self):
+        # Carries the account's region when the app is sharded, so load_user knows where to look
+        return qualify_id(self.id)
+
+class PatientProfile(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    full_name = db.Column(db.String(100), nullable=False, default='Unnamed')
+    phone = db.Column(db.String(20))
+    address = db.Column(db.String(200))
+    pincode = db.Column(db.String(10))
+    latitude = db.Column(db.Float)
+    longitude = db.Column(db.Float)
+    
+    # --- NEW: Insurance Details for Patient ---
+    insurance_policy_id = db.Column(db.String(100), nullable=True)
+    insurance_company_id = db.Column(db.Integer, db.ForeignKey('insurance_profile.id'), nullable=True)
+    
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, unique=True)
+    
+    records = db.relationship('MedicalRecord', backref='patient', lazy='dynamic', foreign_keys='MedicalRecord.patient_id')
+    appointments = db.relationship('Appointment', backref='patient', lazy='dynamic', foreign_keys='Appointment.patient_id')
+    reviews = db.relationship('DoctorReview', backref='patient', lazy='dynamic', foreign_keys='DoctorReview.patient_id')
+    files = db.relationship('MedicalFile', backref='patient', lazy='dynamic', foreign_keys='MedicalFile.patient_id')
+    
+    permitted_doctors = db.relationship('DoctorProfile', secondary=patient_doctor_permissions,
+        back_populates='permitted_patients')
+    
+    # --- NEW: Relationship to their insurance company ---
+    insurance_company = db.relationship('InsuranceProfile', foreign_keys=[insurance_company_id])
+
+    __table_args__ = (db.Index('ix_patient_profile_insurance_company_id', 'insurance_company_id'),)
+
+
+class DoctorProfile(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    full_name = db.Column(db.String(100), nullable=False, default='Dr. Unnamed')
+    phone = db.Column(db.String(20))
+    specialty = db.Column(db.String(100))
+    practice_address = db.Column(db.String(200))
+    pincode = db.Column(db.String(10))
+    latitude = db.Column(db.Float)
+    longitude = db.Column(db.Float)
+    
+    # --- NEW: Availability Fields ---
+    availability_start_time = db.Column(db.Time) # e.g., 09:00:00
+    availability_end_time = db.Column(db.Time)   # e.g., 17:00:00
+    slot_duration_minutes = db.Column(db.Integer, default=30)
+    # Bumped on every schedule change; keys the compiled-schedule cache (see schedule.py)
+    schedule_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, unique=True)
+    
+    records_written = db.relationship('MedicalRecord', backref='doctor', lazy='dynamic', foreign_keys='MedicalRecord.doctor_id')
+    appointments = db.relationship('Appointment', backref='doctor', lazy='dynamic', foreign_keys='Appointment.doctor_id')
+    reviews = db.relationship('DoctorReview', backref='doctor_profile', lazy='dynamic', foreign_keys='DoctorReview.doctor_id')
+    files_written = db.relationship('MedicalFile', backref='doctor', lazy='dynamic', foreign_keys='MedicalFile.doctor_id')
+    
+    permitted_patients = db.relationship('PatientProfile', secondary=patient_doctor_permissions,
+        back_populates='permitted_doctors')
+
+    __table_args__ = (
+        db.Index('ix_doctor_profile_specialty', 'specialty'),
+        # Case-insensitive prefix search (LIKE 'cardio%') seeks on this one
+        db.Index('ix_doctor_profile_specialty_nocase', db.text('specialty COLLATE NOCASE')),
+    )
+
+# (Other Models Unchanged)
+class InsuranceProfile(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    company_name = db.Column(db.String(100), nullable=False, default='Unnamed Company')
+    phone = db.Column(db.String(20))
+    company_address = db.Column(db.String(200))
+    pincode = db.Column(db.String(10))
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, unique=True)
+
+class MedicalRecord(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    diagnosis = db.Column(db.Text, nullable=False)
+    notes = db.Column(db.Text)
+    prescription = db.Column(db.String(500))
+    created_at = db.Column(db.DateTime, nullable=False, default=db.func.current_timestamp())
+    patient_id = db.Column(db.Integer, db.ForeignKey('patient_profile.id'), nullable=False)
+    doctor_id = db.Column(db.Integer, db.ForeignKey('doctor_profile.id'), nullable=False)
+
+    # Index names are shared with migrations.HOT_PATH_INDEXES
+    __table_args__ = (
+        db.Index('ix_medical_record_patient_doctor_created', 'patient_id', 'doctor_id', 'created_at'),
+        db.Index('ix_medical_record_doctor_id', 'doctor_id'),
+    )
+
+class Appointment(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    appointment_time = db.Column(db.DateTime, nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='Pending') # Pending, Confirmed, Cancelled, Completed
+    patient_id = db.Column(db.Integer, db.ForeignKey('patient_profile.id'), nullable=False)
+    doctor_id = db.Column(db.Integer, db.ForeignKey('doctor_profile.id'), nullable=False)
+    # Set on every ORM insert and update; the reminder scheduler polls it for changed bookings
+    updated_at = db.Column(db.DateTime, default=datetime.datetime.now, onupdate=datetime.datetime.now)
+
+    # --- UPDATED: Billing lives in the invoice tables (see billing.py); None until the doctor bills ---
+    invoice = db.relationship('Invoice', primaryjoin='foreign(Invoice.appointment_id) == Appointment.id',
+                              uselist=False, viewonly=True)
+    
+    # --- NEW: Unique constraint for doctor and time ---
+    # This ensures only one patient can book a specific slot with a doctor
+    # (doctor_id, appointment_time) also serves as the doctor's index, so doctor_id needs no index of its own
+    __table_args__ = (
+        db.UniqueConstraint('doctor_id', 'appointment_time', name='_doctor_time_uc'),
+        db.Index('ix_appointment_patient_time', 'patient_id', 'appointment_time'),
+        # Reminder scheduler: confirmed appointments in a time window, and bookings changed since its last poll
+        db.Index('ix_appointment_status_time', 'status', 'appointment_time'),
+        db.Index('ix_appointment_updated_at', 'updated_at'),
+    )
+
+
+class DoctorReview(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    cost_rating = db.Column(db.Integer, nullable=False) # 1-10
+    hospitality_rating = db.Column(db.Integer, nullable=False) # 1-10
+    med_rec_rating = db.Column(db.Integer, nullable=False) # 1-10
+    overall_rating = db.Column(db.Integer, nullable=False) # 1-10
+    comment = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, nullable=False, default=db.func.current_timestamp())
+    patient_id = db.Column(db.Integer, db.ForeignKey('patient_profile.id'), nullable=False)
+    doctor_id = db.Column(db.Integer, db.ForeignKey('doctor_profile.id'), nullable=False)
+    __table_args__ = (
+        db.UniqueConstraint('patient_id', 'doctor_id', name='_patient_doctor_review_uc'),
+        db.Index('ix_doctor_review_doctor_created', 'doctor_id', 'created_at'),
+        # Covers the per-doctor rating averages, so they never read the table itself
+        db.Index('ix_doctor_review_doctor_ratings', 'doctor_id', 'overall_rating', 'cost_rating', 'hospitality_rating',
+                 'med_rec_rating'),
+    )
+
+class MedicalFile(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    filename = db.Column(db.String(256), unique=True, nullable=False)
+    original_filename = db.Column(db.String(256), nullable=False)
+    description = db.Column(db.String(500))
+    created_at = db.Column(db.DateTime, nullable=False, default=db.func.current_timestamp())
+    patient_id = db.Column(db.Integer, db.ForeignKey('patient_profile.id'), nullable=False)
+    doctor_id = db.Column(db.Integer, db.ForeignKey('doctor_profile.id'), nullable=False)
+    # Filled in by the fingerprint_upload job after the upload commits
+    size_bytes = db.Column(db.Integer)
+    sha256 = db.Column(db.String(64))
+
+    __table_args__ = (
+        db.Index('ix_medical_file_patient_doctor', 'patient_id', 'doctor_id'),
+        db.Index('ix_medical_file_doctor_id', 'doctor_id'),
+    )
+
+
+# --- NEW: Background job queue (see jobs.py) ---
+class Job(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    task = db.Column(db.String(100), nullable=False)
+    payload = db.Column(db.Text, nullable=False, default='{}') # JSON keyword arguments for the task
+    status = db.Column(db.String(20), nullable=False, default='queued') # queued, running, succeeded, failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=5)
+    # Times are local Python datetimes (not CURRENT_TIMESTAMP, which is UTC) so they compare with run_at
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.now)
+    idempotency_key = db.Column(db.String(200), unique=True)
+    locked_by = db.Column(db.String(100))
+    locked_at = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+    result = db.Column(db.Text) # JSON returned by the task
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.now)
+    finished_at = db.Column(db.DateTime)
+
+    # Workers look for the oldest due job: status = 'queued' AND run_at <= now
+    __table_args__ = (
+        db.Index('ix_job_status_run_at', 'status', 'run_at'),
+    )
+
+
+# --- NEW: Weekly schedule templates and dated exceptions (see schedule.py) ---
+class ScheduleBlock(db.Model):
+    """A recurring session in a doctor's week, e.g. Mondays 09:00-13:00 at the main clinic."""
+    id = db.Column(db.Integer, primary_key=True)
+    doctor_id = db.Column(db.Integer, db.ForeignKey('doctor_profile.id'), nullable=False)
+    weekday = db.Column(db.Integer, nullable=False) # 0 = Monday ... 6 = Sunday
+    start_time = db.Column(db.Time, nullable=False)
+    end_time = db.Column(db.Time, nullable=False)
+    slot_duration_minutes = db.Column(db.Integer, nullable=False, default=30)
+    location = db.Column(db.String(200)) # Clinic or session name shown with the slot
+
+    doctor = db.relationship('DoctorProfile', backref=db.backref('schedule_blocks', lazy='dynamic'))
+
+    __table_args__ = (
+        db.Index('ix_schedule_block_doctor_weekday', 'doctor_id', 'weekday'),
+    )
+
+class ScheduleException(db.Model):
+    """A dated change to the weekly template: time off ('unavailable') or an extra session ('available')."""
+    id = db.Column(db.Integer, primary_key=True)
+    doctor_id = db.Column(db.Integer, db.ForeignKey('doctor_profile.id'), nullable=False)
+    date = db.Column(db.Date, nullable=False)
+    kind = db.Column(db.String(20), nullable=False, default='unavailable') # unavailable, available
+    start_time = db.Column(db.Time) # Both empty on an 'unavailable' exception = the whole day
+    end_time = db.Column(db.Time)
+    slot_duration_minutes = db.Column(db.Integer)
+    location = db.Column(db.String(200))
+    reason = db.Column(db.String(200))
+
+    doctor = db.relationship('DoctorProfile', backref=db.backref('schedule_exceptions', lazy='dynamic'))
+
+    __table_args__ = (
+        db.Index('ix_schedule_exception_doctor_date', 'doctor_id', 'date'),
+    )
+
+
+# --- NEW: Reminder outbox (see reminders.py) ---
+class ReminderOutbox(db.Model):
+    """A reminder that fell due, waiting for (or done with) the configured sender."""
+    __tablename__ = 'reminder_outbox'
+    id = db.Column(db.Integer, primary_key=True)
+    appointment_id = db.Column(db.Integer, nullable=False) # No foreign key: the appointment may be archived later
+    appointment_time = db.Column(db.DateTime, nullable=False)
+    offset_minutes = db.Column(db.Integer, nullable=False) # How long before the appointment it was due
+    recipient = db.Column(db.String(120), nullable=False)
+    subject = db.Column(db.String(200), nullable=False)
+    body = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='pending') # pending, sent, failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.now)
+    sent_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        # One reminder per appointment, time and offset however often the scheduler restarts
+        db.UniqueConstraint('appointment_id', 'appointment_time', 'offset_minutes', name='_reminder_outbox_uc'),
+        db.Index('ix_reminder_outbox_status_id', 'status', 'id'),
+    )
+
+
+# --- NEW: Billing ledger (see billing.py) ---
+# An invoice per billed appointment, the insurance claims and payments made against it, and
+# an append-only log of every change. Billing writes touch these narrow rows, never the
+# appointment, and the log keeps the history the old status columns overwrote.
+class Invoice(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    # No foreign key: the appointment may be archived later (it keeps its id)
+    appointment_id = db.Column(db.Integer, nullable=False, unique=True)
+    # Copied from the appointment so statements need neither the hot nor the archive appointment table
+    patient_id = db.Column(db.Integer, db.ForeignKey('patient_profile.id'), nullable=False)
+    doctor_id = db.Column(db.Integer, db.ForeignKey('doctor_profile.id'), nullable=False)
+    appointment_time = db.Column(db.DateTime, nullable=False)
+    amount = db.Column(db.Float, nullable=False)
+    description = db.Column(db.Text)
+    status = db.Column(db.String(20), nullable=False, default='Unpaid') # Unpaid, Pending Insurance, Paid
+    # The claim currently attached; earlier (rejected) claims stay in insurance_claim
+    claim_id = db.Column(db.Integer)
+    # Bumped on every change; keys the invoice cache and the invoice ETag
+    version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    issued_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.now)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.now, onupdate=datetime.datetime.now)
+
+    patient = db.relationship('PatientProfile', viewonly=True)
+    doctor = db.relationship('DoctorProfile', viewonly=True)
+    claim = db.relationship('InsuranceClaim', primaryjoin='foreign(Invoice.claim_id) == InsuranceClaim.id', viewonly=True)
+
+    __table_args__ = (
+        # Patient statements and dashboards: a patient's invoices by visit time
+        db.Index('ix_invoice_patient_time', 'patient_id', 'appointment_time'),
+    )
+
+class InsuranceClaim(db.Model):
+    __tablename__ = 'insurance_claim'
+    id = db.Column(db.Integer, primary_key=True)
+    invoice_id = db.Column(db.Integer, db.ForeignKey('invoice.id'), nullable=False)
+    insurer_id = db.Column(db.Integer, db.ForeignKey('insurance_profile.id'), nullable=False)
+    policy_id = db.Column(db.String(100))
+    amount = db.Column(db.Float, nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='Pending') # Pending, Accepted, Rejected
+    submitted_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.now)
+    decided_at = db.Column(db.DateTime)
+
+    insurer = db.relationship('InsuranceProfile', viewonly=True)
+
+    __table_args__ = (
+        # Insurer dashboard and statements: an insurer's claims by status
+        db.Index('ix_insurance_claim_insurer_status', 'insurer_id', 'status'),
+        db.Index('ix_insurance_claim_invoice_id', 'invoice_id'),
+    )
+
+class Payment(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    invoice_id = db.Column(db.Integer, db.ForeignKey('invoice.id'), nullable=False)
+    amount = db.Column(db.Float, nullable=False)
+    method = db.Column(db.String(20), nullable=False) # upi, insurance, at_clinic, migrated
+    claim_id = db.Column(db.Integer, db.ForeignKey('insurance_claim.id')) # Set when an accepted claim paid it
+    paid_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.now)
+
+    __table_args__ = (db.Index('ix_payment_invoice_id', 'invoice_id'),)
+
+class BillingEvent(db.Model):
+    """One change to an invoice. Rows are only ever inserted."""
+    __tablename__ = 'billing_event'
+    id = db.Column(db.Integer, primary_key=True)
+    invoice_id = db.Column(db.Integer, db.ForeignKey('invoice.id'), nullable=False)
+    # issued, reissued, claim_submitted, claim_accepted, claim_rejected, paid, migrated
+    kind = db.Column(db.String(30), nullable=False)
+    amount = db.Column(db.Float)
+    claim_id = db.Column(db.Integer)
+    payment_id = db.Column(db.Integer)
+    actor_user_id = db.Column(db.Integer) # None for changes made by scripts and migrations
+    status_after = db.Column(db.String(20), nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.now)
+
+    __table_args__ = (db.Index('ix_billing_event_invoice_id', 'invoice_id', 'id'),)
+
+
+# --- NEW: Archive tables (see archive.py) ---
+# Settled history is moved here, keeping its ids, so the hot tables and their indexes stay
+# small. Columns mirror the hot models; archived_at records when the row was moved.
+class ArchivedAppointment(db.Model):
+    __tablename__ = 'appointment_archive'
+    id = db.Column(db.Integer, primary_key=True)
+    appointment_time = db.Column(db.DateTime, nullable=False)
+    status = db.Column(db.String(20), nullable=False)
+    patient_id = db.Column(db.Integer, db.ForeignKey('patient_profile.id'), nullable=False)
+    doctor_id = db.Column(db.Integer, db.ForeignKey('doctor_profile.id'), nullable=False)
+    updated_at = db.Column(db.DateTime)
+    archived_at = db.Column(db.DateTime, nullable=False)
+
+    patient = db.relationship('PatientProfile', viewonly=True)
+    doctor = db.relationship('DoctorProfile', viewonly=True)
+    invoice = db.relationship('Invoice', primaryjoin='foreign(Invoice.appointment_id) == ArchivedAppointment.id',
+                              uselist=False, viewonly=True)
+
+    __table_args__ = (
+        db.Index('ix_appointment_archive_patient_time', 'patient_id', 'appointment_time'),
+        db.Index('ix_appointment_archive_doctor_patient', 'doctor_id', 'patient_id'),
+    )
+
+class ArchivedMedicalRecord(db.Model):
+    __tablename__ = 'medical_record_archive'
+    id = db.Column(db.Integer, primary_key=True)
+    diagnosis = db.Column(db.Text, nullable=False)
+    notes = db.Column(db.Text)
+    prescription = db.Column(db.String(500))
+    created_at = db.Column(db.DateTime, nullable=False)
+    patient_id = db.Column(db.Integer, db.ForeignKey('patient_profile.id'), nullable=False)
+    doctor_id = db.Column(db.Integer, db.ForeignKey('doctor_profile.id'), nullable=False)
+    archived_at = db.Column(db.DateTime, nullable=False)
+
+    patient = db.relationship('PatientProfile', viewonly=True)
+    doctor = db.relationship('DoctorProfile', viewonly=True)
+
+    __table_args__ = (
+        db.Index('ix_medical_record_archive_patient_doctor_created', 'patient_id', 'doctor_id', 'created_at'),
+    )
+
+class ArchivedMedicalFile(db.Model):
+    __tablename__ = 'medical_file_archive'
+    id = db.Column(db.Integer, primary_key=True)
+    filename = db.Column(db.String(256), unique=True, nullable=False)
+    original_filename = db.Column(db.String(256), nullable=False)
+    description = db.Column(db.String(500))
+    created_at = db.Column(db.DateTime, nullable=False)
+    patient_id = db.Column(db.Integer, db.ForeignKey('patient_profile.id'), nullable=False)
+    doctor_id = db.Column(db.Integer, db.ForeignKey('doctor_profile.id'), nullable=False)
+    size_bytes = db.Column(db.Integer)
+    sha256 = db.Column(db.String(64))
+    archived_at = db.Column(db.DateTime, nullable=False)
+
+    patient = db.relationship('PatientProfile', viewonly=True)
+    doctor = db.relationship('DoctorProfile', viewonly=True)
+
+    __table_args__ = (
+        db.Index('ix_medical_file_archive_patient_doctor', 'patient_id', 'doctor_id'),
+    )
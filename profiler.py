@@ -0,0 +1,171 @@
+"""On-demand cProfile sampling of live requests.
+
+An admin picks the endpoints to watch and a sample rate from /admin/profiling.
+The settings are kept in PROFILE_DIR/settings.json, so every worker process
+picks up a change on its next request without a restart. A sampled request is
+run under cProfile and written to PROFILE_DIR as <id>.prof (loadable with
+pstats or snakeviz) next to <id>.json holding the request metadata.
+"""
+import cProfile
+import datetime
+import json
+import os
+import pstats
+import random
+import re
+import threading
+import time
+import uuid
+from flask import g, request
+from flask_login import current_user
+
+DEFAULT_SETTINGS = {'enabled': False, 'endpoints': [], 'sample_rate': 0.1}
+PROFILE_ID_RE = re.compile(r'^[0-9T]+-[\w.]+-[0-9a-f]{8}$')
+SORT_KEYS = {'cumulative': 'cumtime', 'tottime': 'tottime', 'ncalls': 'ncalls'}
+
+# Only one cProfile.Profile can be active per process on newer Pythons, so
+# concurrent requests that lose the race are simply not sampled.
+_profiler_lock = threading.Lock()
+_settings_cache = {'mtime': None, 'settings': DEFAULT_SETTINGS}
+
+
+def settings_path(profile_dir):
+    return os.path.join(profile_dir, 'settings.json')
+
+
+def load_settings(profile_dir):
+    """Returns the current settings, re-reading the file only when it has changed."""
+    try:
+        mtime = os.stat(settings_path(profile_dir)).st_mtime_ns
+    except FileNotFoundError:
+        return DEFAULT_SETTINGS
+    if mtime != _settings_cache['mtime']:
+        try:
+            with open(settings_path(profile_dir)) as f:
+                settings = {**DEFAULT_SETTINGS, **json.load(f)}
+        except (OSError, ValueError):
+            settings = DEFAULT_SETTINGS
+        _settings_cache.update(mtime=mtime, settings=settings)
+    return _settings_cache['settings']
+
+
+def save_settings(profile_dir, enabled, endpoints, sample_rate):
+    os.makedirs(profile_dir, exist_ok=True)
+    settings = {'enabled': bool(enabled), 'endpoints': sorted(set(endpoints)),
+                'sample_rate': min(max(float(sample_rate), 0.0), 1.0)}
+    tmp_path = settings_path(profile_dir) + f'.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(settings, f)
+    os.replace(tmp_path, settings_path(profile_dir)) # Atomic, so workers never read a half-written file
+    return settings
+
+
+def list_profiles(profile_dir, limit=100):
+    """Metadata of the newest saved profiles, newest first."""
+    if not os.path.isdir(profile_dir):
+        return []
+    names = sorted((n for n in os.listdir(profile_dir) if n.endswith('.json') and n != 'settings.json'), reverse=True)
+    profiles = []
+    for name in names[:limit]:
+        try:
+            with open(os.path.join(profile_dir, name)) as f:
+                profiles.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return profiles
+
+
+def load_profile_meta(profile_dir, profile_id):
+    if not PROFILE_ID_RE.match(profile_id):
+        return None
+    try:
+        with open(os.path.join(profile_dir, profile_id + '.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def top_functions(profile_dir, profile_id, sort='cumulative', limit=40):
+    """Returns the top `limit` functions of a saved profile, and the profile's total time."""
+    stats = pstats.Stats(os.path.join(profile_dir, profile_id + '.prof'))
+    key = SORT_KEYS.get(sort, 'cumtime')
+    rows = []
+    for (filename, lineno, funcname), (cc, nc, tt, ct, callers) in stats.stats.items():
+        rows.append({
+            'ncalls': nc if nc == cc else f'{nc}/{cc}',
+            'calls': nc,
+            'tottime': tt,
+            'cumtime': ct,
+            'location': f'{funcname} ({filename}:{lineno})' if lineno else funcname,
+        })
+    rows.sort(key=lambda row: row['calls' if key == 'ncalls' else key], reverse=True)
+    return rows[:limit], stats.total_tt
+
+
+def prune_profiles(profile_dir, keep):
+    names = sorted(n[:-5] for n in os.listdir(profile_dir) if n.endswith('.prof'))
+    for profile_id in names[:-keep] if keep else []:
+        for ext in ('.prof', '.json'):
+            try:
+                os.remove(os.path.join(profile_dir, profile_id + ext))
+            except FileNotFoundError:
+                pass
+
+
+def init_profiler(app):
+    app.config.setdefault('PROFILE_DIR', os.path.join(app.root_path, 'logs', 'profiles'))
+    app.config.setdefault('PROFILE_KEEP', 500) # Oldest profiles beyond this are deleted
+
+    @app.before_request
+    def start_sampled_profile():
+        settings = load_settings(app.config['PROFILE_DIR'])
+        if not settings['enabled'] or request.endpoint not in settings['endpoints']:
+            return
+        if random.random() >= settings['sample_rate'] or not _profiler_lock.acquire(blocking=False):
+            return
+        g.cprofile = cProfile.Profile()
+        g.cprofile_started = time.perf_counter()
+        try:
+            g.cprofile.enable()
+        except ValueError: # Another profiler (e.g. a debugger) already owns the hook
+            g.pop('cprofile')
+            _profiler_lock.release()
+
+    @app.after_request
+    def save_sampled_profile(response):
+        if 'cprofile' not in g:
+            return response
+        profile = g.pop('cprofile')
+        try:
+            profile.disable()
+        finally:
+            _profiler_lock.release()
+
+        profile_dir = app.config['PROFILE_DIR']
+        now = datetime.datetime.now()
+        profile_id = f'{now:%Y%m%dT%H%M%S%f}-{request.endpoint}-{uuid.uuid4().hex[:8]}'
+        os.makedirs(profile_dir, exist_ok=True)
+        profile.dump_stats(os.path.join(profile_dir, profile_id + '.prof'))
+        meta = {
+            'id': profile_id,
+            'created_at': now.isoformat(timespec='seconds'),
+            'endpoint': request.endpoint,
+            'method': request.method,
+            'path': request.path,
+            'user_id': current_user.get_id() if current_user.is_authenticated else None,
+            'status': response.status_code,
+            'duration_ms': round((time.perf_counter() - g.cprofile_started) * 1000, 1),
+            'sql_count': g.get('sql_count'),
+            'pid': os.getpid(),
+        }
+        with open(os.path.join(profile_dir, profile_id + '.json'), 'w') as f:
+            json.dump(meta, f)
+        prune_profiles(profile_dir, app.config['PROFILE_KEEP'])
+        return response
+
+    @app.teardown_request
+    def release_profiler(exc):
+        # after_request is skipped when a view raises; make sure the hook and lock are released
+        if 'cprofile' in g:
+            g.pop('cprofile').disable()
+            _profiler_lock.release()
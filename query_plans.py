@@ -0,0 +1,85 @@
+"""EXPLAIN QUERY PLAN regression check.
+
+`flask check-query-plans` drives the read paths of every route through the test
+client, captures the SQL each one issues, and runs EXPLAIN QUERY PLAN on it.
+Any full scan of a hot (unbounded, per-user) table fails the check, so a
+dropped index or an un-indexable predicate shows up before it reaches
+production data sizes. There is no allow-list: a scan is fixed with an index
+or a different query, not excused.
+
+New read routes, JSON API endpoints included, are added to the request list in
+main.check_query_plans_command.
+"""
+import re
+from contextlib import contextmanager
+from sqlalchemy import event
+
+# Tables that grow with usage; scanning one of them on a request path is a regression
+HOT_TABLES = {
+    'appointment', 'medical_record', 'medical_file', 'doctor_review', 'doctor_profile',
+    'patient_doctor_permissions', 'user', 'patient_profile', 'schedule_block', 'schedule_exception',
+    'invoice', 'insurance_claim', 'payment', 'billing_event',
+    'appointment_archive', 'medical_record_archive', 'medical_file_archive',
+}
+
+_SCAN_RE = re.compile(r'^SCAN (?:TABLE )?(\w+)')
+
+
+@contextmanager
+def capture_statements(engine):
+    """Collects (statement, parameters) for every SELECT (with or without a WITH clause) run on `engine` inside the block."""
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith(('SELECT', 'WITH')):
+            statements.append((statement, parameters))
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def explain(engine, statement, parameters):
+    with engine.connect() as conn:
+        rows = conn.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters).all()
+    return [row[-1] for row in rows]
+
+
+def hot_table_scans(plan):
+    """Returns (table, plan line) for each full scan of a hot table in an EXPLAIN QUERY PLAN result."""
+    scans = []
+    for detail in plan:
+        match = _SCAN_RE.match(detail)
+        if match and match.group(1) in HOT_TABLES:
+            scans.append((match.group(1), detail))
+    return scans
+
+
+def check_requests(app, engine, requests, echo=print):
+    """Runs each (endpoint, client, method, url, data) through the client and checks its queries.
+
+    Returns the number of offending statements.
+    """
+    failures = 0
+    for endpoint, client, method, url, data in requests:
+        # A fresh app context per request, so flask_login's cached user in `g` doesn't leak between clients
+        with app.app_context(), capture_statements(engine) as statements:
+            response = client.open(url, method=method, data=data)
+            response.get_data() # Drain streamed bodies so their queries run inside the capture
+            response.close()
+        seen = set()
+        problems = []
+        for statement, parameters in statements:
+            if statement in seen:
+                continue
+            seen.add(statement)
+            for table, detail in hot_table_scans(explain(engine, statement, parameters)):
+                problems.append((detail, ' '.join(statement.split())))
+        status = 'FAIL' if problems else 'ok'
+        echo(f'{status:<5}{endpoint:<24}{response.status_code}  {len(statements)} queries ({len(seen)} distinct)')
+        for detail, statement in problems:
+            echo(f'      {detail}\n        in: {statement[:300]}')
+        failures += len(problems)
+    return failures
@@ -0,0 +1,171 @@
+"""Rate limiting and admission control for CPU-heavy endpoints.
+
+init_rate_limiting(app) checks two things before a limited endpoint runs:
+
+- RATE_LIMITS: token buckets per endpoint, one per IP and, when signed in,
+  one per user as well. A request takes from both and is refused if either is
+  empty, so spreading requests over many accounts from one address doesn't
+  help. The IP bucket can be given its own, larger ip_per_minute / ip_burst,
+  so a clinic behind one NAT address is not throttled as a single user.
+  Over the limit, the request gets 429 with Retry-After.
+- CONCURRENCY_LIMITS: at most N requests for an endpoint run at once in this
+  process, counting only the methods its RATE_LIMITS rule names. Extra requests are shed straight away with 503 and Retry-After,
+  instead of queueing behind bcrypt or PDF rendering and tying up every
+  worker thread. Booking and dashboard routes are not limited, so they stay
+  responsive.
+
+Buckets live in process memory by default. With several worker processes,
+set RATE_LIMIT_STORAGE to 'sqlite:///path/to/ratelimit.db' to share them
+through a small SQLite file, kept apart from the application database so
+rate-limit writes never contend with its locks. If the shared store fails, the
+request is allowed through.
+"""
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from flask import g, request, render_template, jsonify, make_response
+from flask_login import current_user
+
+logger = logging.getLogger('loop.ratelimit')
+
+
+class MemoryBucketStore:
+    """Token buckets for this process, least recently used dropped beyond max_keys."""
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict() # key -> (tokens, updated)
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst, cost=1.0):
+        """Takes `cost` tokens if available. Returns 0 if allowed, else the seconds until they would be."""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            allowed = tokens >= cost
+            self._buckets[key] = (tokens - cost if allowed else tokens, now)
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return 0 if allowed else (cost - tokens) / rate
+
+
+class SQLiteBucketStore:
+    """Token buckets shared by every process on the host through one SQLite file."""
+
+    PRUNE_EVERY = 1000 # Calls between deletions of buckets idle long enough to be full again
+
+    def __init__(self, path, busy_timeout=1.0):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        self._calls = 0
+        with self._connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS bucket (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)')
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=OFF') # Losing the last few refills in a crash is harmless
+            self._local.conn = conn
+        return conn
+
+    def take(self, key, rate, burst, cost=1.0):
+        now = time.time() # Wall clock: the value is compared across processes
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT tokens, updated FROM bucket WHERE key = ?', (key,)).fetchone()
+            tokens, updated = row if row else (burst, now)
+            tokens = min(burst, tokens + max(0.0, now - updated) * rate)
+            allowed = tokens >= cost
+            conn.execute('INSERT INTO bucket (key, tokens, updated) VALUES (?, ?, ?) '
+                         'ON CONFLICT (key) DO UPDATE SET tokens = excluded.tokens, updated = excluded.updated',
+                         (key, tokens - cost if allowed else tokens, now))
+            self._calls += 1
+            if self._calls % self.PRUNE_EVERY == 0:
+                conn.execute('DELETE FROM bucket WHERE updated < ?', (now - 3600,))
+            conn.execute('COMMIT')
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+        return 0 if allowed else (cost - tokens) / rate
+
+
+def create_store(storage, max_keys=100000):
+    if storage == 'memory':
+        return MemoryBucketStore(max_keys)
+    if storage.startswith('sqlite:///'):
+        return SQLiteBucketStore(storage[len('sqlite:///'):])
+    raise ValueError(f'Unknown RATE_LIMIT_STORAGE {storage!r}')
+
+
+def client_buckets(rule):
+    """(key, rate per second, burst) for each bucket this request takes from: its IP, then its user."""
+    ip_per_minute = rule.get('ip_per_minute', rule['per_minute'])
+    buckets = [(f'ip:{request.remote_addr}', ip_per_minute / 60.0, rule.get('ip_burst', rule.get('burst', ip_per_minute)))]
+    if current_user.is_authenticated:
+        buckets.append((f'user:{current_user.get_id()}', rule['per_minute'] / 60.0, rule.get('burst', rule['per_minute'])))
+    return buckets
+
+
+def reject(status, message, retry_after):
+    retry_after = max(1, int(retry_after + 0.999))
+    if request.path.startswith('/api/'):
+        response = make_response(jsonify({'error': message}), status)
+    else:
+        response = make_response(render_template('rate_limited.html', status=status, message=message,
+                                                 retry_after=retry_after), status)
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+
+def init_rate_limiting(app):
+    app.config.setdefault('RATE_LIMITS', {})
+    app.config.setdefault('CONCURRENCY_LIMITS', {})
+    app.config.setdefault('RATE_LIMIT_STORAGE', 'memory')
+    app.config.setdefault('RATE_LIMIT_MAX_KEYS', 100000)
+    app.config.setdefault('RATE_LIMIT_ENABLED', True)
+    store = create_store(app.config['RATE_LIMIT_STORAGE'], app.config['RATE_LIMIT_MAX_KEYS'])
+    slots = {endpoint: threading.BoundedSemaphore(limit) for endpoint, limit in app.config['CONCURRENCY_LIMITS'].items()}
+    app.extensions['rate_limit_store'] = store
+
+    @app.before_request
+    def admit_request():
+        if not app.config['RATE_LIMIT_ENABLED']:
+            return None
+        endpoint = request.endpoint
+        rule = app.config['RATE_LIMITS'].get(endpoint)
+        # Only the methods a rule names are limited: a burst of POST /login must not shed GET /login
+        if request.method not in (rule or {}).get('methods', ('GET', 'POST')):
+            return None
+        if rule:
+            for client, rate, burst in client_buckets(rule):
+                key = f'{client}:{endpoint}'
+                try:
+                    wait = store.take(key, rate, burst)
+                except sqlite3.Error:
+                    logger.exception('Rate-limit store unavailable; allowing %s', endpoint)
+                    break
+                if wait:
+                    logger.warning('Rate limited %s on %s', key, endpoint)
+                    return reject(429, 'Too many requests. Please slow down and try again shortly.', wait)
+        slot = slots.get(endpoint)
+        if slot is not None:
+            if not slot.acquire(blocking=False):
+                logger.warning('Shed %s: %d already running', endpoint, app.config['CONCURRENCY_LIMITS'][endpoint])
+                return reject(503, 'The server is busy right now. Please try again in a moment.', 1)
+            g.admission_slot = slot
+        return None
+
+    @app.teardown_request
+    def release_admission_slot(exc):
+        slot = g.pop('admission_slot', None)
+        if slot is not None:
+            slot.release()
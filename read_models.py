@@ -0,0 +1,175 @@
+"""Read models for pages that only display data.
+
+Dashboards and search used to load full ORM objects. Each one went into the
+session's identity map with change tracking, and templates walking
+`apt.patient` or `item.doctor` set off further loads. The helpers here instead
+run one column-only select per list, with the related names joined in, and
+return frozen `__slots__` dataclasses. Each row holds just the displayed
+fields, so nothing is tracked or lazy-loaded.
+
+Use the ORM models wherever something is changed.
+"""
+import datetime
+from dataclasses import dataclass
+from sqlalchemy import literal
+from models import (db, Appointment, ArchivedAppointment, PatientProfile, DoctorProfile, InsuranceProfile,
+                    Invoice, InsuranceClaim, MedicalRecord, ArchivedMedicalRecord, MedicalFile, ArchivedMedicalFile)
+
+
+@dataclass(frozen=True, slots=True)
+class AppointmentRow:
+    id: int
+    appointment_time: datetime.datetime
+    status: str
+    patient_id: int
+    patient_name: str
+    patient_phone: str
+    doctor_id: int
+    doctor_name: str
+    doctor_specialty: str
+    bill_amount: float
+    bill_status: str # 'Unbilled' without an invoice
+    bill_description: str
+    insurance_id: int # Insurer of the invoice's current claim
+    insurance_claim_status: str # 'None' without a claim
+    insurer_name: str
+    archived: bool
+
+
+@dataclass(frozen=True, slots=True)
+class TimelineItem:
+    kind: str # 'record' or 'file'
+    id: int
+    created_at: datetime.datetime
+    doctor_id: int
+    doctor_name: str
+    doctor_specialty: str
+    archived: bool
+    diagnosis: str = None
+    notes: str = None
+    prescription: str = None
+    filename: str = None
+    original_filename: str = None
+    description: str = None
+
+
+@dataclass(frozen=True, slots=True)
+class DoctorSummary:
+    id: int
+    full_name: str
+    specialty: str
+
+
+@dataclass(frozen=True, slots=True)
+class DoctorSearchRow:
+    id: int
+    full_name: str
+    specialty: str
+    practice_address: str
+    pincode: str
+    latitude: float
+    longitude: float
+    region: str = None # Region database the doctor lives in (see shards.py)
+
+
+def appointment_columns(model=Appointment):
+    return (model.id, model.appointment_time, model.status, model.patient_id,
+            PatientProfile.full_name, PatientProfile.phone,
+            model.doctor_id, DoctorProfile.full_name, DoctorProfile.specialty,
+            Invoice.amount, db.func.coalesce(Invoice.status, 'Unbilled'), Invoice.description,
+            InsuranceClaim.insurer_id, db.func.coalesce(InsuranceClaim.status, 'None'),
+            InsuranceProfile.company_name, literal(model is ArchivedAppointment))
+
+
+def appointment_select(model=Appointment):
+    return (
+        db.select(*appointment_columns(model))
+        .join(PatientProfile, model.patient_id == PatientProfile.id)
+        .join(DoctorProfile, model.doctor_id == DoctorProfile.id)
+        .outerjoin(Invoice, Invoice.appointment_id == model.id)
+        .outerjoin(InsuranceClaim, InsuranceClaim.id == Invoice.claim_id)
+        .outerjoin(InsuranceProfile, InsuranceClaim.insurer_id == InsuranceProfile.id)
+    )
+
+
+def appointment_rows(query):
+    return [AppointmentRow(*row) for row in db.session.execute(query)]
+
+
+def appointment_row(appointment_id):
+    rows = appointment_rows(appointment_select().where(Appointment.id == appointment_id))
+    return rows[0] if rows else None
+
+
+def doctor_appointments(doctor_id):
+    """All of a doctor's appointments, earliest first."""
+    return appointment_rows(appointment_select().where(Appointment.doctor_id == doctor_id)
+                            .order_by(Appointment.appointment_time.asc()))
+
+
+def insurer_claims(insurer_id, claim_statuses, newest_first=False):
+    """Appointments whose current claim is with the insurer and in one of `claim_statuses`."""
+    order = Appointment.appointment_time.desc() if newest_first else Appointment.appointment_time.asc()
+    # Driven from the insurer's claims, not from every appointment
+    return appointment_rows(
+        db.select(*appointment_columns())
+        .select_from(InsuranceClaim)
+        .join(Invoice, db.and_(Invoice.id == InsuranceClaim.invoice_id, Invoice.claim_id == InsuranceClaim.id))
+        .join(Appointment, Appointment.id == Invoice.appointment_id)
+        .join(PatientProfile, Appointment.patient_id == PatientProfile.id)
+        .join(DoctorProfile, Appointment.doctor_id == DoctorProfile.id)
+        .join(InsuranceProfile, InsuranceClaim.insurer_id == InsuranceProfile.id)
+        .where(InsuranceClaim.insurer_id == insurer_id, InsuranceClaim.status.in_(claim_statuses))
+        .order_by(order)
+    )
+
+
+def patient_appointments(patient_id, include_archived=False):
+    """A patient's appointments, newest first, optionally with the archived ones."""
+    rows = appointment_rows(appointment_select().where(Appointment.patient_id == patient_id)
+                            .order_by(Appointment.appointment_time.desc()))
+    if include_archived:
+        rows += appointment_rows(appointment_select(ArchivedAppointment).where(ArchivedAppointment.patient_id == patient_id))
+        rows.sort(key=lambda row: row.appointment_time, reverse=True)
+    return rows
+
+
+def _timeline_select(model, kind, columns, patient_id, doctor_id):
+    query = (
+        db.select(literal(kind), model.id, model.created_at, model.doctor_id, DoctorProfile.full_name,
+                  DoctorProfile.specialty, literal(model.__tablename__.endswith('_archive')),
+                  *(getattr(model, name) for name in columns))
+        .join(DoctorProfile, model.doctor_id == DoctorProfile.id)
+        .where(model.patient_id == patient_id)
+    )
+    if doctor_id is not None:
+        query = query.where(model.doctor_id == doctor_id)
+    return query
+
+
+def patient_timeline(patient_id, doctor_id=None, include_archived=False):
+    """A patient's records and files, newest first; optionally only one doctor's, and with archived ones."""
+    sources = [(MedicalRecord, 'record'), (MedicalFile, 'file')]
+    if include_archived:
+        sources += [(ArchivedMedicalRecord, 'record'), (ArchivedMedicalFile, 'file')]
+    items = []
+    for model, kind in sources:
+        if kind == 'record':
+            columns = ('diagnosis', 'notes', 'prescription')
+            build = lambda row: TimelineItem(*row[:7], diagnosis=row[7], notes=row[8], prescription=row[9])
+        else:
+            columns = ('filename', 'original_filename', 'description')
+            build = lambda row: TimelineItem(*row[:7], filename=row[7], original_filename=row[8], description=row[9])
+        items += [build(row) for row in db.session.execute(_timeline_select(model, kind, columns, patient_id, doctor_id))]
+    items.sort(key=lambda item: item.created_at, reverse=True)
+    return items
+
+
+def doctor_summaries(doctor_ids):
+    """{id: DoctorSummary} for the given doctors."""
+    if not doctor_ids:
+        return {}
+    rows = db.session.execute(
+        db.select(DoctorProfile.id, DoctorProfile.full_name, DoctorProfile.specialty).where(DoctorProfile.id.in_(doctor_ids))
+    )
+    return {row.id: DoctorSummary(*row) for row in rows}
@@ -0,0 +1,240 @@
+"""Appointment reminders through an outbox.
+
+`flask reminders-run` keeps the confirmed appointments of the next few hours
+in a heap ordered by when their reminders fall due (REMINDER_OFFSETS minutes
+before each appointment). Every tick it:
+
+1. extends the loaded window once it runs low, with one range query on
+   (status, appointment_time),
+2. applies bookings changed since the previous tick, with one query on
+   appointment.updated_at,
+3. writes the reminders that fell due to the reminder_outbox table,
+4. drains pending outbox rows through the configured sender in batches.
+
+Cancelled or moved appointments are not searched for in the heap; their stale
+entries are dropped when they reach the top. Outbox rows are unique per
+appointment, time and offset, so a restarted scheduler never queues a reminder
+twice. Delivery is at least once: a sender that fails, or a crash before a
+batch is marked sent, means the batch is offered again on the next tick.
+"""
+import datetime
+import heapq
+import json
+import os
+import time
+from sqlalchemy import insert, update
+from models import db, User, Appointment, PatientProfile, DoctorProfile, ReminderOutbox
+
+MAX_SEND_ATTEMPTS = 5
+# Changes are re-read with this much overlap: a booking's updated_at is set at flush time,
+# and its transaction may commit (become visible) a little later
+CHANGE_OVERLAP = datetime.timedelta(seconds=60)
+
+SENDERS = {}
+
+
+def sender(name):
+    """Registers a sender class as `name` (see REMINDER_SENDER). It is built with the app config."""
+    def register(cls):
+        SENDERS[name] = cls
+        return cls
+    return register
+
+
+@sender('file')
+class FileSender:
+    """Appends reminders as JSON lines to one file per day in REMINDER_OUTBOX_DIR.
+
+    Stands in for an email or SMS gateway: a sender only needs send(messages),
+    raising if the batch could not be delivered.
+    """
+
+    def __init__(self, config):
+        self.directory = config['REMINDER_OUTBOX_DIR']
+        os.makedirs(self.directory, exist_ok=True)
+
+    def send(self, messages):
+        path = os.path.join(self.directory, f'reminders-{datetime.date.today().isoformat()}.ndjson')
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write(''.join(json.dumps(message) + '\n' for message in messages))
+            f.flush()
+            os.fsync(f.fileno())
+
+
+class ReminderScheduler:
+    def __init__(self, offsets, lookahead_minutes=60):
+        self.offsets = sorted(offsets, reverse=True) # Minutes before the appointment, earliest reminder first
+        self.lookahead = datetime.timedelta(minutes=lookahead_minutes)
+        self.horizon = datetime.timedelta(minutes=self.offsets[0]) # Appointments this close have a reminder due soon
+        self.heap = [] # (due at, appointment id, offset, appointment time)
+        # appointment id -> appointment time its heap entries are for. Kept until the appointment
+        # starts, so a booking seen again by the change poll is not reminded twice.
+        self.scheduled = {}
+        self.loaded_until = None
+        self.changes_since = None
+
+    def schedule(self, appointment_id, appointment_time, now):
+        if self.scheduled.get(appointment_id) == appointment_time:
+            return
+        self.scheduled[appointment_id] = appointment_time
+        overdue = None
+        for offset in self.offsets:
+            due_at = appointment_time - datetime.timedelta(minutes=offset)
+            if due_at > now:
+                heapq.heappush(self.heap, (due_at, appointment_id, offset, appointment_time))
+            else:
+                overdue = offset
+        # Confirmed late (or the scheduler was down): only the closest of the missed reminders goes out
+        if overdue is not None:
+            heapq.heappush(self.heap, (now, appointment_id, overdue, appointment_time))
+
+    def load(self, start, end, now):
+        for appointment_id, appointment_time in list(self.scheduled.items()):
+            if appointment_time <= now:
+                del self.scheduled[appointment_id]
+        rows = db.session.execute(
+            db.select(Appointment.id, Appointment.appointment_time)
+            .where(Appointment.status == 'Confirmed', Appointment.appointment_time > start, Appointment.appointment_time <= end)
+        )
+        for appointment_id, appointment_time in rows:
+            self.schedule(appointment_id, appointment_time, now)
+        self.loaded_until = end
+
+    def refresh(self, now):
+        """Loads the next stretch of appointments when needed and applies changed bookings."""
+        if self.loaded_until is None:
+            self.changes_since = now - CHANGE_OVERLAP
+            self.load(now, now + self.horizon + self.lookahead, now)
+            return
+        if self.loaded_until < now + self.horizon:
+            self.load(self.loaded_until, now + self.horizon + self.lookahead, now)
+        changes_since, self.changes_since = self.changes_since, now - CHANGE_OVERLAP
+        changed = db.session.execute(
+            db.select(Appointment.id, Appointment.appointment_time, Appointment.status)
+            .where(Appointment.updated_at >= changes_since)
+        )
+        for appointment_id, appointment_time, status in changed:
+            if status == 'Confirmed' and now < appointment_time <= self.loaded_until:
+                self.schedule(appointment_id, appointment_time, now)
+            else:
+                self.scheduled.pop(appointment_id, None)
+
+    def pop_due(self, now):
+        """[(appointment id, appointment time, offset)] for every reminder due by `now`."""
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            _, appointment_id, offset, appointment_time = heapq.heappop(self.heap)
+            if self.scheduled.get(appointment_id) != appointment_time:
+                continue # Cancelled, completed or moved since it was scheduled
+            due.append((appointment_id, appointment_time, offset))
+        return due
+
+    def next_due(self):
+        return self.heap[0][0] if self.heap else None
+
+
+def describe_offset(minutes):
+    if minutes % 1440 == 0:
+        return f'{minutes // 1440} day(s)'
+    if minutes % 60 == 0:
+        return f'{minutes // 60} hour(s)'
+    return f'{minutes} minutes'
+
+
+def write_outbox(due):
+    """Writes due reminders to the outbox, re-checking each booking. Returns the number written."""
+    if not due:
+        return 0
+    by_id = {}
+    for appointment_id, appointment_time, offset in due:
+        by_id.setdefault(appointment_id, []).append((appointment_time, offset))
+    rows = db.session.execute(
+        db.select(Appointment.id, Appointment.appointment_time, User.email, PatientProfile.full_name,
+                  DoctorProfile.full_name.label('doctor_name'), DoctorProfile.practice_address)
+        .join(PatientProfile, Appointment.patient_id == PatientProfile.id)
+        .join(User, PatientProfile.user_id == User.id)
+        .join(DoctorProfile, Appointment.doctor_id == DoctorProfile.id)
+        .where(Appointment.id.in_(by_id), Appointment.status == 'Confirmed')
+    ).all()
+    already_queued = set(db.session.execute(
+        db.select(ReminderOutbox.appointment_id, ReminderOutbox.appointment_time, ReminderOutbox.offset_minutes)
+        .where(ReminderOutbox.appointment_id.in_(by_id))
+    ).tuples())
+    outbox = []
+    for appointment_id, appointment_time, email, patient_name, doctor_name, address in rows:
+        for scheduled_time, offset in by_id[appointment_id]:
+            if scheduled_time != appointment_time or (appointment_id, appointment_time, offset) in already_queued:
+                continue
+            when = appointment_time.strftime('%A, %B %d at %I:%M %p')
+            outbox.append({
+                'appointment_id': appointment_id,
+                'appointment_time': appointment_time,
+                'offset_minutes': offset,
+                'recipient': email,
+                'subject': f'Reminder: appointment with {doctor_name} on {appointment_time.strftime("%b %d")}',
+                'body': (f'Hello {patient_name},\n\nThis is a reminder of your appointment with {doctor_name} '
+                         f'on {when}{f" at {address}" if address else ""}, in about {describe_offset(offset)}.\n'),
+            })
+    if outbox:
+        db.session.execute(insert(ReminderOutbox), outbox)
+    db.session.commit()
+    return len(outbox)
+
+
+def drain_outbox(reminder_sender, batch_size=100):
+    """Hands pending outbox rows to the sender, oldest first, until none are left or a batch fails.
+
+    Returns the number sent.
+    """
+    sent = 0
+    while True:
+        batch = db.session.execute(
+            db.select(ReminderOutbox.id, ReminderOutbox.recipient, ReminderOutbox.subject, ReminderOutbox.body,
+                      ReminderOutbox.appointment_id, ReminderOutbox.appointment_time)
+            .where(ReminderOutbox.status == 'pending').order_by(ReminderOutbox.id).limit(batch_size)
+        ).all()
+        if not batch:
+            db.session.rollback()
+            return sent
+        ids = [row.id for row in batch]
+        try:
+            reminder_sender.send([{**row._asdict(), 'appointment_time': row.appointment_time.isoformat()} for row in batch])
+        except Exception as e:
+            db.session.execute(
+                update(ReminderOutbox).where(ReminderOutbox.id.in_(ids))
+                .values(attempts=ReminderOutbox.attempts + 1, last_error=repr(e)[:4000])
+            )
+            db.session.execute(
+                update(ReminderOutbox).where(ReminderOutbox.id.in_(ids), ReminderOutbox.attempts >= MAX_SEND_ATTEMPTS)
+                .values(status='failed')
+            )
+            db.session.commit()
+            return sent # Try again next tick
+        db.session.execute(
+            update(ReminderOutbox).where(ReminderOutbox.id.in_(ids))
+            .values(status='sent', sent_at=datetime.datetime.now(), attempts=ReminderOutbox.attempts + 1)
+        )
+        db.session.commit()
+        sent += len(ids)
+
+
+def outbox_counts():
+    rows = db.session.execute(db.select(ReminderOutbox.status, db.func.count()).group_by(ReminderOutbox.status))
+    return {status: count for status, count in rows}
+
+
+def run_scheduler(scheduler, reminder_sender, interval=30.0, batch_size=100, once=False, echo=print):
+    """Ticks the scheduler until interrupted (or once). Needs an app context."""
+    while True:
+        now = datetime.datetime.now()
+        scheduler.refresh(now)
+        written = write_outbox(scheduler.pop_due(now))
+        sent = drain_outbox(reminder_sender, batch_size)
+        db.session.remove()
+        if written or sent:
+            echo(f'{written} reminder(s) queued, {sent} sent.')
+        if once:
+            return
+        next_due = scheduler.next_due()
+        wait = interval if next_due is None else (next_due - datetime.datetime.now()).total_seconds()
+        time.sleep(min(max(wait, 0.1), interval))
@@ -0,0 +1,252 @@
+"""Bulk import of doctor rosters from CSV or NDJSON.
+
+import_roster() reads rows as a stream and handles them in batches:
+
+1. validate each row and drop emails repeated earlier in the file,
+2. find emails that already have an account with one IN query per batch,
+3. hash the initial passwords in a process pool (bcrypt is the dominant cost),
+4. geocode the batch's distinct pincodes once,
+5. bulk-insert the User rows, then the DoctorProfile rows, in one transaction
+   per region when the app is sharded (see shards.py).
+
+Rows that fail are reported with their line number and reasons. The rest of
+the batch is still imported. Columns: email, password and full_name are
+required. phone, specialty, practice_address (or address), pincode,
+availability_start and availability_end (HH:MM) and slot_duration_minutes
+are optional and default like the register form.
+"""
+import csv
+import datetime
+import io
+import json
+import multiprocessing
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+import bcrypt as bcrypt_lib
+from sqlalchemy import insert
+from models import db, User, DoctorProfile, PatientProfile
+import shards
+
+BATCH_SIZE = 500
+EMAIL_RE = re.compile(r'^[^@\s]+@[^@\s]+\.[^@\s]+$')
+PINCODE_RE = re.compile(r'^\d{6}$')
+
+
+def hash_password(password, rounds, prefix):
+    """Same hash as flask_bcrypt's generate_password_hash. Runs in the pool's worker processes."""
+    return bcrypt_lib.hashpw(password.encode('utf-8'), bcrypt_lib.gensalt(rounds=rounds, prefix=prefix)).decode('utf-8')
+
+
+def read_rows(stream, file_format):
+    """Yields (line number, dict) from a text stream of CSV (with a header) or NDJSON."""
+    if file_format == 'csv':
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, {(k or '').strip().lower(): (v or '').strip() for k, v in row.items()}
+    else:
+        for line_number, line in enumerate(stream, start=1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                yield line_number, None
+                continue
+            if not isinstance(row, dict):
+                yield line_number, None
+                continue
+            yield line_number, {str(k).strip().lower(): '' if v is None else str(v).strip() for k, v in row.items()}
+
+
+def parse_time(value, default):
+    return datetime.time.fromisoformat(value) if value else default
+
+
+def validate_row(row):
+    """Returns (doctor fields, []) for a valid row, or (None, [reasons])."""
+    if row is None:
+        return None, ['not a JSON object']
+    errors = []
+    email = row.get('email', '').lower()
+    if not EMAIL_RE.match(email):
+        errors.append('invalid email')
+    password = row.get('password', '')
+    if not password:
+        errors.append('missing password')
+    elif len(password.encode('utf-8')) > 72:
+        errors.append('password longer than 72 bytes')
+    if not row.get('full_name'):
+        errors.append('missing full_name')
+    pincode = row.get('pincode', '')
+    if pincode and not PINCODE_RE.match(pincode):
+        errors.append('pincode must be 6 digits')
+    try:
+        start = parse_time(row.get('availability_start'), datetime.time(9, 0))
+        end = parse_time(row.get('availability_end'), datetime.time(17, 0))
+        if start >= end:
+            errors.append('availability_start must be before availability_end')
+    except ValueError:
+        errors.append('availability times must be HH:MM')
+        start = end = None
+    try:
+        duration = int(row.get('slot_duration_minutes') or 30)
+        if duration < 10:
+            errors.append('slot_duration_minutes must be at least 10')
+    except ValueError:
+        errors.append('slot_duration_minutes must be a number')
+        duration = None
+    if errors:
+        return None, errors
+    return {
+        'email': email,
+        'password': password,
+        'full_name': row['full_name'],
+        'phone': row.get('phone') or None,
+        'specialty': row.get('specialty') or 'General',
+        'practice_address': row.get('practice_address') or row.get('address') or None,
+        'pincode': pincode or None,
+        'availability_start_time': start,
+        'availability_end_time': end,
+        'slot_duration_minutes': duration,
+    }, []
+
+
+def known_coordinates(pincodes):
+    """Average (lat, lon) per pincode from the profiles that already have coordinates."""
+    coordinates = {}
+    if not pincodes:
+        return coordinates
+    for model in (DoctorProfile, PatientProfile):
+        rows = db.session.execute(
+            db.select(model.pincode, db.func.avg(model.latitude), db.func.avg(model.longitude))
+            .where(model.pincode.in_(pincodes), model.latitude.is_not(None), model.longitude.is_not(None))
+            .group_by(model.pincode)
+        )
+        for pincode, lat, lon in rows:
+            coordinates.setdefault(pincode, (lat, lon))
+    return coordinates
+
+
+class NominatimGeocoder:
+    """Looks pincodes up on OpenStreetMap Nominatim, at most one request per second (its usage policy)."""
+
+    def __init__(self, user_agent='loop-healthcare-roster-import', country='India'):
+        from geopy.geocoders import Nominatim # Imported on first use; only online geocoding needs it
+        self.geocoder = Nominatim(user_agent=user_agent)
+        self.country = country
+        self._last_request = 0.0
+
+    def __call__(self, pincode):
+        time.sleep(max(0.0, 1.0 - (time.monotonic() - self._last_request)))
+        self._last_request = time.monotonic()
+        location = self.geocoder.geocode({'postalcode': pincode, 'country': self.country}, timeout=10)
+        return (location.latitude, location.longitude) if location else None
+
+
+def geocode_pincodes(pincodes, geocoder=None, cache=None):
+    """Coordinates for each pincode that can be placed: known ones first, then `geocoder` for the rest."""
+    cache = {} if cache is None else cache
+    missing = {p for p in pincodes if p not in cache}
+    cache.update(known_coordinates(missing))
+    for pincode in sorted(missing - cache.keys()):
+        if geocoder is None:
+            break
+        try:
+            cache[pincode] = geocoder(pincode)
+        except Exception: # Unplaceable or the service is down; the doctor is imported without coordinates
+            cache[pincode] = None
+    return {p: cache[p] for p in pincodes if cache.get(p)}
+
+
+def import_batch(batch, hash_passwords, geocoder, geocode_cache, seen_emails, dry_run):
+    """Validates and inserts one batch. Returns (imported count, [error dicts])."""
+    errors, valid = [], []
+    for line_number, row in batch:
+        doctor, reasons = validate_row(row)
+        if doctor and doctor['email'] in seen_emails:
+            reasons = ['email repeated earlier in the file']
+        if reasons:
+            errors.append({'line': line_number, 'email': (row or {}).get('email', ''), 'errors': reasons})
+            continue
+        seen_emails.add(doctor['email'])
+        valid.append((line_number, doctor))
+
+    existing = set()
+    if valid: # Emails are unique across every region
+        emails = [doctor['email'] for _, doctor in valid]
+        for found in shards.fan_out(lambda: set(db.session.scalars(db.select(User.email).where(User.email.in_(emails))))).values():
+            existing |= found
+    for line_number, doctor in valid:
+        if doctor['email'] in existing:
+            errors.append({'line': line_number, 'email': doctor['email'], 'errors': ['email already registered']})
+    valid = [(line_number, doctor) for line_number, doctor in valid if doctor['email'] not in existing]
+    if dry_run or not valid:
+        db.session.rollback()
+        return len(valid), errors
+
+    passwords = [doctor.pop('password') for _, doctor in valid]
+    hashes = hash_passwords(passwords)
+    coordinates = geocode_pincodes({doctor['pincode'] for _, doctor in valid if doctor['pincode']},
+                                   geocoder, geocode_cache)
+
+    by_region = {}
+    for (_, doctor), pw_hash in zip(valid, hashes):
+        by_region.setdefault(shards.region_for_pincode(doctor['pincode']), []).append((doctor, pw_hash))
+    for region, doctors in by_region.items():
+        with shards.use_region(region):
+            user_ids = db.session.execute(
+                insert(User).returning(User.id, User.email, sort_by_parameter_order=True),
+                [{'email': doctor['email'], 'password_hash': pw_hash, 'role': 'doctor'} for doctor, pw_hash in doctors]
+            ).all()
+            profiles = []
+            for (doctor, _), (user_id, _) in zip(doctors, user_ids):
+                lat, lon = coordinates.get(doctor['pincode'], (None, None))
+                profiles.append({**{k: v for k, v in doctor.items() if k != 'email'},
+                                 'user_id': user_id, 'latitude': lat, 'longitude': lon})
+            db.session.execute(insert(DoctorProfile), profiles)
+            db.session.commit()
+    return len(valid), errors
+
+
+def import_roster(stream, file_format, rounds=12, prefix='2b', processes=None, geocoder=None,
+                  dry_run=False, batch_size=BATCH_SIZE):
+    """Imports a roster. Returns {'imported': n, 'errors': [{'line', 'email', 'errors'}], 'seconds': t}."""
+    started = time.perf_counter()
+    imported, errors, batch = 0, [], []
+    seen_emails, geocode_cache = set(), {}
+    prefix = prefix.encode('ascii') if isinstance(prefix, str) else prefix
+    processes = processes or os.cpu_count() or 1
+    # Spawned, not forked: workers must not inherit the parent's open SQLite connections
+    with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn')) as pool:
+        def hash_passwords(passwords):
+            n = len(passwords)
+            return list(pool.map(hash_password, passwords, [rounds] * n, [prefix] * n,
+                                 chunksize=max(1, n // (4 * processes))))
+
+        for item in read_rows(stream, file_format):
+            batch.append(item)
+            if len(batch) >= batch_size:
+                count, batch_errors = import_batch(batch, hash_passwords, geocoder, geocode_cache, seen_emails, dry_run)
+                imported, batch = imported + count, []
+                errors.extend(batch_errors)
+        if batch:
+            count, batch_errors = import_batch(batch, hash_passwords, geocoder, geocode_cache, seen_emails, dry_run)
+            imported += count
+            errors.extend(batch_errors)
+    errors.sort(key=lambda error: error['line'])
+    return {'imported': imported, 'errors': errors, 'seconds': round(time.perf_counter() - started, 2)}
+
+
+def detect_format(filename, default='csv'):
+    name = (filename or '').lower()
+    if name.endswith(('.ndjson', '.jsonl')):
+        return 'ndjson'
+    if name.endswith('.csv'):
+        return 'csv'
+    return default
+
+
+def text_stream(binary_stream):
+    return io.TextIOWrapper(binary_stream, encoding='utf-8-sig', newline='')
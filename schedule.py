@@ -0,0 +1,138 @@
+"""Doctor schedules compiled into interval sets.
+
+A doctor's week is a set of ScheduleBlock rows (weekday, start, end, slot length,
+location). Dated ScheduleException rows either close part or all of a day
+(leave, holidays, a long lunch) or add a session that is not in the template.
+A doctor with no blocks works their default hours every day.
+
+compile_day() turns these into the day's sessions: a sorted tuple of
+non-overlapping Session(start, end, slot, location), in minutes since
+midnight. Slots are the session start plus whole multiples of its slot length
+that fit before the session end. Free slots and booking conflicts are worked
+out with interval subtraction and arithmetic on that grid, so the cost depends
+on the number of sessions and bookings, not on the number of slots in the day.
+"""
+import bisect
+from collections import namedtuple
+
+DAY_MINUTES = 24 * 60
+
+Session = namedtuple('Session', 'start end slot location')
+
+
+def to_minutes(t):
+    return t.hour * 60 + t.minute
+
+
+def merge(intervals):
+    """Sorted union of (start, end) intervals."""
+    merged = []
+    for start, end in sorted(intervals):
+        if start >= end:
+            continue
+        if merged and start <= merged[-1][1]:
+            if end > merged[-1][1]:
+                merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def subtract(sessions, removals):
+    """The parts of `sessions` not covered by `removals`. Each part keeps its session's grid origin,
+    so a session cut in two still offers the slots it had, minus the covered ones."""
+    removals = merge(removals)
+    starts = [start for start, _ in removals]
+    result = []
+    for session in sessions:
+        cursor = session.start
+        # Removals that end after the session starts; the merged list is sorted by both ends
+        i = max(bisect.bisect_right(starts, session.start) - 1, 0)
+        while i < len(removals) and removals[i][0] < session.end:
+            start, end = removals[i]
+            if end > cursor:
+                if start > cursor:
+                    result.append((session, cursor, start))
+                cursor = max(cursor, end)
+            i += 1
+        if cursor < session.end:
+            result.append((session, cursor, session.end))
+    return result
+
+
+def _pieces_to_sessions(pieces):
+    # A piece keeps its parent's grid: shift its start to the parent's next slot boundary
+    sessions = []
+    for session, start, end in pieces:
+        offset = -(-(start - session.start) // session.slot) * session.slot
+        if session.start + offset < end:
+            sessions.append(Session(session.start + offset, end, session.slot, session.location))
+    return sessions
+
+
+def compile_day(weekday_blocks, exceptions, default=None):
+    """Sessions for one date.
+
+    weekday_blocks: (start, end, slot, location) for the date's weekday from the weekly template.
+    exceptions: (kind, start, end, slot, location) for the date; kind is 'unavailable' or
+        'available', and an 'unavailable' exception with no times closes the whole day.
+    default: (start, end, slot) used when the doctor has no weekly template at all (None if they do).
+    """
+    if default is not None:
+        base = [Session(*default, None)] if default[0] < default[1] else []
+    else:
+        base = [Session(*block) for block in weekday_blocks if block[0] < block[1]]
+    closures, extras = [], []
+    for kind, start, end, slot, location in exceptions:
+        if kind == 'unavailable':
+            closures.append((0, DAY_MINUTES) if start is None else (start, end))
+        elif start is not None and start < end:
+            extras.append(Session(start, end, slot, location))
+    # Closures remove template hours; added sessions replace whatever template hours they overlap
+    open_sessions = _pieces_to_sessions(subtract(base, closures + [(s.start, s.end) for s in extras]))
+    open_sessions += _pieces_to_sessions(subtract(extras, closures))
+    # Overlapping blocks (or overlapping added sessions) are resolved in favour of the earlier one
+    compiled, covered_until = [], 0
+    for session in sorted(open_sessions):
+        compiled += _pieces_to_sessions([(session, max(session.start, covered_until), session.end)])
+        covered_until = max(covered_until, session.end)
+    return tuple(compiled)
+
+
+def session_at(sessions, minute):
+    """The session whose slot grid starts a slot at `minute`, or None."""
+    i = bisect.bisect_right(sessions, (minute, DAY_MINUTES + 1)) - 1
+    if i < 0:
+        return None
+    session = sessions[i]
+    if (minute - session.start) % session.slot == 0 and minute + session.slot <= session.end:
+        return session
+    return None
+
+
+def busy_intervals(sessions, booked_minutes, default_slot):
+    """(start, end) of each booking: a slot of the session it falls in, or `default_slot` outside every session."""
+    starts = [session.start for session in sessions]
+    busy = []
+    for minute in booked_minutes:
+        i = bisect.bisect_right(starts, minute) - 1
+        slot = sessions[i].slot if i >= 0 and minute < sessions[i].end else default_slot
+        busy.append((minute, minute + slot))
+    return merge(busy)
+
+
+def overlaps(busy, start, end):
+    """True if [start, end) intersects any of the merged, sorted `busy` intervals."""
+    i = bisect.bisect_left(busy, (end,))
+    return i > 0 and busy[i - 1][1] > start
+
+
+def free_slots(sessions, busy, not_before=0):
+    """Minute offsets of every slot that fits in a session and avoids `busy` and the time before `not_before`."""
+    removals = busy + [(0, not_before)] if not_before > 0 else busy
+    slots = []
+    for session, start, end in subtract(sessions, removals):
+        first = -(-(start - session.start) // session.slot)
+        last = (end - session.start) // session.slot - 1
+        slots.extend(range(session.start + first * session.slot, session.start + (last + 1) * session.slot, session.slot))
+    return slots
@@ -0,0 +1,271 @@
+"""Reconciles UPLOAD_FOLDER with the uploaded-file rows.
+
+scrub_uploads() works in two phases, in batches:
+
+- rows: every medical_file and medical_file_archive row, in id order, in every
+  region. A row whose blob is gone is reported as missing. A blob whose size
+  differs from the row's size_bytes is reported as corrupt. With verify, each
+  SHA-256 is recomputed as well. The files are read and hashed in a thread
+  pool; hashlib releases the GIL, so the threads overlap disk reads with
+  hashing. Rows the fingerprint_upload job has not reached yet are counted as
+  unverified.
+- files: the upload folder is listed with os.scandir, and the names are looked
+  up a batch at a time. When sharded, every region is asked, because all
+  regions share the folder. A file that no row names is an orphan, usually
+  left behind when upload_file saved the blob but its commit failed. Files
+  younger than the grace period are skipped, since their row may still be on
+  its way.
+
+Findings are appended to a report, one JSON object per line, as they are found.
+Progress is saved to a checkpoint after every batch of rows and every listing
+partition. A scrub that stops (--max-seconds, Ctrl-C, a crash) carries on from
+the checkpoint on the next run, so a large store can be scrubbed a slice at a
+time from cron. The listing is split into partitions by a hash of the file
+name; each partition is one pass over the directory. A partition interrupted
+by a crash is listed again, so its orphans can appear twice in the report.
+
+With quarantine, orphans are moved to the quarantine folder, after checking
+once more that no row has appeared for them. A missing blob found in the
+quarantine folder is moved back. Nothing is ever deleted.
+"""
+import datetime
+import hashlib
+import json
+import os
+import shutil
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from models import db, MedicalFile, ArchivedMedicalFile
+import shards
+
+FILE_MODELS = (MedicalFile, ArchivedMedicalFile)
+CHUNK_SIZE = 1024 * 1024
+COUNTS = ('rows', 'files', 'missing', 'corrupt', 'unverified', 'orphans', 'quarantined', 'restored', 'bytes_verified')
+
+
+def load_checkpoint(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def save_checkpoint(path, state):
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path) # Atomic: a crash leaves the previous checkpoint intact
+
+
+def new_state(scrub_dir, partitions):
+    started = datetime.datetime.now()
+    report = os.path.join(scrub_dir, f'report-{started:%Y%m%d-%H%M%S}.ndjson')
+    attempt = 1
+    while os.path.exists(report): # Another scrub started within the same second
+        attempt += 1
+        report = os.path.join(scrub_dir, f'report-{started:%Y%m%d-%H%M%S}-{attempt}.ndjson')
+    return {
+        'started_at': started.isoformat(timespec='seconds'),
+        'finished_at': None,
+        'report': report,
+        'partitions': partitions,
+        'rows': {}, # '<region>:<table>' -> last id checked
+        'rows_done': [],
+        'files_done': [], # Listing partitions finished
+        'counts': dict.fromkeys(COUNTS, 0),
+    }
+
+
+def check_blob(task):
+    """Runs in the pool. (path, size_bytes, sha256, verify) -> (status, detail)."""
+    path, expected_size, expected_sha256, verify = task
+    try:
+        size = os.stat(path).st_size
+    except FileNotFoundError:
+        return 'missing', None
+    if expected_size is not None and size != expected_size:
+        return 'corrupt', f'size is {size}, expected {expected_size}'
+    if not verify:
+        return 'ok', None
+    if expected_sha256 is None:
+        return 'unverified', None
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    if digest.hexdigest() != expected_sha256:
+        return 'corrupt', 'sha256 mismatch'
+    return 'verified', size
+
+
+def known_filenames(names):
+    """The names among `names` that a file row, hot or archived, in the current region refers to."""
+    found = set()
+    for model in FILE_MODELS:
+        found.update(db.session.scalars(db.select(model.filename).where(model.filename.in_(names))))
+    return found
+
+
+def known_anywhere(names):
+    return set().union(*shards.fan_out(known_filenames, names).values())
+
+
+class Scrubber:
+    """One run of a scrub. Each batch of rows and each listing partition is counted on its own and
+    only added to the state, with the checkpoint saved, once it is complete. Work cut short is
+    simply done again by the next run."""
+
+    def __init__(self, state, checkpoint_path, report, upload_folder, quarantine_dir, verify, workers, batch_size, grace,
+                 deadline, echo):
+        self.state, self.checkpoint_path, self.report = state, checkpoint_path, report
+        self.upload_folder, self.quarantine_dir, self.verify = upload_folder, quarantine_dir, verify
+        self.batch_size, self.grace, self.deadline, self.echo = batch_size, grace, deadline, echo
+        self.pool = ThreadPoolExecutor(workers, thread_name_prefix='scrub')
+
+    def out_of_time(self):
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def record(self, kind, **finding):
+        self.report.write(json.dumps({'kind': kind, **finding}) + '\n')
+
+    def save(self, counts=None):
+        for name, value in (counts or {}).items():
+            self.state['counts'][name] += value
+        self.report.flush() # Findings reach the report before the checkpoint that covers them
+        save_checkpoint(self.checkpoint_path, self.state)
+
+    # --- Rows: every file row has an intact blob ---
+
+    def scrub_rows(self):
+        """Returns False if it ran out of time."""
+        for region in shards.regions():
+            with shards.use_region(region):
+                for model in FILE_MODELS:
+                    key = f'{region or ""}:{model.__tablename__}'
+                    while key not in self.state['rows_done']:
+                        if self.out_of_time():
+                            return False
+                        self.scrub_row_batch(region, model, key)
+        return True
+
+    def scrub_row_batch(self, region, model, key):
+        rows = db.session.execute(
+            db.select(model.id, model.filename, model.size_bytes, model.sha256)
+            .where(model.id > self.state['rows'].get(key, 0)).order_by(model.id).limit(self.batch_size)
+        ).all()
+        db.session.rollback() # Don't hold a read transaction open while the files are checked
+        if not rows:
+            self.state['rows_done'].append(key)
+            self.save()
+            self.echo(f'Checked every {model.__tablename__} row{f" in {region}" if region else ""}.')
+            return
+        counts = dict.fromkeys(COUNTS, 0)
+        tasks = [(os.path.join(self.upload_folder, row.filename), row.size_bytes, row.sha256, self.verify) for row in rows]
+        for row, (status, detail) in zip(rows, self.pool.map(check_blob, tasks)):
+            counts['rows'] += 1
+            if status == 'verified':
+                counts['bytes_verified'] += detail
+            elif status == 'unverified':
+                counts['unverified'] += 1
+            elif status in ('missing', 'corrupt'):
+                counts[status] += 1
+                action = self.restore(row.filename, counts) if status == 'missing' else None
+                self.record(status, region=region, table=model.__tablename__, id=row.id, filename=row.filename,
+                            detail=detail, action=action)
+        self.state['rows'][key] = rows[-1].id
+        self.save(counts)
+
+    def restore(self, filename, counts):
+        """Moves a missing blob back from quarantine, if it is there."""
+        if not self.quarantine_dir or not os.path.isfile(os.path.join(self.quarantine_dir, filename)):
+            return None
+        shutil.move(os.path.join(self.quarantine_dir, filename), os.path.join(self.upload_folder, filename))
+        counts['restored'] += 1
+        return 'restored'
+
+    # --- Files: every blob has a file row ---
+
+    def scrub_files(self):
+        """Returns False if it ran out of time."""
+        partitions = self.state['partitions']
+        for partition in range(partitions):
+            if partition in self.state['files_done']:
+                continue
+            if self.out_of_time():
+                return False
+            counts = self.scrub_partition(partition, partitions)
+            self.state['files_done'].append(partition)
+            self.save(counts)
+        self.echo(f'Listed every file in {self.upload_folder}.')
+        return True
+
+    def scrub_partition(self, partition, partitions):
+        counts, names = dict.fromkeys(COUNTS, 0), []
+        with os.scandir(self.upload_folder) as entries:
+            for entry in entries:
+                if zlib.crc32(os.fsencode(entry.name)) % partitions != partition:
+                    continue
+                if entry.name.startswith('.') or not entry.is_file(follow_symlinks=False):
+                    continue
+                names.append(entry.name)
+                if len(names) >= self.batch_size:
+                    self.scrub_name_batch(names, counts)
+                    names = []
+        if names:
+            self.scrub_name_batch(names, counts)
+        return counts
+
+    def scrub_name_batch(self, names, counts):
+        counts['files'] += len(names)
+        known = known_anywhere(names)
+        newest = time.time() - self.grace.total_seconds()
+        for name in names:
+            if name in known:
+                continue
+            path = os.path.join(self.upload_folder, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue # Removed since the listing
+            if stat.st_mtime > newest:
+                continue # Its row may not be committed yet
+            counts['orphans'] += 1
+            action = self.quarantine(name, counts) if self.quarantine_dir else None
+            self.record('orphan', filename=name, size_bytes=stat.st_size,
+                        modified=datetime.datetime.fromtimestamp(stat.st_mtime).isoformat(timespec='seconds'), action=action)
+
+    def quarantine(self, name, counts):
+        if known_anywhere([name]): # Committed since the batch was looked up
+            return None
+        shutil.move(os.path.join(self.upload_folder, name), os.path.join(self.quarantine_dir, name))
+        counts['quarantined'] += 1
+        return 'quarantined'
+
+
+def scrub_uploads(upload_folder, scrub_dir, quarantine_dir=None, verify=False, workers=8, batch_size=1000, partitions=16,
+                  grace=datetime.timedelta(hours=1), max_seconds=None, restart=False, echo=print):
+    """Runs or resumes a scrub of upload_folder. Returns its state: counts, report path and finished_at
+    (None if it stopped early and the next call will carry on)."""
+    os.makedirs(scrub_dir, exist_ok=True)
+    if quarantine_dir:
+        os.makedirs(quarantine_dir, exist_ok=True)
+    checkpoint_path = os.path.join(scrub_dir, 'checkpoint.json')
+    state = None if restart else load_checkpoint(checkpoint_path)
+    if state is None or state['finished_at']:
+        state = new_state(scrub_dir, partitions)
+    else:
+        echo(f'Resuming the scrub started at {state["started_at"]}.')
+    deadline = time.monotonic() + max_seconds if max_seconds else None
+
+    with open(state['report'], 'a') as report:
+        scrubber = Scrubber(state, checkpoint_path, report, upload_folder, quarantine_dir, verify, workers, batch_size,
+                            grace, deadline, echo)
+        try:
+            if scrubber.scrub_rows() and scrubber.scrub_files():
+                state['finished_at'] = datetime.datetime.now().isoformat(timespec='seconds')
+                scrubber.save()
+        finally:
+            scrubber.pool.shutdown(wait=False, cancel_futures=True)
+    return state
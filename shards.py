@@ -0,0 +1,165 @@
+"""Optional region sharding: one SQLite database per region, picked by pincode.
+
+With SHARDS empty (the default) everything lives in SQLALCHEMY_DATABASE_URI and
+nothing here changes behaviour. Otherwise:
+
+- SHARDS maps region names to database URIs, e.g. from the environment:
+  SHARDS='north=sqlite:///shards/north.db,south=sqlite:///shards/south.db'.
+  Every region database holds the full schema; a new, empty one is built from
+  the models on startup.
+- SHARD_REGIONS maps pincode prefixes to regions (the longest matching prefix
+  wins). An account belongs to the region of the pincode it registered with;
+  pincodes outside every configured region, and every account created before
+  sharding was turned on, stay in the default database.
+- Each request works in its user's region. The region travels with the login
+  (the session and remember-me cookies hold 'region:user_id'), and
+  RoutingSession sends every statement of the request to that region's engine.
+  Each region is its own SQLite file with its own write lock, so writes in
+  different regions never wait for each other.
+- fan_out() runs a function in every region in parallel threads. Login uses it
+  to find an email, and doctor search uses it to merge results from every
+  region.
+
+Bookings, records and claims stay within one region: a patient books doctors
+and claims from insurers in their own region. Commands that work on the
+database (jobs-worker, reminders-run, archive-history, db-upgrade, ...) run
+against one region at a time, chosen with the SHARD environment variable.
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from flask import current_app, g, has_app_context
+from flask_login import current_user
+from flask_sqlalchemy.session import Session
+
+# Indian PIN codes: the first digit is the postal zone
+ZONE_REGIONS = {'1': 'north', '2': 'north', '3': 'west', '4': 'west', '5': 'south', '6': 'south', '7': 'east', '8': 'east'}
+
+_CURRENT = object() # qualify_id(): the current region, since None names the default database
+
+
+class RoutingSession(Session):
+    """Sends every statement to the current region's engine (the default bind outside a region)."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and has_app_context():
+            region = current_region()
+            if region is not None:
+                return self._db.engines[region]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def parse_shards(value):
+    """{'north': 'sqlite:///north.db', ...} from 'north=sqlite:///north.db,...'."""
+    shards = {}
+    for item in filter(None, (part.strip() for part in value.split(','))):
+        region, _, uri = item.partition('=')
+        if not region or not uri:
+            raise ValueError(f'SHARDS entries look like region=uri, not {item!r}')
+        shards[region.strip()] = uri.strip()
+    return shards
+
+
+def init_sharding(app):
+    """Configures the region binds. Call before db.init_app(app)."""
+    app.config.setdefault('SHARDS', parse_shards(os.environ.get('SHARDS', '')))
+    app.config.setdefault('SHARD_REGIONS', ZONE_REGIONS)
+    app.config.setdefault('SHARD', os.environ.get('SHARD') or None) # Region of commands run outside a request
+    app.config.setdefault('SHARD_FAN_OUT_WORKERS', None) # Threads for fan_out (None = one per region)
+    shards = app.config['SHARDS']
+    if app.config['SHARD'] is not None and app.config['SHARD'] not in shards:
+        raise ValueError(f'SHARD {app.config["SHARD"]!r} is not one of SHARDS')
+    app.config['SQLALCHEMY_BINDS'] = {**app.config.get('SQLALCHEMY_BINDS', {}), **shards}
+    workers = app.config['SHARD_FAN_OUT_WORKERS'] or len(shards) + 1
+    app.extensions['shards'] = ThreadPoolExecutor(workers, thread_name_prefix='shard') if shards else None
+
+    @app.before_request
+    def select_region():
+        """Loads the user now, so the region main.load_user selects applies to every query of the request."""
+        current_user._get_current_object()
+
+
+def is_sharded():
+    return bool(current_app.config.get('SHARDS'))
+
+
+def regions():
+    """Every region, None (the default database) first."""
+    return [None, *current_app.config['SHARDS']]
+
+
+def current_region():
+    # .get(): scripts such as init_db.py bind `db` to a bare app without init_sharding()
+    return g.get('region', current_app.config.get('SHARD'))
+
+
+def set_region(region):
+    """Works in `region` for the rest of the request or app context."""
+    if region is not None and region not in current_app.config['SHARDS']:
+        raise KeyError(f'Unknown region {region!r}')
+    g.region = region
+
+
+@contextmanager
+def use_region(region):
+    previous = g.get('region', current_app.config.get('SHARD'))
+    set_region(region)
+    try:
+        yield
+    finally:
+        g.region = previous
+
+
+def engine():
+    """The current region's engine."""
+    return current_app.extensions['sqlalchemy'].engines[current_region()]
+
+
+def region_for_pincode(pincode):
+    """The region an account with this pincode belongs to (None for the default database)."""
+    pincode = (pincode or '').strip()
+    prefixes = current_app.config['SHARD_REGIONS']
+    for length in range(len(pincode), 0, -1):
+        region = prefixes.get(pincode[:length])
+        if region is not None:
+            return region if region in current_app.config['SHARDS'] else None
+    return None
+
+
+def qualify_id(value, region=_CURRENT):
+    """An id that is unique across regions: 'region:id', or just 'id' in the process's own region."""
+    region = current_region() if region is _CURRENT else region
+    return str(value) if region == current_app.config.get('SHARD') else f'{region or ""}:{value}'
+
+
+def parse_id(qualified):
+    """(region, int id) from qualify_id()'s output. Raises ValueError if malformed."""
+    region, _, value = str(qualified).rpartition(':')
+    if not _:
+        return current_app.config.get('SHARD'), int(value)
+    return region or None, int(value)
+
+
+def fan_out(fn, *args, **kwargs):
+    """{region: fn(*args, **kwargs)}, run in every region at once, each in its own app context and session.
+
+    Unsharded, fn simply runs here and the result is {None: result}.
+    """
+    executor = current_app.extensions['shards']
+    if executor is None:
+        return {None: fn(*args, **kwargs)}
+    app = current_app._get_current_object()
+
+    def run(region):
+        with app.app_context():
+            set_region(region)
+            return fn(*args, **kwargs)
+
+    futures = {region: executor.submit(run, region) for region in regions()}
+    return {region: future.result() for region, future in futures.items()}
+
+
+def scoped(key):
+    """`key` for a per-process cache, qualified with the current region when there is one."""
+    region = current_region()
+    return key if region is None else (region, key)
@@ -0,0 +1,41 @@
+"""Runs `flask check-query-plans` against a small generated database.
+
+    python -m pytest tests
+"""
+import os
+import subprocess
+import sys
+
+import pytest
+
+basedir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, basedir)
+
+
+@pytest.fixture(scope='module')
+def generated_db(tmp_path_factory):
+    db_path = str(tmp_path_factory.mktemp('query_plans') / 'plans.db')
+    subprocess.run(
+        [sys.executable, os.path.join(basedir, 'generate_data.py'), '--db', db_path, '--insurers', '3', '--doctors', '500',
+         '--patients', '2000', '--appointments', '10000', '--reviews', '3000', '--records', '900', '--files', '200'],
+        cwd=basedir, check=True, capture_output=True,
+    )
+    return db_path
+
+
+@pytest.mark.parametrize('preload', [False, True])
+def test_no_hot_table_scans(generated_db, tmp_path, preload):
+    import autocomplete
+    import main
+
+    autocomplete._indexes.clear() # Start cold, as a fresh worker does
+    app = main.create_app({
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + generated_db,
+        'AUTOCOMPLETE_PRELOAD': preload,
+        'RATE_LIMIT_ENABLED': False,
+        'UPLOAD_FOLDER': str(tmp_path / 'uploads'),
+        'INVOICE_DIR': str(tmp_path / 'invoices'),
+    })
+    result = app.test_cli_runner().invoke(args=['check-query-plans'])
+    assert result.exit_code == 0, result.output
+    assert 'No full scans of hot tables.' in result.output